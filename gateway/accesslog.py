@@ -0,0 +1,195 @@
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger("gateway.access")
+
+# settings.json 的 "access_log" 段：每个请求一条 JSON 访问日志，由后台线程格式化写出
+DEFAULT_ACCESS_LOG_OPTIONS = {
+    "enabled": True,
+    "sample_rate": 1.0,    # 成功请求的采样比例（0～1），4xx / 5xx 始终记录
+    "debug": False,        # 记录每次上游尝试的请求体概要和（脱敏）请求头
+    "queue_size": 10000,   # 待写日志上限，写不过来时丢弃并计数
+}
+
+
+def access_log_options(settings: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_ACCESS_LOG_OPTIONS)
+    overrides = (settings or {}).get("access_log")
+    if isinstance(overrides, dict):
+        for k in DEFAULT_ACCESS_LOG_OPTIONS:
+            if overrides.get(k) is not None:
+                options[k] = overrides[k]
+    try:
+        rate = float(options["sample_rate"])
+        if rate != rate:
+            raise ValueError("NaN")
+        options["sample_rate"] = min(1.0, max(0.0, rate))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid access_log.sample_rate {options['sample_rate']!r}; logging every request")
+        options["sample_rate"] = 1.0
+    return options
+
+
+class AccessRecord:
+    """Per-request fields filled in by the handlers; read once when the response has been sent."""
+
+    __slots__ = ("sampled", "debug", "service", "model", "upstream_model", "ttfb", "cache", "hedged", "attempts")
+
+    def __init__(self, sampled: bool, debug: bool):
+        self.sampled = sampled
+        self.debug = debug
+        self.service: Optional[str] = None
+        self.model: Optional[str] = None
+        self.upstream_model: Optional[str] = None
+        self.ttfb: Optional[float] = None
+        self.cache: Optional[str] = None
+        self.hedged = False
+        self.attempts: Optional[List[Dict]] = None
+
+
+_current: ContextVar[Optional[AccessRecord]] = ContextVar("access_record", default=None)
+
+
+def current_record() -> Optional[AccessRecord]:
+    return _current.get()
+
+
+def annotate(**fields):
+    """Set fields on the current request's record (no-op outside a logged request)."""
+    record = _current.get()
+    if record is not None:
+        for name, value in fields.items():
+            setattr(record, name, value)
+
+
+def debug_record() -> Optional[AccessRecord]:
+    """The current record when it is sampled in debug mode; build detail only when this is not None."""
+    record = _current.get()
+    return record if record is not None and record.debug and record.sampled else None
+
+
+class AccessLog:
+    """
+    Bounded queue plus one writer thread. The request path only puts a tuple on the queue;
+    JSON encoding and the logging call happen on the writer thread.
+    """
+
+    def __init__(self, options_fn: Callable[[], Dict]):
+        self._options_fn = options_fn
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def options(self) -> Dict:
+        return self._options_fn()
+
+    def submit(self, item: tuple):
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            try:
+                access_logger.info(json.dumps(_format(item), ensure_ascii=False, default=str))
+                self.written += 1
+            except Exception as e:
+                logger.error(f"Access log write failed: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._queue = queue.Queue(maxsize=max(1, int(self._options_fn()["queue_size"])))
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name="access-log", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            q, self._queue = self._queue, None
+            q.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self) -> Dict:
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+
+_FIELDS = ("ts", "method", "path", "status", "duration_ms", "bytes", "key", "service", "model", "upstream_model",
+           "ttfb_ms", "cache", "hedged", "attempts")
+
+
+def _format(item: tuple) -> Dict:
+    entry = dict(zip(_FIELDS, item))
+    entry["ts"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(entry["ts"])) + f".{int(entry['ts'] % 1 * 1000):03d}Z"
+    entry["duration_ms"] = round(entry["duration_ms"] * 1000, 1)
+    if entry["ttfb_ms"] is not None:
+        entry["ttfb_ms"] = round(entry["ttfb_ms"] * 1000, 1)
+    return {k: v for k, v in entry.items() if v is not None and v is not False}
+
+
+class AccessLogMiddleware:
+    """
+    Outermost ASGI middleware: one record per HTTP request, taken when the last body chunk has been
+    sent (so streamed responses report their full duration). Successful requests are sampled up front
+    so unsampled ones never build debug detail; errors are always logged.
+    """
+
+    def __init__(self, app, log: AccessLog):
+        self.app = app
+        self.log = log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        options = self.log.options()
+        if not options.get("enabled", True):
+            await self.app(scope, receive, send)
+            return
+
+        rate = options["sample_rate"]
+        record = AccessRecord(rate >= 1.0 or random.random() < rate, bool(options.get("debug")))
+        token = _current.set(record)
+        started = time.monotonic()
+        response = [0, 0]  # status, bytes
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response[0] = message["status"]
+            elif message["type"] == "http.response.body":
+                response[1] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            status, sent = response
+            if record.sampled or status >= 400 or status == 0:
+                spec = (scope.get("state") or {}).get("api_key")
+                self.log.submit((
+                    time.time(), scope["method"], scope["path"], status, time.monotonic() - started, sent,
+                    spec["name"] if spec else None, record.service, record.model, record.upstream_model,
+                    record.ttfb, record.cache, record.hedged, record.attempts,
+                ))
+            else:
+                self.log.sampled_out += 1
@@ -0,0 +1,299 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from scheduler import token_id
+
+logger = logging.getLogger(__name__)
+
+# settings.json 的 "api_keys" 段。keys 为空时不做鉴权（兼容任意 Key 的旧行为）
+# "keys": {"sk-gw-xxx": {"name": "team-a", "rpm": 120, "max_streams": 8}}
+DEFAULT_API_KEY_OPTIONS = {
+    "enabled": True,
+    "rpm": 60,              # 每个 Key 每分钟请求数
+    "burst": 0,             # 令牌桶容量，0 表示等于 rpm
+    "max_streams": 4,       # 每个 Key 同时进行的流式请求数，0 表示不限
+    "flush_interval": 10.0, # 计数器写盘间隔（秒）
+    "keys": {},
+}
+
+
+def api_key_options(settings: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_API_KEY_OPTIONS)
+    overrides = (settings or {}).get("api_keys")
+    if isinstance(overrides, dict):
+        for k in DEFAULT_API_KEY_OPTIONS:
+            if overrides.get(k) is not None:
+                options[k] = overrides[k]
+    return options
+
+
+def compile_api_keys(options: Dict) -> Dict[str, Dict]:
+    """Gateway key -> limits with defaults filled in; empty when API keys are disabled."""
+    keys = options.get("keys") if options.get("enabled", True) else None
+    if not isinstance(keys, dict):
+        return {}
+    compiled = {}
+    for key, spec in keys.items():
+        if not isinstance(key, str) or not key.strip():
+            continue
+        if not isinstance(spec, dict):
+            spec = {"name": spec if isinstance(spec, str) else None}
+        rpm = float(spec.get("rpm") if spec.get("rpm") is not None else options["rpm"])
+        burst = float(spec.get("burst") or options["burst"] or rpm)
+        compiled[key.strip()] = {
+            "id": token_id(key.strip()),
+            "name": spec.get("name") or token_id(key.strip()),
+            "rpm": rpm,
+            "burst": burst,
+            "max_streams": int(spec.get("max_streams") if spec.get("max_streams") is not None else options["max_streams"]),
+        }
+    return compiled
+
+
+class KeyRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int = 0):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "streams", "requests", "rejected")
+
+    def __init__(self, capacity: float):
+        self.tokens = capacity
+        self.updated = time.time()
+        self.streams = 0
+        self.requests = 0
+        self.rejected = 0
+
+
+class StreamSlot:
+    """Released exactly once when the streaming response finishes."""
+
+    __slots__ = ("_bucket", "_released")
+
+    def __init__(self, bucket: _Bucket):
+        self._bucket = bucket
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._bucket.streams = max(0, self._bucket.streams - 1)
+
+
+class ApiKeyLimiter:
+    """
+    Per-key token buckets (requests per minute) and concurrent stream counters, all O(1) in memory.
+    Bucket levels and request counters are written to state_file every flush_interval seconds and
+    restored at startup, so a restart neither resets quotas nor loses usage numbers.
+    With a SharedState (multi-process deployment) the buckets live there instead, so every worker
+    process draws from the same quota; stream counters stay per process.
+    """
+
+    def __init__(self, state_file: str, keys_fn: Callable[[], Tuple[Dict[str, Dict], Dict]], shared=None):
+        self._state_file = state_file
+        self._keys_fn = keys_fn
+        self._shared = shared
+        self._buckets: Dict[str, _Bucket] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._load()
+
+    def _bucket(self, spec: Dict) -> _Bucket:
+        bucket = self._buckets.get(spec["id"])
+        if bucket is None:
+            bucket = _Bucket(spec["burst"])
+            self._buckets[spec["id"]] = bucket
+        return bucket
+
+    def authenticate(self, authorization: Optional[str]) -> Optional[Dict]:
+        """Key spec for the presented key; None when no keys are configured (auth off)."""
+        keys, _ = self._keys_fn()
+        if not keys:
+            return None
+        presented = (authorization or "").strip()
+        if presented.lower().startswith("bearer "):
+            presented = presented[7:].strip()
+        spec = keys.get(presented)
+        if spec is None:
+            raise KeyRejected(401, "Invalid API key")
+        return spec
+
+    async def admit(self, spec: Dict):
+        """Take one request token from the key's bucket or raise KeyRejected(429)."""
+        rate = spec["rpm"] / 60.0
+        if self._shared is not None:
+            try:
+                # The shared bucket is a SQLite write transaction; keep its lock wait off the event loop
+                admitted, tokens = await asyncio.to_thread(self._shared.take, spec["id"], spec["rpm"], spec["burst"])
+            except Exception as e:
+                # Shared store busy or broken: fall back to this process's own bucket
+                logger.warning(f"Shared rate limit unavailable, using local bucket: {e}")
+            else:
+                if not admitted:
+                    self._reject(spec, tokens, rate)
+                return
+
+        bucket = self._bucket(spec)
+        now = time.time()
+        bucket.tokens = min(spec["burst"], bucket.tokens + (now - bucket.updated) * rate)
+        bucket.updated = now
+        if bucket.tokens < 1.0:
+            bucket.rejected += 1
+            self._reject(spec, bucket.tokens, rate)
+        bucket.tokens -= 1.0
+        bucket.requests += 1
+
+    @staticmethod
+    def _reject(spec: Dict, tokens: float, rate: float):
+        retry_after = math.ceil((1.0 - tokens) / rate) if rate > 0 else 60
+        raise KeyRejected(429, f"Rate limit exceeded for key {spec['name']} ({spec['rpm']:g} rpm)", retry_after)
+
+    def open_stream(self, spec: Dict) -> StreamSlot:
+        bucket = self._bucket(spec)
+        if spec["max_streams"] > 0 and bucket.streams >= spec["max_streams"]:
+            bucket.rejected += 1
+            raise KeyRejected(429, f"Too many concurrent streams for key {spec['name']} (max {spec['max_streams']})", 1)
+        bucket.streams += 1
+        return StreamSlot(bucket)
+
+    def _load(self):
+        if not os.path.exists(self._state_file):
+            return
+        try:
+            with open(self._state_file, "r") as f:
+                saved = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading API key state: {e}")
+            return
+        for key_id, item in (saved.get("keys") or {}).items():
+            bucket = _Bucket(0.0)
+            bucket.tokens = float(item.get("tokens", 0.0))
+            bucket.updated = float(item.get("updated", time.time()))
+            bucket.requests = int(item.get("requests", 0))
+            bucket.rejected = int(item.get("rejected", 0))
+            self._buckets[key_id] = bucket
+
+    def _state(self) -> Dict:
+        return {
+            "saved_at": time.time(),
+            "keys": {
+                key_id: {
+                    "tokens": round(b.tokens, 3),
+                    "updated": b.updated,
+                    "requests": b.requests,
+                    "rejected": b.rejected,
+                }
+                for key_id, b in self._buckets.items()
+            },
+        }
+
+    def _write(self, state: Dict):
+        tmp_file = f"{self._state_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self._state_file)
+
+    async def _loop(self):
+        while True:
+            _, options = self._keys_fn()
+            await asyncio.sleep(max(1.0, float(options.get("flush_interval") or 10.0)))
+            try:
+                if self._buckets:
+                    # Snapshot on the loop, write off it
+                    await asyncio.to_thread(self._write, self._state())
+            except Exception as e:
+                logger.error(f"Error saving API key state: {e}")
+
+    def start(self):
+        if self._task is None and self._shared is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            if self._buckets and self._shared is None:
+                self._write(self._state())
+        except Exception as e:
+            logger.error(f"Error saving API key state: {e}")
+
+    def stats(self) -> Dict:
+        keys, _ = self._keys_fn()
+        shared = self._shared.buckets() if self._shared is not None else {}
+        result = {}
+        for spec in keys.values():
+            bucket = self._buckets.get(spec["id"])
+            usage = shared.get(spec["id"])
+            if usage is None and bucket is not None:
+                usage = {"tokens": bucket.tokens, "requests": bucket.requests, "rejected": bucket.rejected}
+            result[spec["name"]] = {
+                "key_id": spec["id"],
+                "rpm": spec["rpm"],
+                "max_streams": spec["max_streams"],
+                "tokens": round(usage["tokens"], 2) if usage else spec["burst"],
+                "streams": bucket.streams if bucket else 0,
+                "requests": usage["requests"] if usage else 0,
+                "rejected": usage["rejected"] if usage else 0,
+            }
+        return result
+
+
+class ApiKeyMiddleware:
+    """
+    ASGI middleware guarding /v1/*: authenticates the gateway key and takes a request token before the
+    route runs, so rejected calls never reach routing or an upstream. Stream slots opened by the route
+    (scope state "api_key_stream") are released when the response has been fully sent.
+    """
+
+    def __init__(self, app, limiter: ApiKeyLimiter, prefix: str = "/v1/"):
+        self.app = app
+        self.limiter = limiter
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        authorization = None
+        for name, value in scope.get("headers") or []:
+            if name == b"authorization":
+                authorization = value.decode("latin-1")
+                break
+        try:
+            spec = self.limiter.authenticate(authorization)
+            if spec is not None:
+                await self.limiter.admit(spec)
+        except KeyRejected as e:
+            await self._reject(send, e)
+            return
+
+        state = scope.setdefault("state", {})
+        state["api_key"] = spec
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            slot = state.pop("api_key_stream", None)
+            if slot is not None:
+                slot.release()
+
+    @staticmethod
+    async def _reject(send, error: KeyRejected):
+        body = json.dumps({"detail": error.detail}, ensure_ascii=False).encode("utf-8")
+        headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        if error.retry_after:
+            headers.append((b"retry-after", str(error.retry_after).encode()))
+        if error.status_code == 401:
+            headers.append((b"www-authenticate", b"Bearer"))
+        await send({"type": "http.response.start", "status": error.status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
@@ -4,26 +4,130 @@ import random
 import asyncio
 import time
 import httpx
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException, Body
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, StreamingResponse, Response
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
+from starlette.requests import ClientDisconnect
 from pydantic import BaseModel
-from typing import Dict, List, Optional
+from typing import Awaitable, Dict, List, Optional
 from datetime import datetime, timezone
 import logging
 
+from accesslog import AccessLog, AccessLogMiddleware, access_log_options, annotate, debug_record
+from batch import batch_concurrency, batch_line, batch_options, fan_out
+from batches import (
+    PURPOSE_BATCH,
+    SUPPORTED_ENDPOINTS,
+    BatchRunner,
+    BatchStore,
+    FileTooLarge,
+    batch_view,
+    batches_options,
+    completion_window_seconds,
+    file_view,
+)
+from apikeys import ApiKeyLimiter, ApiKeyMiddleware, KeyRejected, api_key_options, compile_api_keys
+from cache import ResponseCache, cache_key, cache_options, cache_ttl, compile_cache_policies, raw_key
+from clients import UpstreamClients
+from config_store import ConfigStore
+from disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnects, DisconnectMiddleware, cancel_on_disconnect
+from health import HealthMonitor, health_options
+from hedging import FirstByteTracker, hedging_options, race
+from jobs import JobFull, JobQueue, JobStore, job_options, job_view
+from metrics import GatewayMetrics, render_labels
+from limiter import (
+    PRIORITY_BATCH,
+    PRIORITY_DEFAULT,
+    PRIORITY_INTERACTIVE,
+    ConcurrencyLimiter,
+    LimitExceeded,
+    compile_limit_options,
+)
+from breaker import BreakerRegistry, compile_breaker_options
+from rawjson import RawBody, scan_fields
+from routing import FailoverIndex, ModelCatalog, RoutingTable
+from scheduler import TokenScheduler, compile_accounts
+from shared import SharedState
+from singleflight import SingleFlight, compile_singleflight_options
+from sse import (
+    PING,
+    SSE_REWRITE,
+    compile_heartbeat_options,
+    heartbeat,
+    heartbeat_interval,
+    iter_text_lines,
+    passthrough_sse,
+    prepend_chunk,
+    rewrite_sse_lines,
+)
+from transforms import compile_transforms, default_transform
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="AI API Gateway")
+# 每个上游服务一个长连接 client（连接池 + keep-alive），在 lifespan 中创建/关闭
+upstream_clients = UpstreamClients()
+# 按健康度选择账号（替代 random.choice），401/429/5xx 的账号会被临时隔离
+token_scheduler = TokenScheduler()
+concurrency_limiter = ConcurrencyLimiter(token_scheduler)
+# 每个上游服务一个熔断器；熔断时按 settings.json 的 failover 分组切换到等价模型
+breakers = BreakerRegistry()
+response_cache = ResponseCache()
+gateway_metrics = GatewayMetrics()
+single_flight = SingleFlight()
+first_byte_tracker = FirstByteTracker()
+# 连接超时单独收紧，上游容器宕机时尽快失败并转移
+CHAT_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+# 非流式 / 图片 / 视频响应按固定块大小边收边发，单个请求的内存占用与响应体大小无关
+STREAM_CHUNK_SIZE = 64 * 1024
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    snapshot = config_store.reload()
+    if shared_state is not None:
+        shared_state.start()
+    await upstream_clients.sync(snapshot.services)
+    response_cache.configure(snapshot.compiled["cache_options"])
+    config_store.start()
+    health_monitor.start()
+    api_key_limiter.start()
+    access_log.start()
+    await job_queue.start()
+    await batch_runner.start()
+    try:
+        yield
+    finally:
+        await batch_runner.stop()
+        await job_queue.stop()
+        access_log.stop()
+        await api_key_limiter.stop()
+        await health_monitor.stop()
+        await config_store.stop()
+        await upstream_clients.aclose()
+        if shared_state is not None:
+            await shared_state.stop()
+
+app = FastAPI(title="AI API Gateway", lifespan=lifespan)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
 
 CONFIG_FILE = os.path.join(BASE_DIR, "config.json")
 DEFAULT_CONFIG_FILE = os.path.join(BASE_DIR, "config.default.json")
-
-def load_config():
+# 网关级设置（故障转移、熔断等），settings.json 中的同名段落覆盖 settings.default.json
+SETTINGS_FILE = os.path.join(BASE_DIR, "settings.json")
+DEFAULT_SETTINGS_FILE = os.path.join(BASE_DIR, "settings.default.json")
+# 配置文件变更检测间隔（秒），0 表示关闭文件监听，仅在保存时重新加载
+CONFIG_WATCH_INTERVAL = float(os.environ.get("GATEWAY_CONFIG_WATCH_INTERVAL", "2"))
+# 工作进程数（python app.py 启动时生效）；大于 1 时账号隔离、熔断、API Key 令牌桶和配置版本
+# 通过 gateway_state.db 在进程之间共享
+GATEWAY_WORKERS = max(1, int(os.environ.get("GATEWAY_WORKERS", "1")))
+SHARED_STATE_FILE = os.path.join(BASE_DIR, "gateway_state.db")
+shared_state = SharedState(SHARED_STATE_FILE) if GATEWAY_WORKERS > 1 else None
+
+def load_config(strict: bool = False):
     default_config = {}
     if os.path.exists(DEFAULT_CONFIG_FILE):
         try:
@@ -60,6 +164,8 @@ def load_config():
             return user_config
         except Exception as e:
             logger.error(f"Error loading config.json: {e}")
+            if strict:
+                raise
             
     # Fallback to default if config.json doesn't exist or failed to load
     if default_config:
@@ -70,14 +176,183 @@ def load_config():
             
     return {}
 
+def load_settings(strict: bool = False):
+    settings = {}
+    for path in (DEFAULT_SETTINGS_FILE, SETTINGS_FILE):
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, "r") as f:
+                loaded = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading {os.path.basename(path)}: {e}")
+            if strict:
+                raise
+            continue
+        for section, val in (loaded or {}).items():
+            if isinstance(val, dict) and isinstance(settings.get(section), dict):
+                settings[section] = {**settings[section], **val}
+            else:
+                settings[section] = val
+    return settings
+
 def save_config(config):
-    with open(CONFIG_FILE, "w") as f:
+    # 先写临时文件再替换，避免监听器读到写了一半的 config.json
+    tmp_file = f"{CONFIG_FILE}.tmp"
+    with open(tmp_file, "w") as f:
         json.dump(config, f, indent=4)
+    os.replace(tmp_file, CONFIG_FILE)
+
+# 合并后的配置只在启动、保存或文件变化时编译一次，请求路径只读取当前快照
+config_store = ConfigStore(
+    load_config,
+    [CONFIG_FILE, DEFAULT_CONFIG_FILE, SETTINGS_FILE, DEFAULT_SETTINGS_FILE],
+    settings_loader=load_settings,
+    interval=CONFIG_WATCH_INTERVAL,
+)
+
+async def _sync_upstream_clients(snapshot):
+    await upstream_clients.sync(snapshot.services)
+
+async def _prune_token_states(snapshot):
+    token_scheduler.prune(snapshot.compiled["accounts"])
+
+async def _configure_limiter(snapshot):
+    concurrency_limiter.configure(snapshot.compiled["limit_options"])
+
+async def _configure_response_cache(snapshot):
+    response_cache.configure(snapshot.compiled["cache_options"])
+
+config_store.register_compiler("routing", lambda snapshot: RoutingTable(snapshot.services))
+config_store.register_compiler(
+    "models", lambda snapshot: ModelCatalog(snapshot.compiled["routing"], int(snapshot.loaded_at))
+)
+config_store.register_compiler("accounts", lambda snapshot: compile_accounts(snapshot.services))
+config_store.register_compiler(
+    "transforms", lambda snapshot: compile_transforms(snapshot.services, snapshot.compiled["accounts"])
+)
+config_store.register_compiler("failover", lambda snapshot: FailoverIndex(snapshot.settings, snapshot.services))
+config_store.register_compiler(
+    "breaker_options",
+    lambda snapshot: compile_breaker_options(snapshot.services, snapshot.settings.get("breaker")),
+)
+config_store.register_compiler("health_options", lambda snapshot: health_options(snapshot.settings))
+config_store.register_compiler("cache_options", lambda snapshot: cache_options(snapshot.settings))
+config_store.register_compiler(
+    "cache_policies",
+    lambda snapshot: compile_cache_policies(snapshot.services, snapshot.compiled["cache_options"]),
+)
+config_store.register_compiler(
+    "singleflight_options",
+    lambda snapshot: compile_singleflight_options(snapshot.services, snapshot.settings.get("singleflight")),
+)
+config_store.register_compiler(
+    "heartbeat_options",
+    lambda snapshot: compile_heartbeat_options(snapshot.services, snapshot.settings.get("heartbeat")),
+)
+config_store.register_compiler(
+    "limit_options",
+    lambda snapshot: compile_limit_options(snapshot.services, snapshot.settings.get("limits")),
+)
+config_store.register_compiler(
+    "route_metrics", lambda snapshot: gateway_metrics.bind_routes(snapshot.compiled["routing"].models())
+)
+config_store.register_compiler("hedging_options", lambda snapshot: hedging_options(snapshot.settings))
+config_store.register_compiler("api_key_options", lambda snapshot: api_key_options(snapshot.settings))
+config_store.register_compiler("api_keys", lambda snapshot: compile_api_keys(snapshot.compiled["api_key_options"]))
+config_store.register_compiler("job_options", lambda snapshot: job_options(snapshot.settings))
+config_store.register_compiler("access_log_options", lambda snapshot: access_log_options(snapshot.settings))
+config_store.register_compiler("batch_options", lambda snapshot: batch_options(snapshot.settings))
+config_store.register_compiler("batches_options", lambda snapshot: batches_options(snapshot.settings))
+config_store.add_listener(_sync_upstream_clients)
+config_store.add_listener(_prune_token_states)
+config_store.add_listener(_configure_response_cache)
+config_store.add_listener(_configure_limiter)
+
+def _publish_quarantine(service_key: str, tid: str, seconds: float, failures: int):
+    shared_state.publish("token", service_key, {"token_id": tid, "until": time.time() + seconds, "failures": failures})
+
+def _apply_quarantine(service_key: str, data: Dict):
+    seconds = data["until"] - time.time()
+    if seconds > 0:
+        token_scheduler.apply_quarantine(service_key, data["token_id"], seconds, data["failures"])
+
+def _publish_breaker(service_key: str, state: str, open_seconds_left: float):
+    shared_state.publish("breaker", service_key, {"state": state, "until": time.time() + open_seconds_left})
+
+def _apply_breaker(service_key: str, data: Dict):
+    breakers.apply(service_key, data["state"], max(0.0, data["until"] - time.time()))
+
+def _apply_config_version(_key: str, data: Dict):
+    # Another process saved config.json; reload now instead of waiting for the file watcher
+    if data.get("signature") != json.dumps(config_store.signature()):
+        config_store.request_reload()
+
+if shared_state is not None:
+    token_scheduler.on_quarantine = _publish_quarantine
+    breakers.on_change = _publish_breaker
+    shared_state.subscribe("token", _apply_quarantine)
+    shared_state.subscribe("breaker", _apply_breaker)
+    shared_state.subscribe("config", _apply_config_version)
+
+def _api_keys():
+    snapshot = config_store.current()
+    return snapshot.compiled["api_keys"], snapshot.compiled["api_key_options"]
+
+# 网关 API Key 的令牌桶状态与计数，定期写盘，重启后恢复
+API_KEY_STATE_FILE = os.path.join(BASE_DIR, "api_keys_state.json")
+api_key_limiter = ApiKeyLimiter(API_KEY_STATE_FILE, _api_keys, shared_state)
+# 客户端断开后立即取消仍在等待的上游调用（最内层，只处理已通过鉴权的请求）
+client_disconnects = ClientDisconnects()
+app.add_middleware(DisconnectMiddleware, disconnects=client_disconnects)
+app.add_middleware(ApiKeyMiddleware, limiter=api_key_limiter)
+# 最外层：每个请求一条访问日志（含被 API Key 拒绝的请求）
+access_log = AccessLog(lambda: config_store.current().compiled["access_log_options"])
+app.add_middleware(AccessLogMiddleware, log=access_log)
+
+def _disconnected(request: Request) -> Optional[asyncio.Event]:
+    """Set by DisconnectMiddleware when the client goes away; None outside /v1/*."""
+    return getattr(request.state, "disconnected", None)
+
+def _open_key_stream(request: Request):
+    """Count a streaming response against the caller's gateway key; the middleware releases it at the end."""
+    spec = getattr(request.state, "api_key", None)
+    if spec is None:
+        return
+    try:
+        request.state.api_key_stream = api_key_limiter.open_stream(spec)
+    except KeyRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
+def current_config() -> Dict:
+    return config_store.current().services
+
+def _route_model(snapshot, model: str):
+    return snapshot.compiled["routing"].lookup(model)
+
+async def _acquire_token(
+    snapshot, target_key: str, target_service: Dict, priority: int = PRIORITY_DEFAULT, exclude: Optional[str] = None
+):
+    """
+    Lease an account, waiting for a concurrency slot if needed; raises LimitExceeded (429) on backpressure.
+    exclude skips that token id (a hedge avoiding the primary's account) unless it is the only one.
+    """
+    entries = snapshot.compiled["accounts"].get(target_key, [])
+    if exclude is not None:
+        entries = [(tid, account) for tid, account in entries if tid != exclude] or entries
+    return await concurrency_limiter.acquire(
+        target_key,
+        entries,
+        target_service,
+        snapshot.compiled["limit_options"].get(target_key) or {},
+        priority,
+    )
 
 def _now_iso_utc():
     return datetime.now(timezone.utc).isoformat()
 
 def _select_service_for_model(config: Dict, model: str):
+    """Reference implementation of model routing; requests go through the compiled RoutingTable."""
     target_service = None
     target_key = None
 
@@ -126,10 +401,12 @@ async def _probe_upstream(
     timeout: float = 10.0,
     token_strategy: str = "first",
     user_agent: str = "Gateway-Monitor/1.0",
+    account=None,
 ):
     """
     Minimal upstream probe (auth + basic endpoint).
     Returns a dict compatible with /api/test response, plus latency_ms/model/checked_at.
+    `account` probes a specific account instead of applying token_strategy.
     """
     started = time.monotonic()
     url = (service or {}).get("url")
@@ -145,7 +422,9 @@ async def _probe_upstream(
 
     token_config = (service or {}).get("token")
     selected_account = None
-    if isinstance(token_config, list) and len(token_config) > 0:
+    if account is not None:
+        selected_account = account
+    elif isinstance(token_config, list) and len(token_config) > 0:
         selected_account = token_config[0] if token_strategy == "first" else random.choice(token_config)
     elif isinstance(token_config, str) and token_config.strip():
         selected_account = token_config
@@ -319,14 +598,47 @@ async def _probe_upstream(
             "checked_at": _now_iso_utc(),
         }
 
+async def _health_probe(service_key: str, service: Dict, account, timeout: float):
+    result = await _probe_upstream(
+        upstream_clients.get(service_key, service),
+        service_key,
+        service,
+        timeout=timeout,
+        account=account,
+        user_agent="Gateway-Monitor/1.0",
+    )
+    gateway_metrics.probes.labels(service_key, result.get("status") or "error").inc()
+    if result.get("latency_ms") is not None:
+        gateway_metrics.probe_latency.labels(service_key).observe(result["latency_ms"] / 1000.0)
+    return result
+
+# 后台健康检查：每个服务按自适应间隔探测，/api/monitor 与 /api/test 读取缓存结果
+health_monitor = HealthMonitor(_health_probe, config_store.current)
+
+async def _elect_health_prober() -> bool:
+    # One process probes the upstreams; the rest apply its results from "health" events
+    return await asyncio.to_thread(shared_state.hold, "health")
+
+def _publish_health(service_key: str, result: Dict, interval: float):
+    shared_state.publish("health", service_key, {"result": result, "interval": interval})
+
+def _apply_health(service_key: str, data: Dict):
+    if service_key in config_store.current().services:
+        health_monitor.apply(service_key, data["result"], float(data["interval"]))
+
+if shared_state is not None:
+    health_monitor.elect = _elect_health_prober
+    health_monitor.on_result = _publish_health
+    shared_state.subscribe("health", _apply_health)
+
 @app.get("/", response_class=HTMLResponse)
 async def dashboard(request: Request):
-    config = load_config()
+    config = current_config()
     return templates.TemplateResponse("index.html", {"request": request, "config": config})
 
 @app.get("/api/config")
 async def get_config():
-    return load_config()
+    return current_config()
 
 @app.post("/api/config")
 async def update_config(config: Dict):
@@ -335,12 +647,16 @@ async def update_config(config: Dict):
     except Exception as e:
         logger.exception(f"Error saving config.json: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to save config: {e}")
+    await config_store.areload()
+    if shared_state is not None:
+        shared_state.publish("config", "version", {"signature": json.dumps(config_store.signature())})
     return {"status": "ok"}
 
 @app.get("/api/env")
 async def get_env_info():
     """Returns environment and config loading status for debugging"""
-    config = load_config()
+    snapshot = config_store.current()
+    config = snapshot.services
     
     # Mask secrets
     masked_config = {}
@@ -356,64 +672,185 @@ async def get_env_info():
     return {
         "config_file_exists": os.path.exists(CONFIG_FILE),
         "default_config_exists": os.path.exists(DEFAULT_CONFIG_FILE),
+        "config_version": snapshot.version,
         "loaded_config": masked_config,
         "env_vars": {k: "***" for k in os.environ if "TOKEN" in k}
     }
 
 @app.get("/api/test/{service_key}")
-async def test_service_connection(service_key: str):
-    """Test connection to a specific service upstream with AUTH check"""
-    config = load_config()
+async def test_service_connection(service_key: str, refresh: bool = False):
+    """Latest cached health probe for a service; ?refresh=1 forces a live probe with AUTH check"""
+    snapshot = config_store.current()
+    config = snapshot.services
     if service_key not in config:
         raise HTTPException(status_code=404, detail="Service not found")
-        
-    service = config[service_key]
-    async with httpx.AsyncClient() as client:
-        return await _probe_upstream(
-            client,
-            service_key,
-            service,
-            timeout=10.0,
-            token_strategy="first",
-            user_agent="Gateway-Test/1.0",
+
+    result = None if refresh else health_monitor.cached(service_key)
+    if result is None:
+        result = await health_monitor.probe(
+            service_key, config[service_key], snapshot.compiled["accounts"].get(service_key, [])
         )
+    return result
 
 @app.get("/api/monitor")
-async def monitor_services(timeout: float = 10.0):
-    """Run a probe against all configured upstream services and return a summary."""
-    config = load_config()
+async def monitor_services(timeout: float = 10.0, refresh: bool = False):
+    """
+    Summary of the background health monitor for all configured upstream services.
+    Served from cache; ?refresh=1 probes every service now (timeout applies to those probes).
+    """
+    snapshot = config_store.current()
+    config = snapshot.services
     keys = list(config.keys())
     checked_at = _now_iso_utc()
 
-    async with httpx.AsyncClient() as client:
-        tasks = [
-            _probe_upstream(
-                client,
-                key,
-                config[key],
-                timeout=timeout,
-                token_strategy="first",
-                user_agent="Gateway-Monitor/1.0",
-            )
-            for key in keys
-        ]
-        results_list = await asyncio.gather(*tasks)
+    results = {}
+    pending = []
+    for key in keys:
+        cached = None if refresh else health_monitor.cached(key)
+        if cached is None:
+            pending.append(key)
+        else:
+            results[key] = cached
+    if pending:
+        probed = await asyncio.gather(*[
+            health_monitor.probe(key, config[key], snapshot.compiled["accounts"].get(key, []), timeout=timeout)
+            for key in pending
+        ])
+        results.update(zip(pending, probed))
+    results = {k: results[k] for k in keys}
 
-    results = {k: v for k, v in zip(keys, results_list)}
     ok = sum(1 for v in results.values() if v.get("status") == "success")
     fail = len(results) - ok
 
     return {
         "checked_at": checked_at,
         "timeout": timeout,
+        "refreshed": refresh,
         "summary": {"total": len(results), "ok": ok, "fail": fail},
         "results": results,
+        "breakers": {
+            key: breakers.get(key, snapshot.compiled["breaker_options"].get(key)).stats() for key in keys
+        },
     }
 
+@app.get("/api/pool")
+async def pool_stats():
+    """Connection pool statistics (in use / idle / waiting) per upstream service."""
+    return {"services": upstream_clients.stats()}
+
+@app.get("/api/cache")
+async def cache_stats():
+    """Response cache counters: entries, bytes, hits / misses / evictions."""
+    return response_cache.stats()
+
+@app.delete("/api/cache")
+async def clear_cache():
+    response_cache.clear()
+    return {"status": "success"}
+
+@app.get("/api/singleflight")
+async def singleflight_stats():
+    """Identical in-flight requests sharing one upstream call."""
+    return single_flight.stats()
+
+@app.get("/api/limits")
+async def limit_stats():
+    """Per-service concurrency: active slots, queue depth, rejections and queue wait times."""
+    return {"services": concurrency_limiter.stats()}
+
+@app.get("/api/jobs")
+async def job_stats():
+    """Async job queue: queued and running jobs, workers and average run time."""
+    return {"options": config_store.current().compiled["job_options"], **job_queue.stats()}
+
+@app.get("/api/batches")
+async def batches_stats():
+    """Batch API runner: batches being drained by this process and result lines written."""
+    return {"options": config_store.current().compiled["batches_options"], **batch_runner.stats()}
+
+@app.get("/api/accesslog")
+async def access_log_stats():
+    """Access log writer: records written, dropped on a full queue and skipped by sampling."""
+    return {"options": config_store.current().compiled["access_log_options"], **access_log.stats()}
+
+@app.get("/api/keys")
+async def api_key_stats():
+    """Gateway API key usage: remaining bucket tokens, open streams, requests and rejections."""
+    return {"keys": api_key_limiter.stats()}
+
+_BREAKER_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+def _collect_runtime_metrics():
+    """Scrape-time view of state the scheduler, limiter, breakers, cache and pools already keep."""
+    limits = concurrency_limiter.stats()
+    tokens = token_scheduler.stats()
+    # Limiter slots cover services without accounts too; token leases only where limits are disabled
+    inflight = {key: sum(t["inflight"] for t in states) for key, states in tokens.items()}
+    inflight.update((key, item["active"]) for key, item in limits.items())
+    yield "gateway_upstream_inflight", "gauge", "In-flight upstream requests per service.", [
+        ("", render_labels(("service",), (key,)), value) for key, value in inflight.items()
+    ]
+    yield "gateway_token_selections_total", "counter", "Times each upstream account was selected.", [
+        ("", render_labels(("service", "token_id"), (key, t["token_id"])), t["requests"])
+        for key, states in tokens.items()
+        for t in states
+    ]
+    yield "gateway_queue_depth", "gauge", "Requests waiting for a concurrency slot.", [
+        ("", render_labels(("service",), (key,)), item["queue_depth"]) for key, item in limits.items()
+    ]
+    yield "gateway_queue_rejected_total", "counter", "Requests answered 429 by the concurrency limiter.", [
+        ("", render_labels(("service",), (key,)), item["rejected"] + item["timed_out"]) for key, item in limits.items()
+    ]
+    yield "gateway_breaker_state", "gauge", "Circuit state (0 closed, 1 half-open, 2 open).", [
+        ("", render_labels(("service",), (key,)), _BREAKER_STATE_VALUES.get(item["state"], 0))
+        for key, item in breakers.stats().items()
+    ]
+    yield "gateway_pool_connections", "gauge", "Upstream pool connections by state.", [
+        ("", render_labels(("service", "state"), (key, state)), item[state])
+        for key, item in upstream_clients.stats().items()
+        for state in ("in_use", "idle", "waiting")
+        if item[state] is not None
+    ]
+    cache = response_cache.stats()
+    yield "gateway_cache_events_total", "counter", "Response cache lookups and evictions.", [
+        ("", render_labels(("event",), (event,)), cache[event]) for event in ("hits", "misses", "bypassed", "evictions")
+    ]
+    yield "gateway_cache_bytes", "gauge", "Bytes held by the response cache.", [("", "", cache["bytes"])]
+    yield "gateway_coalesced_total", "counter", "Requests served by another identical in-flight request.", [
+        ("", "", single_flight.stats()["coalesced"])
+    ]
+    yield "gateway_client_disconnects_total", "counter", "Clients that disconnected before their response was complete.", [
+        ("", render_labels(("phase",), (phase,)), count) for phase, count in client_disconnects.stats().items()
+    ]
+    jobs = job_queue.stats()
+    yield "gateway_jobs", "gauge", "Async image/video jobs by state.", [
+        ("", render_labels(("state",), (state,)), jobs[state]) for state in ("queued", "running")
+    ]
+    yield "gateway_batch_lines_total", "counter", "Batch API input lines processed, by outcome.", [
+        ("", render_labels(("outcome",), (outcome,)), count) for outcome, count in batch_runner.stats()["lines"].items()
+    ]
+
+gateway_metrics.registry.add_collector(_collect_runtime_metrics)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition."""
+    return Response(content=gateway_metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/hedging")
+async def hedging_stats():
+    """First-byte samples and the current hedging threshold per service/model."""
+    return {"options": config_store.current().compiled["hedging_options"], "thresholds": first_byte_tracker.stats()}
+
+@app.get("/api/tokens")
+async def token_stats():
+    """Per-token scheduler state: in-flight, EWMA latency, failures and quarantine."""
+    return {"services": token_scheduler.stats()}
+
 @app.get("/api/yuanbao/login/qrcode")
 async def yuanbao_login_qrcode():
     """代理元宝服务的获取二维码接口"""
-    config = load_config()
+    config = current_config()
     if "yuanbao" not in config:
         raise HTTPException(status_code=404, detail="Yuanbao service not configured")
     
@@ -425,41 +862,278 @@ async def yuanbao_login_qrcode():
     # 这里直接使用 docker-compose 中的 service name
     target_url = "http://yuanbao-free-api:8003/login/qrcode"
     
-    async with httpx.AsyncClient() as client:
-        try:
-            resp = await client.get(target_url, timeout=10)
-            return resp.json()
-        except Exception as e:
-            logger.error(f"Proxy error: {e}")
-            raise HTTPException(status_code=502, detail="Failed to connect to Yuanbao service")
+    client = upstream_clients.get("yuanbao", config["yuanbao"])
+    try:
+        resp = await client.get(target_url, timeout=10)
+        return resp.json()
+    except Exception as e:
+        logger.error(f"Proxy error: {e}")
+        raise HTTPException(status_code=502, detail="Failed to connect to Yuanbao service")
 
 @app.get("/api/yuanbao/login/status")
 async def yuanbao_login_status(uuid: str):
     """代理元宝服务的检查状态接口"""
     target_url = f"http://yuanbao-free-api:8003/login/status?uuid={uuid}"
     
-    async with httpx.AsyncClient() as client:
+    client = upstream_clients.get("yuanbao")
+    try:
+        resp = await client.get(target_url, timeout=10)
+        return resp.json()
+    except Exception as e:
+        logger.error(f"Proxy error: {e}")
+        raise HTTPException(status_code=502, detail="Failed to connect to Yuanbao service")
+
+class UpstreamUnavailable(Exception):
+    """Every candidate upstream failed or had its circuit open; nothing was sent to the client yet."""
+
+    def __init__(self, message: str, retry_after: int = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _attempt_detail(target_key: str, target_service: Dict, target_url: str, headers: Dict, body: Dict) -> Dict:
+    """Debug access-log detail for one upstream attempt: token config shape, body summary, masked headers."""
+    token_config = target_service.get("token")
+    if isinstance(token_config, list):
+        token_meta = f"list(len={len(token_config)})"
+    elif isinstance(token_config, str):
+        token_meta = "string(set)" if token_config.strip() else "string(empty)"
+    elif token_config is None:
+        token_meta = "none"
+    else:
+        token_meta = type(token_config).__name__
+    messages = body.get("messages") if isinstance(body.get("messages"), list) else []
+    debug_headers = headers.copy()
+    if "Authorization" in debug_headers:
+        debug_headers["Authorization"] = debug_headers["Authorization"][:10] + "..."
+    return {
+        "service": target_key,
+        "url": target_url,
+        "token": token_meta,
+        "keys": sorted(k for k in body.keys() if isinstance(k, str)),
+        "stream": bool(body.get("stream")),
+        "max_tokens": body.get("max_tokens"),
+        "messages": len(messages),
+        "roles": [m.get("role") for m in messages[:6] if isinstance(m, dict) and m.get("role")],
+        "headers": debug_headers,
+    }
+
+def _prepare_chat_call(transform, target_key: str, target_service: Dict, lease, body: Dict):
+    """Build (url, headers, body) for one upstream attempt; `body` is a per-attempt copy and may be mutated."""
+    target_url = f"{target_service['url']}/v1/chat/completions"
+
+    # Per-service transforms (config.json "transforms", compiled at load): dropped / clamped fields,
+    # Yuanbao account fields injected into the body, Baidu cookie auth. Chat bodies only: image and
+    # video payloads are forwarded as the client sent them
+    account = lease.account if lease else None
+    transform.apply(body, account)
+    headers = transform.headers(account)
+
+    record = debug_record()
+    if record is not None:
+        record.attempts = (record.attempts or []) + [_attempt_detail(target_key, target_service, target_url, headers, body)]
+
+    return target_url, headers, body
+
+def _chat_candidates(snapshot, target_key: str, target_service: Dict, model: str):
+    """The routed service first, then equivalent (service, model) pairs from settings.json failover groups."""
+    candidates = [(target_key, target_service, model)]
+    for alt_key, alt_model in snapshot.compiled["failover"].alternatives(target_key, model):
+        alt_service = snapshot.services.get(alt_key)
+        if isinstance(alt_service, dict) and alt_key != "jimeng":
+            candidates.append((alt_key, alt_service, alt_model))
+    return candidates
+
+async def _open_chat_upstream(
+    snapshot,
+    candidates,
+    body: Dict,
+    priority: int = PRIORITY_DEFAULT,
+    leased: Optional[Dict[str, str]] = None,
+    avoid: Optional[Dict[str, str]] = None,
+):
+    """
+    Send the request to the first candidate whose circuit allows it, failing over on connection
+    errors, 5xx and concurrency backpressure until one answers. Only the response headers have been
+    read when this returns, so failover always happens before any byte reaches the client.
+    Returns (target_key, response, lease, ttfb); raises UpstreamUnavailable when nothing answered,
+    or LimitExceeded when every open candidate was saturated.
+    leased collects the token id taken per service; avoid skips those token ids (hedging).
+    """
+    last_error = None
+    limited = None
+    retry_after = 0
+    transforms = snapshot.compiled["transforms"]
+    for index, (key, service, upstream_model) in enumerate(candidates):
+        breaker = breakers.get(key, snapshot.compiled["breaker_options"].get(key))
+        if not breaker.allow():
+            logger.warning(f"Circuit open for {key}, skipping")
+            wait = breaker.retry_after()
+            retry_after = min(retry_after, wait) if retry_after else wait
+            continue
+
+        if index > 0:
+            logger.warning(f"Failing over {body.get('model')} to {key}/{upstream_model}")
+        try:
+            lease = await _acquire_token(snapshot, key, service, priority, (avoid or {}).get(key))
+        except LimitExceeded as e:
+            breaker.release()
+            logger.warning(f"{key} is saturated: {e.detail}")
+            limited = e
+            continue
+        if leased is not None and lease and lease.token_id is not None:
+            leased[key] = lease.token_id
+        # One compiled transform per attempt, so body and headers always come from the same config version
+        transform = transforms.get(key) or default_transform(key)
+        if isinstance(body, RawBody) and upstream_model == body.get("model") and transform.passthrough:
+            # Nothing to change: forward the client's bytes instead of re-serializing the parsed body
+            target_url = f"{service['url']}/v1/chat/completions"
+            headers = transform.headers(lease.account if lease else None)
+            record = debug_record()
+            if record is not None:
+                record.attempts = (record.attempts or []) + [_attempt_detail(key, service, target_url, headers, body)]
+            payload = {"content": body.raw}
+        else:
+            try:
+                attempt_body = dict(body.parsed() if isinstance(body, RawBody) else body)
+            except ValueError:
+                breaker.release()
+                if lease:
+                    lease.release()
+                raise HTTPException(status_code=400, detail="Invalid JSON body")
+            attempt_body["model"] = upstream_model
+            target_url, headers, attempt_body = _prepare_chat_call(transform, key, service, lease, attempt_body)
+            payload = {"json": attempt_body}
+
+        client = upstream_clients.get(key, service)
+        started = time.monotonic()
         try:
-            resp = await client.get(target_url, timeout=10)
-            return resp.json()
+            upstream_request = client.build_request(
+                "POST", target_url, headers=headers, timeout=CHAT_TIMEOUT, **payload
+            )
+            response = await client.send(upstream_request, stream=True)
+        except asyncio.CancelledError:
+            # Lost a hedge race (or the caller went away): not the token's or the upstream's fault
+            breaker.release()
+            if lease:
+                lease.release()
+            raise
         except Exception as e:
-            logger.error(f"Proxy error: {e}")
-            raise HTTPException(status_code=502, detail="Failed to connect to Yuanbao service")
+            breaker.record(False, time.monotonic() - started)
+            if lease:
+                lease.release(0)
+            logger.error(f"Proxy error ({key}): {e}")
+            last_error = f"{key}: {e}"
+            continue
+
+        ttfb = time.monotonic() - started
+        breaker.record(response.status_code < 500, ttfb)
+        if response.status_code >= 500 and index < len(candidates) - 1:
+            await response.aclose()
+            if lease:
+                lease.release(response.status_code, ttfb)
+            last_error = f"{key}: HTTP {response.status_code}"
+            continue
+        return key, response, lease, ttfb
+
+    if last_error is None and limited is not None:
+        raise limited
+    if last_error is None:
+        raise UpstreamUnavailable("All upstream circuits are open", retry_after=retry_after)
+    raise UpstreamUnavailable(str(last_error))
+
+async def _open_first_byte(
+    snapshot, candidates, body: Dict, priority: int, stream: bool, sample_key, leased=None, avoid=None
+):
+    """
+    _open_chat_upstream plus, for streams, the first body chunk, so "first byte" means the first token
+    rather than just headers. Returns (target_key, response, lease, ttfb, chunks) where chunks replays the
+    prefetched chunk (None for non-stream); the first-byte time is recorded for the hedging threshold.
+    """
+    started = time.monotonic()
+    key, response, lease, ttfb = await _open_chat_upstream(snapshot, candidates, body, priority, leased, avoid)
+    chunks = None
+    if stream and response.status_code < 400:
+        body_chunks = response.aiter_bytes()
+        try:
+            first = await body_chunks.__anext__()
+        except StopAsyncIteration:
+            first = b""
+        except BaseException as e:
+            await response.aclose()
+            if lease:
+                lease.release(None if isinstance(e, asyncio.CancelledError) else 0)
+            raise
+        chunks = prepend_chunk(first, body_chunks)
+    first_byte_tracker.record(*sample_key, time.monotonic() - started, snapshot.compiled["hedging_options"])
+    return key, response, lease, ttfb, chunks
+
+async def _discard_attempt(opened):
+    _, response, lease, _, _ = opened
+    await response.aclose()
+    if lease:
+        lease.release()
+
+def _hedge_plan(snapshot, target_key: str, model: str, stream: bool, candidates):
+    """(enabled, delay, hedge candidates) for this request; delay None means only sample first-byte times."""
+    options = snapshot.compiled["hedging_options"]
+    if not options.get("enabled") or not (stream or options.get("non_stream")):
+        return False, None, None
+    delay = first_byte_tracker.delay(target_key, model, options)
+    tokens = len(snapshot.compiled["accounts"].get(target_key) or [])
+    if tokens > 1:
+        # Same candidates: the hedge excludes the primary's token, so it runs on another account
+        return True, delay, candidates
+    if len(candidates) > 1:
+        return True, delay, candidates[1:] + candidates[:1]
+    return True, None, None
+
+def _model_health(service_key: str, breaker_states: Dict) -> Dict:
+    cached = health_monitor.cached(service_key) or {}
+    return {
+        "status": cached.get("status") or "unknown",
+        "latency_ms": cached.get("latency_ms"),
+        "breaker": (breaker_states.get(service_key) or {}).get("state", "closed"),
+    }
+
+@app.get("/v1/models")
+async def list_models(request: Request, health: bool = False):
+    """
+    Models from the compiled routing table, serialized once per config version; If-None-Match gets a
+    304. ?health=1 adds the cached probe status and breaker state of each model's service (not cached).
+    """
+    catalog = config_store.current().compiled["models"]
+    if health:
+        breaker_states = breakers.stats()
+        data = [{**entry, "health": _model_health(entry["owned_by"], breaker_states)} for entry in catalog.entries]
+        return JSONResponse({"object": "list", "data": data}, headers={"Cache-Control": "no-cache"})
+    headers = {"ETag": catalog.etag, "Cache-Control": "no-cache"}
+    if catalog.matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=catalog.body, media_type="application/json", headers=headers)
+
+@app.get("/v1/models/{model:path}")
+async def retrieve_model(model: str):
+    entry = config_store.current().compiled["models"].by_id.get(model)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Model {model} not found")
+    return entry
 
 @app.post("/v1/chat/completions")
 async def proxy_chat_completions(request: Request):
-    try:
-        body = await request.json()
-    except:
+    # Only model / stream are decoded here; the full body is parsed later only if something needs it
+    raw = await request.body()
+    fields = scan_fields(raw, ("model", "stream"))
+    if fields is None:
         raise HTTPException(status_code=400, detail="Invalid JSON body")
-        
+    body = RawBody(raw, fields)
+
     model = body.get("model")
-    if not model:
+    if not model or not isinstance(model, str):
         raise HTTPException(status_code=400, detail="Model is required")
 
-    config = load_config()
+    snapshot = config_store.current()
     
-    target_key, target_service = _select_service_for_model(config, model)
+    target_key, target_service = _route_model(snapshot, model)
     
     if not target_service:
          raise HTTPException(status_code=404, detail=f"No service found for model: {model}")
@@ -470,238 +1144,851 @@ async def proxy_chat_completions(request: Request):
             detail="Jimeng is an image/video service. Use /v1/images/generations or /v1/videos/generations.",
         )
 
-    target_url = f"{target_service['url']}/v1/chat/completions"
-        
-    token_config = target_service.get("token")
-    selected_account = None
-    if isinstance(token_config, list):
-        token_meta = f"list(len={len(token_config)})"
-    elif isinstance(token_config, str):
-        token_meta = "string(set)" if token_config.strip() else "string(empty)"
-    elif token_config is None:
-        token_meta = "none"
+    annotate(service=target_key, model=model)
+    stream = bool(body.get("stream"))
+    if stream:
+        _open_key_stream(request)
+
+    # Opt-in response cache for non-stream requests; "Cache-Control: no-cache" skips the lookup, "no-store" skips caching
+    entry_key = None
+    cache_status = None
+    ttl = None if stream else cache_ttl(snapshot.compiled["cache_policies"], target_key, model)
+    if ttl is not None:
+        cache_control = (request.headers.get("Cache-Control") or "").lower()
+        try:
+            # The cache key hashes the canonical body; the raw bytes are still what gets forwarded
+            entry_key = cache_key(target_key, body.parsed())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        if "no-cache" in cache_control or "no-store" in cache_control:
+            response_cache.bypassed += 1
+            cache_status = "BYPASS"
+            if "no-store" in cache_control:
+                entry_key = None
+        else:
+            cached = response_cache.get(entry_key)
+            if cached is not None:
+                content, media_type = cached
+                route = gateway_metrics.route(target_key, model)
+                route.bytes.inc(len(content))
+                route.finished(200, 0.0)
+                annotate(cache="HIT")
+                return Response(content=content, media_type=media_type, headers={"X-Gateway-Cache": "HIT"})
+            cache_status = "MISS"
+        annotate(cache=cache_status)
+
+    if _should_coalesce(snapshot, target_key, stream):
+        # Without a cache key, coalesce byte-identical bodies rather than parsing just to hash them.
+        # The cache key ignores stream_options, which still changes the payload (include_usage)
+        if entry_key:
+            flight_key = f"{entry_key}:{json.dumps(body.parsed().get('stream_options'), sort_keys=True)}"
+        else:
+            flight_key = raw_key(target_key, body.raw)
+        produce = single_flight.run(
+            f"{'stream' if stream else 'json'}:{flight_key}",
+            lambda: _forward_chat(snapshot, target_key, target_service, model, body, stream, entry_key, cache_status, ttl),
+            _disconnected(request),
+            _coalesce_buffer(snapshot, target_key),
+        )
     else:
-        token_meta = type(token_config).__name__
-    logger.info(f"Token config for {target_key}: {token_meta}")
+        produce = _forward_chat(
+            snapshot, target_key, target_service, model, body, stream, entry_key, cache_status, ttl, _disconnected(request)
+        )
+    if stream:
+        return await _heartbeat_response(
+            produce, heartbeat_interval(snapshot.compiled["heartbeat_options"].get(target_key))
+        )
+    return await produce
 
-    # Support token rotation if it's a list
-    if isinstance(token_config, list) and len(token_config) > 0:
-        selected_account = random.choice(token_config)
-    elif isinstance(token_config, str) and token_config.strip():
-        # Single string token (non-empty)
-        selected_account = token_config
-    else:
-        # Empty string, None, or empty list
-        selected_account = None
+def _should_coalesce(snapshot, target_key: str, stream: bool) -> bool:
+    options = snapshot.compiled["singleflight_options"].get(target_key) or {}
+    return bool(options.get("stream") if stream else options.get("enabled"))
 
-    final_token = None
-    
-    if selected_account:
-        if isinstance(selected_account, dict):
-            # Yuanbao-style account object
-            # Extract the auth token (usually hy_token for Yuanbao)
-            final_token = selected_account.get("hy_token") or selected_account.get("token")
-            
-            # Inject other fields (hy_user, agent_id) into request body
-            # This ensures the proxy receives the matching user/agent for the token
-            for k, v in selected_account.items():
-                if k not in ["token", "hy_token"]:
-                    body[k] = v
-        else:
-            final_token = selected_account
-    
-    logger.info(f"Routing request for model {model} to {target_key} ({target_url})")
-
-    if target_key == "qwen":
-        if isinstance(body.get("max_tokens"), int) and body.get("max_tokens", 0) <= 0:
-            body.pop("max_tokens", None)
-        if isinstance(body.get("max_completion_tokens"), int) and body.get("max_completion_tokens", 0) <= 0:
-            body.pop("max_completion_tokens", None)
-        for k in [
-            "stream_options",
-            "response_format",
-            "tools",
-            "tool_choice",
-            "functions",
-            "function_call",
-        ]:
-            body.pop(k, None)
+def _coalesce_buffer(snapshot, target_key: str) -> int:
+    options = snapshot.compiled["singleflight_options"].get(target_key) or {}
+    try:
+        return max(0, int(float(options.get("max_buffer_kb", 1024)) * 1024))
+    except (TypeError, ValueError):
+        return 1024 * 1024
 
+@app.post("/v1/chat/completions/batch")
+async def batch_chat_completions(request: Request, concurrency: Optional[int] = None):
+    """
+    Run an array of chat requests (or {"requests": [...], "concurrency": n}) through the normal routing,
+    token selection and cache, at most `concurrency` at a time. Results stream back as JSONL in
+    completion order, one {"index", "status_code", "body" | "error"} line per request.
+    """
     try:
-        message_count = len(body.get("messages") or [])
-        roles = []
-        for m in (body.get("messages") or [])[:6]:
-            if isinstance(m, dict) and m.get("role"):
-                roles.append(m.get("role"))
-        logger.info(
-            "Request body meta: "
-            f"keys={sorted([k for k in body.keys() if isinstance(k, str)])} "
-            f"stream={bool(body.get('stream'))} "
-            f"max_tokens={body.get('max_tokens')} "
-            f"messages={message_count} "
-            f"roles={roles}"
-        )
+        payload = await request.json()
     except Exception:
-        pass
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    options = config_store.current().compiled["batch_options"]
+    if not options.get("enabled", True):
+        raise HTTPException(status_code=404, detail="Batch requests are disabled")
+
+    items = payload.get("requests") if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="Expected a non-empty array of chat requests")
+    if len(items) > int(options["max_requests"]):
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {options['max_requests']} requests")
+    if concurrency is None and isinstance(payload, dict):
+        concurrency = payload.get("concurrency")
+    spec = getattr(request.state, "api_key", None)
 
-    # 构建 Header
-    # 只保留 Content-Type，其他 header 一律不转发，防止污染 upstream 请求
-    headers = {
-        "Content-Type": "application/json",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
-    }
-    
-    # 注入 Token
-    if final_token:
-        # 如果是 Baidu 且 token 是 JSON，或者看起来像 Cookie 字符串，直接传
-        # 其他通常也是 Bearer Token
-        # 为了兼容 Baidu 服务端的 load_cookies 逻辑 (JSON or Cookie String)
-        if target_key == "baidu" and (final_token.strip().startswith("{") or "BDUSS" in final_token):
-            headers["Authorization"] = final_token
-        else:
-            headers["Authorization"] = f"Bearer {final_token}"
-    else:
-        logger.warning(f"No token configured for service {target_key}. Request sent without Authorization header.")
-    
-    # 打印请求头用于调试（脱敏）
-    debug_headers = headers.copy()
-    if "Authorization" in debug_headers:
-        debug_headers["Authorization"] = debug_headers["Authorization"][:10] + "..."
-    logger.info(f"Request Headers: {debug_headers}")
-    
-    stream = bool(body.get("stream"))
+    return StreamingResponse(
+        fan_out(items, batch_concurrency(options, concurrency), lambda index, item: _batch_item(index, item, spec)),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    async def proxy_stream_sse():
-        client = httpx.AsyncClient()
+async def _batch_item(index: int, item, spec: Optional[Dict]) -> Dict:
+    """One batch entry as a non-stream chat call; backpressure (key rpm, concurrency queue) is waited out."""
+    if not isinstance(item, dict):
+        return batch_line(index, 400, error="Request must be a JSON object")
+    model = item.get("model")
+    if not model or not isinstance(model, str):
+        return batch_line(index, 400, error="Model is required")
+    snapshot = config_store.current()
+    target_key, target_service = _route_model(snapshot, model)
+    if not target_service:
+        return batch_line(index, 404, error=f"No service found for model: {model}")
+    if target_key == "jimeng":
+        return batch_line(index, 400, error="Jimeng is an image/video service")
+    body = item if not item.get("stream") else {**item, "stream": False}
+
+    # Every entry counts against the caller's gateway key like a separate request would
+    while spec is not None:
         try:
-            async with client.stream("POST", target_url, json=body, headers=headers, timeout=120.0) as response:
-                # Forward status code if error
-                logger.info(f"Response Status: {response.status_code}")
-                
-                content_type = response.headers.get("Content-Type", "")
-                
-                # Check for upstream errors (Status >= 400 OR JSON response when expecting stream)
-                # Many free-api wrappers return 200 OK with JSON body for errors
-                if response.status_code >= 400 or "application/json" in content_type:
-                    # We need to read the body to check if it's an error
-                    # CAUTION: If it's a legitimate large JSON response (non-stream), reading it all might be slow, but usually fine for chat.
-                    content = await response.aread()
-                    text_content = content.decode('utf-8', errors='replace')
-                    
-                    is_error = False
-                    if response.status_code >= 400:
-                        is_error = True
-                    else:
-                        # Check if body contains "error" field
-                        try:
-                            json_body = json.loads(text_content)
-                            if "error" in json_body or "code" in json_body and json_body.get("code") != 0:
-                                # Loose check for error-like structure
-                                # Standard OpenAI error is {"error": {...}}
-                                if "error" in json_body:
-                                    is_error = True
-                        except:
-                            pass
-                            
-                    if is_error:
-                        logger.error(f"Upstream Error: {text_content}")
-                        yield f"data: {json.dumps({'error': f'Upstream error {response.status_code}: {text_content}'})}\n\n"
-                        return
-                    else:
-                        # It's a valid JSON response (maybe non-stream was requested or forced)
-                        # Yield it as a single chunk if possible, or just write it
-                        # Since we are in an async generator yielding bytes or strings...
-                        # If we yield bytes, FastAPI handles it.
-                        yield f"data: {text_content}\n\n"
-                        return
+            await api_key_limiter.admit(spec)
+            break
+        except KeyRejected as e:
+            await asyncio.sleep(max(1, e.retry_after))
+
+    entry_key = None
+    ttl = cache_ttl(snapshot.compiled["cache_policies"], target_key, model)
+    if ttl is not None:
+        entry_key = cache_key(target_key, body)
+        cached = response_cache.get(entry_key)
+        if cached is not None:
+            gateway_metrics.route(target_key, model).finished(200, 0.0)
+            return batch_line(index, 200, _decode_body(cached[0]))
+
+    while True:
+        try:
+            response = await _forward_chat(
+                snapshot, target_key, target_service, model, body, False, entry_key, "MISS" if entry_key else None, ttl,
+                priority=PRIORITY_BATCH,
+            )
+            break
+        except LimitExceeded as e:
+            await asyncio.sleep(e.retry_after)
+        except HTTPException as e:
+            return batch_line(index, e.status_code, error=str(e.detail))
 
-                async for line in response.aiter_lines():
-                    if not line:
-                        continue
-                    # Ensure we forward SSE lines correctly
-                    # Some upstream services might return raw JSON in chunks without "data: " prefix if not strict SSE
-                    # But DoubaoFreeApi should be returning standard SSE.
-                    
-                    if line.startswith("data:") or line.startswith("event:") or line.startswith(":"):
-                        yield f"{line}\n\n"
-                    elif line.strip() == "[DONE]":
-                        yield "data: [DONE]\n\n"
-                    else:
-                        # Fallback: wrap raw content in data
-                        # Only if it looks like content
-                        if line.strip():
-                             # CAUTION: If the upstream sends partial JSON or raw text, we might be breaking it by wrapping in data:
-                             # But for standard SSE, newlines should be handled.
-                             # If line is just "}", it might be part of a previous JSON.
-                             # But aiter_lines() splits by newline.
-                             yield f"data: {line}\n\n"
-                             
+    chunks = []
+    try:
+        async for chunk in response.body_iterator:
+            chunks.append(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8"))
+    finally:
+        if response.background is not None:
+            await response.background()
+    return batch_line(index, response.status_code, _decode_body(b"".join(chunks)))
+
+def _decode_body(content: bytes):
+    try:
+        return json.loads(content)
+    except ValueError:
+        return content.decode("utf-8", errors="replace")
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no", # Critical for Nginx/Baota
+    "Content-Type": "text/event-stream",
+    # Add CORS headers specifically for the stream response just in case
+    "Access-Control-Allow-Origin": "*",
+}
+
+async def _heartbeat_response(produce: Awaitable[Response], interval: float) -> Response:
+    """
+    Await a streaming chat response; if it is not ready within `interval` (failover, hedging, a slow
+    first byte), start the SSE stream now with ": ping" comments and splice the response in once it
+    arrives. Errors that can no longer change the status code are sent as an SSE error event.
+    """
+    task = asyncio.ensure_future(produce)
+    if interval <= 0:
+        return await task
+    try:
+        done, _ = await asyncio.wait({task}, timeout=interval)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if done:
+        return task.result()
+
+    async def events():
+        response = None
+        try:
+            yield PING
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=interval)
+                if done:
+                    break
+                yield PING
+            try:
+                response = task.result()
+            except HTTPException as e:
+                yield f"data: {json.dumps({'error': e.detail}, ensure_ascii=False)}\n\n"
+                return
+            except Exception as e:
+                logger.error(f"Proxy error: {e}")
+                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                return
+            if isinstance(response, StreamingResponse):
+                async for chunk in response.body_iterator:
+                    yield chunk
+            else:
+                yield f"data: {response.body.decode('utf-8', errors='replace')}\n\n"
+        finally:
+            if not task.done():
+                task.cancel()
+            elif response is not None:
+                body_iterator = getattr(response, "body_iterator", None)
+                if body_iterator is not None and hasattr(body_iterator, "aclose"):
+                    await body_iterator.aclose()
+                if response.background is not None:
+                    await response.background()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+async def _forward_chat(
+    snapshot,
+    target_key: str,
+    target_service: Dict,
+    model: str,
+    body: Dict,
+    stream: bool,
+    entry_key: Optional[str] = None,
+    cache_status: Optional[str] = None,
+    ttl: Optional[float] = None,
+    disconnected: Optional[asyncio.Event] = None,
+    priority: Optional[int] = None,
+):
+    """
+    Open the upstream (with failover) and build the client response; entry_key/ttl enable caching the result.
+    The upstream attempt is cancelled if `disconnected` is set before its response headers arrive.
+    """
+    started = time.monotonic()
+    candidates = _chat_candidates(snapshot, target_key, target_service, model)
+
+    if priority is None:
+        priority = PRIORITY_INTERACTIVE if stream else PRIORITY_DEFAULT
+    hedging, hedge_delay, hedge_candidates = _hedge_plan(snapshot, target_key, model, stream, candidates)
+    requested_key = target_key
+
+    async def open_upstream():
+        if not hedging:
+            key, response, lease, ttfb = await _open_chat_upstream(snapshot, candidates, body, priority)
+            return (key, response, lease, ttfb, None), False
+        if hedge_delay is None:
+            opened = await _open_first_byte(snapshot, candidates, body, priority, stream, (requested_key, model))
+            return opened, False
+        # The hedge leases a different account than the one the primary is waiting on
+        primary_tokens: Dict[str, str] = {}
+        return await race(
+            lambda: _open_first_byte(
+                snapshot, candidates, body, priority, stream, (requested_key, model), leased=primary_tokens
+            ),
+            lambda: _open_first_byte(
+                snapshot, hedge_candidates, body, priority, stream, (requested_key, model), avoid=primary_tokens
+            ),
+            hedge_delay,
+            _discard_attempt,
+            on_hedge=lambda: gateway_metrics.hedges.labels(requested_key, "launched").inc(),
+        )
+
+    try:
+        (target_key, response, lease, ttfb, chunks), hedge_won = await cancel_on_disconnect(
+            disconnected, open_upstream(), lambda result: _discard_attempt(result[0])
+        )
+        if hedge_won:
+            gateway_metrics.hedges.labels(requested_key, "won").inc()
+            annotate(hedged=True)
+    except (ClientDisconnect, asyncio.CancelledError) as e:
+        # The client (or, for a coalesced call, every client) left before the upstream answered
+        gateway_metrics.route(target_key, model).finished(CLIENT_CLOSED_REQUEST, time.monotonic() - started)
+        if isinstance(e, ClientDisconnect):
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+        raise
+    except LimitExceeded:
+        gateway_metrics.route(target_key, model).finished(429, time.monotonic() - started)
+        raise
+    except UpstreamUnavailable as e:
+        gateway_metrics.route(target_key, model).finished(503 if e.retry_after else 502, time.monotonic() - started)
+        if e.retry_after:
+            raise HTTPException(
+                status_code=503,
+                detail=f"Service unavailable for model {model}: {e}",
+                headers={"Retry-After": str(e.retry_after)},
+            )
+        if not stream:
+            raise HTTPException(status_code=502, detail=f"Upstream error: {e}")
+
+        async def upstream_error_sse():
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+        return StreamingResponse(upstream_error_sse(), media_type="text/event-stream")
+
+    upstream_model = next((m for k, _, m in candidates if k == target_key), model)
+    route = gateway_metrics.route(target_key, upstream_model)
+    route.ttfb.observe(ttfb)
+    annotate(service=target_key, upstream_model=upstream_model, ttfb=ttfb)
+
+    def release_token(status_code=None, latency=None):
+        if lease:
+            lease.release(status_code, latency)
+
+    async def proxy_stream_sse():
+        body_started = time.monotonic()
+        sent = 0
+        status = response.status_code
+        try:
+            content_type = response.headers.get("Content-Type", "")
+
+            # Check for upstream errors (Status >= 400 OR JSON response when expecting stream)
+            # Many free-api wrappers return 200 OK with JSON body for errors
+            if response.status_code >= 400 or "application/json" in content_type:
+                # We need to read the body to check if it's an error
+                # CAUTION: If it's a legitimate large JSON response (non-stream), reading it all might be slow, but usually fine for chat.
+                content = await response.aread() if chunks is None else b"".join([c async for c in chunks])
+                text_content = content.decode('utf-8', errors='replace')
+
+                is_error = False
+                if response.status_code >= 400:
+                    is_error = True
+                else:
+                    # Check if body contains "error" field
+                    try:
+                        json_body = json.loads(text_content)
+                        if "error" in json_body or "code" in json_body and json_body.get("code") != 0:
+                            # Loose check for error-like structure
+                            # Standard OpenAI error is {"error": {...}}
+                            if "error" in json_body:
+                                is_error = True
+                    except:
+                        pass
+
+                if is_error:
+                    status = response.status_code if response.status_code >= 400 else 502
+                    logger.error(f"Upstream Error: {text_content}")
+                    release_token(response.status_code if response.status_code >= 400 else 502, ttfb)
+                    yield f"data: {json.dumps({'error': f'Upstream error {response.status_code}: {text_content}'})}\n\n"
+                    return
+                else:
+                    # It's a valid JSON response (maybe non-stream was requested or forced)
+                    # Yield it as a single chunk if possible, or just write it
+                    # Since we are in an async generator yielding bytes or strings...
+                    # If we yield bytes, FastAPI handles it.
+                    release_token(response.status_code, ttfb)
+                    yield f"data: {text_content}\n\n"
+                    return
+
+            # Well-formed SSE upstreams are forwarded byte-for-byte; "sse": "rewrite" keeps the line-rewriting path
+            if (snapshot.services.get(target_key) or {}).get("sse") == SSE_REWRITE:
+                events = rewrite_sse_lines(response.aiter_lines() if chunks is None else iter_text_lines(chunks))
+            else:
+                events = passthrough_sse(response.aiter_bytes() if chunks is None else chunks, label=target_key)
+            # Reasoning models can stay silent for minutes after the headers: keep idle-timeout proxies from hanging up
+            events = heartbeat(events, heartbeat_interval(snapshot.compiled["heartbeat_options"].get(target_key)))
+            async for event in events:
+                # Count upstream payload bytes only: rewritten events are str and keep-alive pings aren't data
+                if event is not PING:
+                    sent += len(event.encode() if isinstance(event, str) else event)
+                yield event
+
+            release_token(response.status_code, ttfb)
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client went away: Starlette stops iterating and the upstream stream is closed below
+            status = CLIENT_CLOSED_REQUEST
+            raise
         except Exception as e:
             logger.error(f"Proxy error: {e}")
+            status = 0
+            release_token(0)
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
         finally:
-            await client.aclose()
+            # Client went away mid-stream: free the slot without judging the token
+            release_token()
+            await response.aclose()
+            body_time = time.monotonic() - body_started
+            route.bytes.inc(sent)
+            route.stream_duration.observe(body_time)
+            route.finished(status, ttfb + body_time)
 
     if not stream:
-        async with httpx.AsyncClient() as non_stream_client:
-            response = await non_stream_client.post(target_url, json=body, headers=headers, timeout=120.0)
-            media_type = response.headers.get("Content-Type") or "application/json"
-            return Response(content=response.content, status_code=response.status_code, media_type=media_type)
+        on_complete = None
+        # A failover answer comes from another service / model: don't store it under the requested one's key
+        served_as_requested = target_key == requested_key and upstream_model == model
+        if entry_key is not None and response.status_code == 200 and served_as_requested:
+            def on_complete(content: bytes, media_type: str):
+                # Free-api wrappers report some errors as 200 + {"error": ...}; never cache those
+                try:
+                    if "error" in json.loads(content):
+                        return
+                except Exception:
+                    return
+                response_cache.put(entry_key, content, media_type, ttl)
+
+        return _relay_response(
+            response,
+            lease,
+            ttfb,
+            headers={"X-Gateway-Cache": cache_status} if cache_status else None,
+            capture=int(response_cache.options["max_entry_bytes"]) if on_complete else None,
+            on_complete=on_complete,
+            route=route,
+        )
 
     return StreamingResponse(
         proxy_stream_sse(),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no", # Critical for Nginx/Baota
-            "Content-Type": "text/event-stream",
-            # Add CORS headers specifically for the stream response just in case
-            "Access-Control-Allow-Origin": "*",
-        },
+        headers=SSE_HEADERS,
+        # Runs even if the generator never started (client left before the first chunk)
+        background=BackgroundTask(response.aclose),
     )
 
 def _build_upstream_headers(
+    snapshot, target_key: str, selected_account, *, content_type: str = "application/json"
+):
+    """Headers (auth, extra headers) for one upstream call from the service's transform in `snapshot`."""
+    transform = snapshot.compiled["transforms"].get(target_key) or default_transform(target_key)
+    return transform.headers(selected_account, content_type)
+
+class UploadTooLarge(Exception):
+    pass
+
+def _upload_limit(request: Request, service: Dict) -> Optional[int]:
+    """Per-service upload cap in bytes ("max_upload_mb"); a declared Content-Length over it is rejected up front."""
+    try:
+        limit = int(float(service.get("max_upload_mb") or 0) * 1024 * 1024)
+    except (TypeError, ValueError):
+        limit = 0
+    if limit <= 0:
+        return None
+    declared = request.headers.get("Content-Length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {service.get('max_upload_mb')} MB limit")
+    return limit
+
+async def _stream_upload(request: Request, limit: Optional[int]):
+    """Forward the client's request body chunk by chunk instead of buffering the whole upload."""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if limit is not None and received > limit:
+            raise UploadTooLarge(received)
+        yield chunk
+
+async def _send_upstream(
+    client: httpx.AsyncClient, lease, url: str, headers: Dict, *, timeout, route=None, disconnected=None, **kwargs
+):
+    """
+    POST upstream and return (response, ttfb) once the response headers arrive;
+    the body is left for _relay_response. The call is cancelled if `disconnected` is set first.
+    """
+    started = time.monotonic()
+    try:
+        upstream_request = client.build_request("POST", url, headers=headers, timeout=timeout, **kwargs)
+        response = await cancel_on_disconnect(
+            disconnected, client.send(upstream_request, stream=True), lambda response: response.aclose()
+        )
+    except (UploadTooLarge, ClientDisconnect, asyncio.CancelledError) as e:
+        # The client side failed, not the upstream token
+        if lease:
+            lease.release()
+        if route is not None:
+            status = 413 if isinstance(e, UploadTooLarge) else CLIENT_CLOSED_REQUEST
+            route.finished(status, time.monotonic() - started)
+        if isinstance(e, UploadTooLarge):
+            raise HTTPException(status_code=413, detail="Upload too large")
+        if isinstance(e, ClientDisconnect):
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+        raise
+    except Exception:
+        if lease:
+            lease.release(0)
+        if route is not None:
+            route.finished(0, time.monotonic() - started)
+        raise
+    ttfb = time.monotonic() - started
+    if route is not None:
+        route.ttfb.observe(ttfb)
+    annotate(ttfb=ttfb)
+    return response, ttfb
+
+def _relay_response(
+    response: httpx.Response,
+    lease=None,
+    latency: Optional[float] = None,
+    *,
+    headers: Optional[Dict] = None,
+    capture: Optional[int] = None,
+    on_complete=None,
+    route=None,
+) -> StreamingResponse:
+    """
+    Stream an upstream response to the client in STREAM_CHUNK_SIZE pieces, keeping its status code
+    and content type, so gateway memory per request stays bounded whatever the body size.
+    With capture set, bodies up to that many bytes are also handed to on_complete(content, media_type)
+    once fully delivered. route (RouteMetrics) records bytes, body duration and the final status.
+    """
+    status_code = response.status_code
+    media_type = response.headers.get("Content-Type") or "application/json"
+    started = time.monotonic()
+    outcome = {"status": status_code, "bytes": 0, "recorded": False}
+
+    async def finish():
+        await response.aclose()
+        if lease:
+            status = outcome["status"]
+            lease.release(None if status == CLIENT_CLOSED_REQUEST else status, latency)
+        if route is not None and not outcome["recorded"]:
+            outcome["recorded"] = True
+            body_time = time.monotonic() - started
+            route.bytes.inc(outcome["bytes"])
+            route.stream_duration.observe(body_time)
+            route.finished(outcome["status"], (latency or 0.0) + body_time)
+
+    async def relay_body():
+        captured = [] if capture is not None else None
+        size = 0
+        sent = 0
+        try:
+            async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                sent += len(chunk)
+                if captured is not None:
+                    size += len(chunk)
+                    if size > capture:
+                        captured = None
+                    else:
+                        captured.append(chunk)
+                yield chunk
+            if captured is not None:
+                on_complete(b"".join(captured), media_type)
+        except (asyncio.CancelledError, GeneratorExit):
+            outcome["status"] = CLIENT_CLOSED_REQUEST
+            raise
+        except Exception as e:
+            # Headers are already sent; aborting is the only honest signal left for the client
+            logger.error(f"Upstream body error after headers: {e}")
+            outcome["status"] = 0
+            raise
+        finally:
+            outcome["bytes"] = sent
+            await finish()
+
+    return StreamingResponse(
+        relay_body(),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+        # Runs even if the client left before the body started
+        background=BackgroundTask(finish),
+    )
+
+# 图片 / 视频异步任务：提交后立即返回任务 ID，由后台固定数量的 worker 调用上游，任务状态保存在 SQLite 中，重启后继续执行
+JOBS_DB_FILE = os.path.join(BASE_DIR, "jobs.db")
+JOB_UPLOAD_DIR = os.path.join(BASE_DIR, "job_uploads")
+
+def _wants_async(request: Request) -> bool:
+    """?async=1 or "Prefer: respond-async" asks for a job instead of waiting on the upstream."""
+    if not config_store.current().compiled["job_options"].get("enabled", True):
+        return False
+    if request.query_params.get("async", "").lower() in ("1", "true", "yes"):
+        return True
+    return "respond-async" in (request.headers.get("Prefer") or "").lower()
+
+async def _spool_upload(request: Request, limit: Optional[int]) -> str:
+    """Write a multipart body to JOB_UPLOAD_DIR so the job can be replayed after the request has gone."""
+    os.makedirs(JOB_UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(JOB_UPLOAD_DIR, f"{os.urandom(16).hex()}.body")
+    try:
+        with open(path, "wb") as f:
+            async for chunk in _stream_upload(request, limit):
+                await asyncio.to_thread(f.write, chunk)
+    except UploadTooLarge:
+        os.remove(path)
+        raise HTTPException(status_code=413, detail="Upload too large")
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+async def _read_spool(path: str):
+    with open(path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+async def _submit_job(
+    request: Request,
+    kind: str,
     target_key: str,
     target_service: Dict,
-    body: Optional[Dict] = None,
-    *,
-    content_type: str = "application/json",
+    model: Optional[str],
+    body_json=None,
+    content_type: Optional[str] = None,
 ):
-    token_config = (target_service or {}).get("token")
+    body_file = None
+    if body_json is None:
+        body_file = await _spool_upload(request, _upload_limit(request, target_service))
+    spec = getattr(request.state, "api_key", None)
+    try:
+        job = await job_queue.submit(
+            kind,
+            target_key,
+            model,
+            owner=spec["id"] if spec else None,
+            request=body_json,
+            body_file=body_file,
+            content_type=content_type or "application/json",
+        )
+    except JobFull as e:
+        if body_file:
+            os.remove(body_file)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    logger.info(f"Queued {kind} job {job['id']} model={model or '-'} for {target_key}")
+    return JSONResponse(
+        job_view(job, await job_queue.progress(job)),
+        status_code=202,
+        headers={"Location": f"/v1/jobs/{job['id']}"},
+    )
 
-    selected_account = None
-    if isinstance(token_config, list) and len(token_config) > 0:
-        selected_account = random.choice(token_config)
-    elif isinstance(token_config, str) and token_config.strip():
-        selected_account = token_config
+async def _execute_job(job: Dict):
+    """Worker side of a job: same upstream call as the synchronous handler, body read in full and stored."""
+    while True:
+        snapshot = config_store.current()
+        target_service = snapshot.services.get(job["service"])
+        if not target_service:
+            raise RuntimeError(f"Service {job['service']} is no longer configured")
+        try:
+            lease = await _acquire_token(snapshot, job["service"], target_service, PRIORITY_BATCH)
+            break
+        except LimitExceeded as e:
+            # Jobs are not in a hurry: wait out the backpressure instead of failing
+            await asyncio.sleep(e.retry_after)
+
+    body_json = json.loads(job["request"]) if job["request"] is not None else None
+    headers = _build_upstream_headers(snapshot, job["service"], lease.account if lease else None, content_type=job["content_type"])
+    target_url = f"{target_service['url']}/v1/{job['kind']}"
+    client = upstream_clients.get(job["service"], target_service)
+    route = gateway_metrics.route(job["service"], job["model"])
+    if body_json is not None:
+        kwargs = {"json": body_json}
+    else:
+        headers["Content-Length"] = str(os.path.getsize(job["body_file"]))
+        kwargs = {"content": _read_spool(job["body_file"])}
+    logger.info(f"Running {job['kind']} job {job['id']} on {job['service']} ({target_url})")
 
-    final_token = None
-    if selected_account:
-        if isinstance(selected_account, dict):
-            final_token = selected_account.get("hy_token") or selected_account.get("token")
-            if isinstance(body, dict):
-                for k, v in selected_account.items():
-                    if k not in ["token", "hy_token"]:
-                        body[k] = v
-        else:
-            final_token = selected_account
+    response, ttfb = await _send_upstream(client, lease, target_url, headers, timeout=1800.0, route=route, **kwargs)
+    started = time.monotonic()
+    status = response.status_code
+    content = b""
+    try:
+        content = await response.aread()
+    except BaseException:
+        status = 0
+        raise
+    finally:
+        await response.aclose()
+        if lease:
+            lease.release(status, ttfb)
+        route.bytes.inc(len(content))
+        route.finished(status, ttfb + time.monotonic() - started)
+    return status, response.headers.get("Content-Type") or "application/json", content
+
+job_queue = JobQueue(JobStore(JOBS_DB_FILE), _execute_job, lambda: config_store.current().compiled["job_options"])
+
+async def _owned_job(request: Request, job_id: str) -> Dict:
+    job = await job_queue.get(job_id)
+    spec = getattr(request.state, "api_key", None)
+    if job is None or (job["owner"] and (spec is None or spec["id"] != job["owner"])):
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+@app.get("/v1/jobs/{job_id}")
+async def get_job(request: Request, job_id: str):
+    """Job status; finished jobs carry the upstream status code and response body."""
+    job = await _owned_job(request, job_id)
+    return job_view(job, await job_queue.progress(job))
+
+@app.get("/v1/jobs/{job_id}/events")
+async def job_events(request: Request, job_id: str):
+    """SSE progress stream: one "job" event per change (and every few seconds) until the job finishes."""
+    await _owned_job(request, job_id)
+
+    async def events():
+        async for job in job_queue.watch(job_id):
+            data = json.dumps(job_view(job, await job_queue.progress(job)), ensure_ascii=False)
+            yield f"event: job\ndata: {data}\n\n".encode("utf-8")
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# OpenAI Batch API：JSONL 输入文件保存在本地磁盘，后台按 settings.json 的 batches.rpm 逐行调用对话接口，
+# 每完成一行记录一次进度，网关重启后从断点继续；结果与错误文件通过 /v1/files/{id}/content 下载
+BATCHES_DB_FILE = os.path.join(BASE_DIR, "batches.db")
+BATCH_FILES_DIR = os.path.join(BASE_DIR, "batch_files")
+
+async def _execute_batch_request(owner: Optional[str], body: Dict):
+    """
+    One Batch API line through the same path as a /v1/chat/completions/batch entry, counted against
+    the rpm of the gateway key that created the batch.
+    """
+    spec = None
+    keys, _ = _api_keys()
+    if owner is not None and keys:
+        spec = next((spec for spec in keys.values() if spec["id"] == owner), None)
+        if spec is None:
+            return 401, {"error": {"message": "The API key that created this batch is no longer configured"}}
+    line = await _batch_item(0, body, spec)
+    return line["status_code"], line["body"] if "body" in line else {"error": line["error"]}
+
+batch_runner = BatchRunner(
+    BatchStore(BATCHES_DB_FILE),
+    BATCH_FILES_DIR,
+    _execute_batch_request,
+    lambda: config_store.current().compiled["batches_options"],
+)
+
+def _batches_enabled() -> Dict:
+    options = config_store.current().compiled["batches_options"]
+    if not options.get("enabled", True):
+        raise HTTPException(status_code=404, detail="Batch API is disabled")
+    return options
+
+def _request_owner(request: Request) -> Optional[str]:
+    spec = getattr(request.state, "api_key", None)
+    return spec["id"] if spec is not None else None
+
+async def _owned_file(request: Request, file_id: str) -> Dict:
+    row = await batch_runner.get_file(file_id)
+    if row is None or (row["owner"] and row["owner"] != _request_owner(request)):
+        raise HTTPException(status_code=404, detail=f"File {file_id} not found")
+    return row
+
+async def _owned_batch(request: Request, batch_id: str) -> Dict:
+    batch = await batch_runner.get(batch_id)
+    if batch is None or (batch["owner"] and batch["owner"] != _request_owner(request)):
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    return batch
+
+@app.post("/v1/files")
+async def upload_file(request: Request):
+    """Multipart upload (fields "file" and "purpose"); only purpose=batch JSONL files are accepted."""
+    options = _batches_enabled()
+    limit = int(float(options["max_file_mb"]) * 1024 * 1024)
+    length = request.headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > limit + 64 * 1024:
+        raise HTTPException(status_code=413, detail=f"File exceeds {options['max_file_mb']} MB")
+    try:
+        form = await request.form()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+    try:
+        purpose = form.get("purpose")
+        upload = form.get("file")
+        if purpose != PURPOSE_BATCH:
+            raise HTTPException(status_code=400, detail='Only purpose "batch" is supported')
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Missing file")
+        try:
+            row = await batch_runner.save_file(_request_owner(request), purpose, upload.filename, upload, limit)
+        except FileTooLarge:
+            raise HTTPException(status_code=413, detail=f"File exceeds {options['max_file_mb']} MB")
+    finally:
+        await form.close()
+    return file_view(row)
+
+@app.get("/v1/files")
+async def list_files(request: Request, purpose: Optional[str] = None, limit: int = 100):
+    limit = max(1, min(limit, 10000))
+    rows = await batch_runner.list_files(_request_owner(request), purpose, limit + 1)
+    return {"object": "list", "data": [file_view(row) for row in rows[:limit]], "has_more": len(rows) > limit}
+
+@app.get("/v1/files/{file_id}")
+async def get_file(request: Request, file_id: str):
+    return file_view(await _owned_file(request, file_id))
+
+@app.get("/v1/files/{file_id}/content")
+async def get_file_content(request: Request, file_id: str):
+    row = await _owned_file(request, file_id)
+    if not os.path.exists(row["path"]):
+        raise HTTPException(status_code=404, detail=f"File {file_id} content is no longer available")
+    return FileResponse(row["path"], media_type="application/jsonl", filename=row["filename"])
+
+@app.delete("/v1/files/{file_id}")
+async def delete_file(request: Request, file_id: str):
+    row = await _owned_file(request, file_id)
+    await batch_runner.delete_file(row)
+    return {"id": file_id, "object": "file", "deleted": True}
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    """Queue an uploaded JSONL file for the background runner; returns the Batch object."""
+    _batches_enabled()
+    try:
+        body = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    endpoint = body.get("endpoint")
+    if endpoint not in SUPPORTED_ENDPOINTS:
+        raise HTTPException(status_code=400, detail=f"Unsupported endpoint: {endpoint}; expected one of {', '.join(SUPPORTED_ENDPOINTS)}")
+    window = body.get("completion_window") or "24h"
+    if completion_window_seconds(window) is None:
+        raise HTTPException(status_code=400, detail='completion_window must be a number of hours, e.g. "24h"')
+    metadata = body.get("metadata")
+    if metadata is not None and not isinstance(metadata, dict):
+        raise HTTPException(status_code=400, detail="metadata must be an object")
+    input_file = await _owned_file(request, str(body.get("input_file_id") or ""))
+    if input_file["purpose"] != PURPOSE_BATCH:
+        raise HTTPException(status_code=400, detail='Input file must have purpose "batch"')
+    try:
+        batch = await batch_runner.create(_request_owner(request), input_file, endpoint, window, metadata)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return batch_view(batch)
+
+@app.get("/v1/batches")
+async def list_batches(request: Request, limit: int = 20, after: Optional[str] = None):
+    limit = max(1, min(limit, 100))
+    cursor = await _owned_batch(request, after) if after else None
+    rows = await batch_runner.list_batches(_request_owner(request), cursor, limit + 1)
+    data = [batch_view(row) for row in rows[:limit]]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": len(rows) > limit,
     }
-    if content_type:
-        headers["Content-Type"] = content_type
 
-    if final_token:
-        if target_key == "baidu" and (final_token.strip().startswith("{") or "BDUSS" in final_token):
-            headers["Authorization"] = final_token
-        else:
-            headers["Authorization"] = f"Bearer {final_token}"
-    else:
-        logger.warning(f"No token configured for service {target_key}. Request sent without Authorization header.")
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(request: Request, batch_id: str):
+    return batch_view(await _owned_batch(request, batch_id))
 
-    return headers
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(request: Request, batch_id: str):
+    """Stop a batch after the line in progress; results so far stay in its output/error files."""
+    await _owned_batch(request, batch_id)
+    return batch_view(await batch_runner.cancel(batch_id))
 
 @app.post("/v1/images/generations")
 async def proxy_images_generations(request: Request):
@@ -714,13 +2001,14 @@ async def proxy_images_generations(request: Request):
     if not isinstance(body, dict):
         raise HTTPException(status_code=400, detail="Invalid JSON body")
 
-    config = load_config()
+    snapshot = config_store.current()
+    config = snapshot.services
     model = body.get("model")
 
     target_key = None
     target_service = None
     if model:
-        target_key, target_service = _select_service_for_model(config, model)
+        target_key, target_service = _route_model(snapshot, model)
 
     if not target_service:
         if "jimeng" in config:
@@ -733,14 +2021,22 @@ async def proxy_images_generations(request: Request):
         else:
             raise HTTPException(status_code=404, detail=f"No service found for model: {model or '(missing model)'}")
 
+    if _wants_async(request):
+        return await _submit_job(request, "images/generations", target_key, target_service, model, body)
+
     target_url = f"{target_service['url']}/v1/images/generations"
-    headers = _build_upstream_headers(target_key, target_service, body, content_type="application/json")
-    logger.info(f"Routing image generation model={model} to {target_key} ({target_url})")
+    lease = await _acquire_token(snapshot, target_key, target_service, PRIORITY_BATCH)
+    headers = _build_upstream_headers(
+        snapshot, target_key, lease.account if lease else None, content_type="application/json"
+    )
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(target_url, json=body, headers=headers, timeout=1800.0)
-        media_type = response.headers.get("Content-Type") or "application/json"
-        return Response(content=response.content, status_code=response.status_code, media_type=media_type)
+    client = upstream_clients.get(target_key, target_service)
+    route = gateway_metrics.route(target_key, model)
+    annotate(service=target_key, model=model)
+    response, ttfb = await _send_upstream(
+        client, lease, target_url, headers, json=body, timeout=1800.0, route=route, disconnected=_disconnected(request)
+    )
+    return _relay_response(response, lease, ttfb, route=route)
 
 @app.post("/v1/images/compositions")
 async def proxy_images_compositions(request: Request):
@@ -748,7 +2044,8 @@ async def proxy_images_compositions(request: Request):
     content_type = request.headers.get("Content-Type") or ""
     is_json = "application/json" in content_type.lower()
 
-    config = load_config()
+    snapshot = config_store.current()
+    config = snapshot.services
     target_key = None
     target_service = None
     body_json = None
@@ -762,7 +2059,7 @@ async def proxy_images_compositions(request: Request):
         if isinstance(body_json, dict):
             model = body_json.get("model")
             if model:
-                target_key, target_service = _select_service_for_model(config, model)
+                target_key, target_service = _route_model(snapshot, model)
 
     if not target_service:
         if "jimeng" in config:
@@ -771,23 +2068,37 @@ async def proxy_images_compositions(request: Request):
         else:
             raise HTTPException(status_code=404, detail="Jimeng service not configured")
 
+    if _wants_async(request):
+        return await _submit_job(
+            request, "images/compositions", target_key, target_service, model, body_json if is_json else None, content_type
+        )
+
     target_url = f"{target_service['url']}/v1/images/compositions"
+    upload_limit = None if is_json else _upload_limit(request, target_service)
+    lease = await _acquire_token(snapshot, target_key, target_service, PRIORITY_BATCH)
     headers = _build_upstream_headers(
+        snapshot,
         target_key,
-        target_service,
-        body_json if is_json else None,
+        lease.account if lease else None,
         content_type=content_type or ("application/json" if is_json else "application/octet-stream"),
     )
-    logger.info(f"Routing image composition model={model or '-'} to {target_key} ({target_url})")
 
-    async with httpx.AsyncClient() as client:
-        if is_json:
-            resp = await client.post(target_url, json=body_json, headers=headers, timeout=1800.0)
-        else:
-            raw = await request.body()
-            resp = await client.post(target_url, content=raw, headers=headers, timeout=1800.0)
-        media_type = resp.headers.get("Content-Type") or "application/json"
-        return Response(content=resp.content, status_code=resp.status_code, media_type=media_type)
+    client = upstream_clients.get(target_key, target_service)
+    route = gateway_metrics.route(target_key, model)
+    annotate(service=target_key, model=model)
+    if is_json:
+        resp, ttfb = await _send_upstream(
+            client, lease, target_url, headers, json=body_json, timeout=1800.0, route=route,
+            disconnected=_disconnected(request),
+        )
+    else:
+        if request.headers.get("Content-Length"):
+            headers["Content-Length"] = request.headers["Content-Length"]
+        resp, ttfb = await _send_upstream(
+            client, lease, target_url, headers, content=_stream_upload(request, upload_limit), timeout=1800.0, route=route,
+            disconnected=_disconnected(request),
+        )
+    return _relay_response(resp, lease, ttfb, route=route)
 
 @app.post("/v1/videos/generations")
 async def proxy_videos_generations(request: Request):
@@ -795,7 +2106,8 @@ async def proxy_videos_generations(request: Request):
     content_type = request.headers.get("Content-Type") or ""
     is_json = "application/json" in content_type.lower()
 
-    config = load_config()
+    snapshot = config_store.current()
+    config = snapshot.services
     target_key = None
     target_service = None
     body_json = None
@@ -809,7 +2121,7 @@ async def proxy_videos_generations(request: Request):
         if isinstance(body_json, dict):
             model = body_json.get("model")
             if model:
-                target_key, target_service = _select_service_for_model(config, model)
+                target_key, target_service = _route_model(snapshot, model)
 
     if not target_service:
         if "jimeng" in config:
@@ -818,24 +2130,43 @@ async def proxy_videos_generations(request: Request):
         else:
             raise HTTPException(status_code=404, detail="Jimeng service not configured")
 
+    if _wants_async(request):
+        return await _submit_job(
+            request, "videos/generations", target_key, target_service, model, body_json if is_json else None, content_type
+        )
+
     target_url = f"{target_service['url']}/v1/videos/generations"
+    upload_limit = None if is_json else _upload_limit(request, target_service)
+    lease = await _acquire_token(snapshot, target_key, target_service, PRIORITY_BATCH)
     headers = _build_upstream_headers(
+        snapshot,
         target_key,
-        target_service,
-        body_json if is_json else None,
+        lease.account if lease else None,
         content_type=content_type or ("application/json" if is_json else "application/octet-stream"),
     )
-    logger.info(f"Routing video generation model={model or '-'} to {target_key} ({target_url})")
 
-    async with httpx.AsyncClient() as client:
-        if is_json:
-            resp = await client.post(target_url, json=body_json, headers=headers, timeout=1800.0)
-        else:
-            raw = await request.body()
-            resp = await client.post(target_url, content=raw, headers=headers, timeout=1800.0)
-        media_type = resp.headers.get("Content-Type") or "application/json"
-        return Response(content=resp.content, status_code=resp.status_code, media_type=media_type)
+    client = upstream_clients.get(target_key, target_service)
+    route = gateway_metrics.route(target_key, model)
+    annotate(service=target_key, model=model)
+    if is_json:
+        resp, ttfb = await _send_upstream(
+            client, lease, target_url, headers, json=body_json, timeout=1800.0, route=route,
+            disconnected=_disconnected(request),
+        )
+    else:
+        if request.headers.get("Content-Length"):
+            headers["Content-Length"] = request.headers["Content-Length"]
+        resp, ttfb = await _send_upstream(
+            client, lease, target_url, headers, content=_stream_upload(request, upload_limit), timeout=1800.0, route=route,
+            disconnected=_disconnected(request),
+        )
+    return _relay_response(resp, lease, ttfb, route=route)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("app:app", host="0.0.0.0", port=8888, reload=True)
+    # GATEWAY_RELOAD=1 仅用于本地开发（单进程 + 代码热重载）
+    if os.environ.get("GATEWAY_RELOAD", "").lower() in ("1", "true", "yes"):
+        uvicorn.run("app:app", host="0.0.0.0", port=8888, reload=True)
+    else:
+        # Requests are logged by AccessLogMiddleware off the event loop
+        uvicorn.run("app:app", host="0.0.0.0", port=8888, workers=GATEWAY_WORKERS, access_log=False)
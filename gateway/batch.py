@@ -0,0 +1,75 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# settings.json 的 "batch" 段：POST /v1/chat/completions/batch 一次提交多条对话请求，结果按完成顺序以 JSONL 流式返回
+DEFAULT_BATCH_OPTIONS = {
+    "enabled": True,
+    "concurrency": 8,        # 每个批次同时进行的请求数（未指定时）
+    "max_concurrency": 32,   # 客户端可指定的并发上限
+    "max_requests": 10000,   # 单个批次的请求条数上限
+}
+
+
+def batch_options(settings: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_BATCH_OPTIONS)
+    overrides = (settings or {}).get("batch")
+    if isinstance(overrides, dict):
+        for k in DEFAULT_BATCH_OPTIONS:
+            if overrides.get(k) is not None:
+                options[k] = overrides[k]
+    return options
+
+
+def batch_concurrency(options: Dict, requested) -> int:
+    """The client's requested concurrency clamped to [1, max_concurrency]; the configured default otherwise."""
+    try:
+        value = int(requested) if requested is not None else int(options["concurrency"])
+    except (TypeError, ValueError):
+        value = int(options["concurrency"])
+    return max(1, min(value, int(options["max_concurrency"])))
+
+
+def batch_line(index: int, status_code: int, body: Any = None, error: Optional[str] = None) -> Dict:
+    line = {"index": index, "status_code": status_code}
+    if error is not None:
+        line["error"] = {"message": error}
+    else:
+        line["body"] = body
+    return line
+
+
+async def fan_out(
+    items: List,
+    concurrency: int,
+    run: Callable[[int, Any], Awaitable[Dict]],
+) -> AsyncIterator[bytes]:
+    """
+    Run run(index, item) for every item with at most `concurrency` in flight and yield each result as
+    one JSONL line as soon as it completes. Workers pull the next index themselves, so only
+    `concurrency` tasks exist whatever the batch size; closing the generator cancels them.
+    """
+    results: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+    indices = iter(range(len(items)))
+
+    async def worker():
+        for index in indices:
+            try:
+                line = await run(index, items[index])
+            except Exception as e:
+                logger.error(f"Batch item {index} failed: {e}")
+                line = batch_line(index, 500, error=str(e))
+            await results.put(line)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(items)))]
+    try:
+        for _ in range(len(items)):
+            line = await results.get()
+            yield (json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8")
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
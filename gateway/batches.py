@@ -0,0 +1,671 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from jobs import HEARTBEAT_INTERVAL, POLL_INTERVAL
+from storeutil import process_alive, remove_file
+
+logger = logging.getLogger(__name__)
+
+# settings.json 的 "batches" 段：兼容 OpenAI Batch API 的 /v1/files 与 /v1/batches。
+# 上传的 JSONL 文件保存在本地磁盘，后台按 rpm 速率逐行调用对话接口，每完成一行记录一次进度，重启后从断点继续
+DEFAULT_BATCHES_OPTIONS = {
+    "enabled": True,
+    "rpm": 60,               # 每个批次每分钟发起的请求数
+    "concurrency": 4,        # 每个批次同时进行的请求数
+    "max_running": 1,        # 每个网关进程同时执行的批次数
+    "max_file_mb": 200,      # 上传文件大小上限
+    "retention_hours": 168,  # 已结束批次及其结果文件的保留时长
+}
+
+BATCH_VALIDATING = "validating"
+BATCH_IN_PROGRESS = "in_progress"
+BATCH_FINALIZING = "finalizing"
+BATCH_COMPLETED = "completed"
+BATCH_FAILED = "failed"
+BATCH_EXPIRED = "expired"
+BATCH_CANCELLING = "cancelling"
+BATCH_CANCELLED = "cancelled"
+ACTIVE_BATCH_STATUSES = (BATCH_VALIDATING, BATCH_IN_PROGRESS, BATCH_FINALIZING, BATCH_CANCELLING)
+
+PURPOSE_BATCH = "batch"
+PURPOSE_BATCH_OUTPUT = "batch_output"
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# execute(owner, body) -> (status_code, response body); owner is the gateway key id that created the batch
+LineFn = Callable[[Optional[str], Dict], Awaitable[Tuple[int, Any]]]
+
+_WINDOW = re.compile(r"^(\d+)h$")
+
+_BATCH_COLUMNS = (
+    "id", "owner", "endpoint", "input_file_id", "completion_window", "status", "metadata", "errors",
+    "output_file_id", "error_file_id", "total", "completed", "failed", "offset", "output_bytes",
+    "error_bytes", "runner", "heartbeat_at", "created_at", "in_progress_at", "expires_at", "finalizing_at",
+    "completed_at", "failed_at", "expired_at", "cancelling_at", "cancelled_at",
+)
+_FILE_COLUMNS = ("id", "owner", "purpose", "filename", "bytes", "path", "created_at")
+
+
+def batches_options(settings: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_BATCHES_OPTIONS)
+    overrides = (settings or {}).get("batches")
+    if isinstance(overrides, dict):
+        for k in DEFAULT_BATCHES_OPTIONS:
+            if overrides.get(k) is not None:
+                options[k] = overrides[k]
+    return options
+
+
+def completion_window_seconds(window) -> Optional[int]:
+    """"24h" -> 86400; None for anything that is not a whole number of hours."""
+    match = _WINDOW.match(window) if isinstance(window, str) else None
+    return int(match.group(1)) * 3600 if match and int(match.group(1)) > 0 else None
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class BatchStore:
+    """Uploaded files and batches in a local SQLite file; every call runs on a worker thread behind one lock."""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    id TEXT PRIMARY KEY,
+                    owner TEXT,
+                    purpose TEXT NOT NULL,
+                    filename TEXT,
+                    bytes INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS batches (
+                    id TEXT PRIMARY KEY,
+                    owner TEXT,
+                    endpoint TEXT NOT NULL,
+                    input_file_id TEXT NOT NULL,
+                    completion_window TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    metadata TEXT,
+                    errors TEXT,
+                    output_file_id TEXT,
+                    error_file_id TEXT,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    completed INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    offset INTEGER NOT NULL DEFAULT 0,
+                    output_bytes INTEGER NOT NULL DEFAULT 0,
+                    error_bytes INTEGER NOT NULL DEFAULT 0,
+                    runner TEXT,
+                    heartbeat_at REAL,
+                    created_at REAL NOT NULL,
+                    in_progress_at REAL,
+                    expires_at REAL,
+                    finalizing_at REAL,
+                    completed_at REAL,
+                    failed_at REAL,
+                    expired_at REAL,
+                    cancelling_at REAL,
+                    cancelled_at REAL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS batches_status ON batches (status, created_at)")
+            self._conn.commit()
+        return self._conn
+
+    def _run(self, sql: str, params: Tuple = (), fetch: bool = False):
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(sql, params)
+            rows = [dict(row) for row in cursor.fetchall()] if fetch else None
+            conn.commit()
+            return rows
+
+    async def execute(self, sql: str, params: Tuple = (), fetch: bool = False):
+        return await asyncio.to_thread(self._run, sql, params, fetch)
+
+    async def _insert(self, table: str, columns: Tuple[str, ...], row: Dict):
+        names = [c for c in columns if c in row]
+        await self.execute(
+            f"INSERT OR REPLACE INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})",
+            tuple(row[c] for c in names),
+        )
+
+    async def insert_file(self, row: Dict):
+        await self._insert("files", _FILE_COLUMNS, row)
+
+    async def insert_batch(self, row: Dict):
+        await self._insert("batches", _BATCH_COLUMNS, row)
+
+    async def get_file(self, file_id: str) -> Optional[Dict]:
+        rows = await self.execute("SELECT * FROM files WHERE id = ?", (file_id,), fetch=True)
+        return rows[0] if rows else None
+
+    async def list_files(self, owner: Optional[str], purpose: Optional[str], limit: int) -> List[Dict]:
+        sql = "SELECT * FROM files WHERE owner IS ?"
+        params: Tuple = (owner,)
+        if purpose:
+            sql += " AND purpose = ?"
+            params += (purpose,)
+        return await self.execute(sql + " ORDER BY created_at DESC LIMIT ?", params + (limit,), fetch=True)
+
+    async def delete_file(self, file_id: str):
+        await self.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    async def get_batch(self, batch_id: str) -> Optional[Dict]:
+        rows = await self.execute("SELECT * FROM batches WHERE id = ?", (batch_id,), fetch=True)
+        return rows[0] if rows else None
+
+    async def list_batches(self, owner: Optional[str], after: Optional[Dict], limit: int) -> List[Dict]:
+        sql = "SELECT * FROM batches WHERE owner IS ?"
+        params: Tuple = (owner,)
+        if after is not None:
+            sql += " AND (created_at < ? OR (created_at = ? AND id < ?))"
+            params += (after["created_at"], after["created_at"], after["id"])
+        return await self.execute(
+            sql + " ORDER BY created_at DESC, id DESC LIMIT ?", params + (limit,), fetch=True
+        )
+
+    async def update_batch(self, batch_id: str, **fields):
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        await self.execute(f"UPDATE batches SET {assignments} WHERE id = ?", (*fields.values(), batch_id))
+
+    async def checkpoint(self, batch_id: str, **fields) -> Optional[str]:
+        """Record progress after one line; returns the stored status so a cancel request is noticed."""
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        rows = await self.execute(
+            f"UPDATE batches SET {assignments}, heartbeat_at = ? WHERE id = ? RETURNING status",
+            (*fields.values(), time.time(), batch_id),
+            fetch=True,
+        )
+        return rows[0]["status"] if rows else None
+
+    async def request_cancel(self, batch_id: str) -> None:
+        await self.execute(
+            f"UPDATE batches SET status = ?, cancelling_at = ? WHERE id = ? "
+            f"AND status IN ({', '.join('?' for _ in (BATCH_VALIDATING, BATCH_IN_PROGRESS))})",
+            (BATCH_CANCELLING, time.time(), batch_id, BATCH_VALIDATING, BATCH_IN_PROGRESS),
+        )
+
+    async def claim(self, runner: str) -> Optional[Dict]:
+        """Atomically take the oldest unowned active batch for this runner; safe across processes."""
+        now = time.time()
+        rows = await self.execute(
+            "UPDATE batches SET runner = ?, heartbeat_at = ? "
+            "WHERE id = (SELECT id FROM batches WHERE runner IS NULL AND status IN (?, ?, ?, ?) "
+            "ORDER BY created_at LIMIT 1) AND runner IS NULL RETURNING *",
+            (runner, now, *ACTIVE_BATCH_STATUSES),
+            fetch=True,
+        )
+        return rows[0] if rows else None
+
+    async def heartbeat(self, batch_ids: List[str]):
+        if batch_ids:
+            await self.execute(
+                f"UPDATE batches SET heartbeat_at = ? WHERE id IN ({', '.join('?' for _ in batch_ids)})",
+                (time.time(), *batch_ids),
+            )
+
+    async def release_orphans(self, stale_before: float, alive: Callable[[str], bool]) -> int:
+        """Unassign active batches whose process is gone (or silent since stale_before) so any runner resumes them."""
+        rows = await self.execute(
+            "SELECT id, runner, heartbeat_at FROM batches WHERE runner IS NOT NULL AND status IN (?, ?, ?, ?)",
+            ACTIVE_BATCH_STATUSES,
+            fetch=True,
+        )
+        orphans = [r["id"] for r in rows if (r["heartbeat_at"] or 0) < stale_before or not alive(r["runner"])]
+        for batch_id in orphans:
+            await self.execute("UPDATE batches SET runner = NULL WHERE id = ?", (batch_id,))
+        return len(orphans)
+
+    async def expired(self, before: float) -> List[Dict]:
+        return await self.execute(
+            "SELECT id, output_file_id, error_file_id FROM batches WHERE runner IS NULL "
+            "AND COALESCE(completed_at, failed_at, expired_at, cancelled_at) < ?",
+            (before,),
+            fetch=True,
+        )
+
+    async def delete_batch(self, batch_id: str):
+        await self.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def parse_request_line(raw: bytes, endpoint: str) -> Tuple[Optional[str], Optional[Dict], Optional[str]]:
+    """(custom_id, body, error) for one input line in the OpenAI batch format."""
+    try:
+        entry = json.loads(raw)
+    except ValueError:
+        return None, None, "Line is not valid JSON"
+    if not isinstance(entry, dict):
+        return None, None, "Line must be a JSON object"
+    custom_id = entry.get("custom_id")
+    if not isinstance(custom_id, str) or not custom_id:
+        return None, None, "custom_id is required"
+    if str(entry.get("method") or "POST").upper() != "POST":
+        return custom_id, None, "method must be POST"
+    if entry.get("url") != endpoint:
+        return custom_id, None, f"url must be {endpoint}"
+    if not isinstance(entry.get("body"), dict):
+        return custom_id, None, "body must be a JSON object"
+    return custom_id, entry["body"], None
+
+
+def _result_line(custom_id: Optional[str], response: Optional[Dict], error: Optional[Dict]) -> bytes:
+    line = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id, "response": response, "error": error}
+    return (json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def file_view(row: Dict) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "object": "file",
+        "bytes": row["bytes"],
+        "created_at": int(row["created_at"]),
+        "filename": row["filename"],
+        "purpose": row["purpose"],
+        "status": "processed",
+    }
+
+
+def batch_view(row: Dict) -> Dict[str, Any]:
+    """OpenAI Batch object for a stored batch."""
+    def ts(name):
+        return int(row[name]) if row.get(name) else None
+
+    return {
+        "id": row["id"],
+        "object": "batch",
+        "endpoint": row["endpoint"],
+        "errors": json.loads(row["errors"]) if row.get("errors") else None,
+        "input_file_id": row["input_file_id"],
+        "completion_window": row["completion_window"],
+        "status": row["status"],
+        "output_file_id": row.get("output_file_id"),
+        "error_file_id": row.get("error_file_id"),
+        "created_at": ts("created_at"),
+        "in_progress_at": ts("in_progress_at"),
+        "expires_at": ts("expires_at"),
+        "finalizing_at": ts("finalizing_at"),
+        "completed_at": ts("completed_at"),
+        "failed_at": ts("failed_at"),
+        "expired_at": ts("expired_at"),
+        "cancelling_at": ts("cancelling_at"),
+        "cancelled_at": ts("cancelled_at"),
+        "request_counts": {"total": row["total"], "completed": row["completed"], "failed": row["failed"]},
+        "metadata": json.loads(row["metadata"]) if row.get("metadata") else None,
+    }
+
+
+def _count_lines(path: str) -> int:
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def _open_result(path: str, size: int):
+    """Open an output/error file for appending, cut back to the last checkpoint (lines written after it are redone)."""
+    f = open(path, "ab")
+    f.truncate(min(size, f.tell()))
+    f.seek(0, os.SEEK_END)
+    return f
+
+
+def _write_line(f, data: bytes) -> int:
+    f.write(data)
+    f.flush()
+    return f.tell()
+
+
+class BatchRunner:
+    """
+    Background drain for OpenAI-style batches. Each claimed batch reads its input file from the saved
+    byte offset, starts at most `rpm` requests a minute with up to `concurrency` in flight, and commits
+    results in input order: the result line is appended, then offset / counts / output sizes are stored.
+    A batch resumed after a crash truncates its result files back to that checkpoint, so no line is
+    written twice. Batches are claimed through SQLite, so several gateway processes can share batches.db.
+    """
+
+    def __init__(self, store: BatchStore, directory: str, execute: LineFn, options_fn: Callable[[], Dict]):
+        self._store = store
+        self._directory = directory
+        self._execute = execute
+        self._options_fn = options_fn
+        self._runner = str(os.getpid())
+        self._wake = asyncio.Event()
+        self._running: Dict[str, asyncio.Task] = {}
+        self._tasks: List[asyncio.Task] = []
+        self.lines = {"completed": 0, "failed": 0}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._directory, name)
+
+    # -- files --
+
+    async def save_file(self, owner: Optional[str], purpose: str, filename: Optional[str], upload, limit: int) -> Dict:
+        """Copy an uploaded file (anything with async read(n)) to disk; raises FileTooLarge past `limit` bytes."""
+        os.makedirs(self._directory, exist_ok=True)
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        path = self._path(f"{file_id}.jsonl")
+        size = 0
+        try:
+            with open(path, "wb") as f:
+                while True:
+                    chunk = await upload.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > limit:
+                        raise FileTooLarge(size)
+                    await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            remove_file(path)
+            raise
+        row = {
+            "id": file_id,
+            "owner": owner,
+            "purpose": purpose,
+            "filename": filename or f"{file_id}.jsonl",
+            "bytes": size,
+            "path": path,
+            "created_at": time.time(),
+        }
+        await self._store.insert_file(row)
+        return row
+
+    async def get_file(self, file_id: str) -> Optional[Dict]:
+        return await self._store.get_file(file_id)
+
+    async def list_files(self, owner: Optional[str], purpose: Optional[str], limit: int) -> List[Dict]:
+        return await self._store.list_files(owner, purpose, limit)
+
+    async def delete_file(self, row: Dict):
+        await self._store.delete_file(row["id"])
+        remove_file(row["path"])
+
+    # -- batches --
+
+    async def create(self, owner: Optional[str], input_file: Dict, endpoint: str, window: str, metadata) -> Dict:
+        """Count the input lines and queue the batch; raises ValueError for an empty input file."""
+        total = await asyncio.to_thread(_count_lines, input_file["path"])
+        if total == 0:
+            raise ValueError("Input file has no requests")
+        now = time.time()
+        row = {
+            "id": f"batch_{uuid.uuid4().hex[:24]}",
+            "owner": owner,
+            "endpoint": endpoint,
+            "input_file_id": input_file["id"],
+            "completion_window": window,
+            "status": BATCH_VALIDATING,
+            "metadata": json.dumps(metadata, ensure_ascii=False) if metadata else None,
+            "total": total,
+            "created_at": now,
+            "expires_at": now + completion_window_seconds(window),
+        }
+        await self._store.insert_batch(row)
+        self._wake.set()
+        return await self._store.get_batch(row["id"])
+
+    async def get(self, batch_id: str) -> Optional[Dict]:
+        return await self._store.get_batch(batch_id)
+
+    async def list_batches(self, owner: Optional[str], after: Optional[Dict], limit: int) -> List[Dict]:
+        return await self._store.list_batches(owner, after, limit)
+
+    async def cancel(self, batch_id: str) -> Optional[Dict]:
+        await self._store.request_cancel(batch_id)
+        # An unclaimed batch is finalized by whichever runner picks it up next
+        self._wake.set()
+        return await self._store.get_batch(batch_id)
+
+    async def _scheduler(self):
+        while True:
+            started = False
+            if len(self._running) < max(1, int(self._options_fn()["max_running"])):
+                try:
+                    batch = await self._store.claim(self._runner)
+                except Exception as e:
+                    logger.error(f"Batch claim failed: {e}")
+                    batch = None
+                if batch is not None:
+                    task = asyncio.create_task(self._drain(batch))
+                    self._running[batch["id"]] = task
+                    task.add_done_callback(lambda _, batch_id=batch["id"]: self._running.pop(batch_id, None))
+                    started = True
+            if not started:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _drain(self, batch: Dict):
+        batch_id = batch["id"]
+        try:
+            await self._process(batch)
+        except asyncio.CancelledError:
+            # Gateway shutting down: leave the checkpoint; the next start (or another process) resumes it
+            raise
+        except Exception as e:
+            logger.error(f"Batch {batch_id} failed: {e}")
+            await self._store.update_batch(
+                batch_id,
+                status=BATCH_FAILED,
+                failed_at=time.time(),
+                runner=None,
+                errors=json.dumps({"object": "list", "data": [{"code": "batch_failed", "message": str(e)}]}),
+            )
+        finally:
+            self._wake.set()
+
+    async def _process(self, batch: Dict):
+        batch_id = batch["id"]
+        if batch["status"] == BATCH_CANCELLING:
+            await self._finalize(batch, BATCH_CANCELLED)
+            return
+        input_file = await self._store.get_file(batch["input_file_id"])
+        if input_file is None or not os.path.exists(input_file["path"]):
+            raise RuntimeError(f"Input file {batch['input_file_id']} no longer exists")
+        if batch["status"] == BATCH_VALIDATING:
+            batch["in_progress_at"] = time.time()
+            await self._store.update_batch(batch_id, status=BATCH_IN_PROGRESS, in_progress_at=batch["in_progress_at"])
+        elif batch["offset"]:
+            logger.info(f"Resuming batch {batch_id} at request {batch['completed'] + batch['failed'] + 1}/{batch['total']}")
+
+        os.makedirs(self._directory, exist_ok=True)
+        source = open(input_file["path"], "rb")
+        output = _open_result(self._path(f"{batch_id}_output.jsonl"), batch["output_bytes"])
+        errors = _open_result(self._path(f"{batch_id}_error.jsonl"), batch["error_bytes"])
+        window: collections.deque = collections.deque()
+        final_status = BATCH_COMPLETED
+        try:
+            source.seek(batch["offset"])
+            offset = batch["offset"]
+            completed, failed = batch["completed"], batch["failed"]
+            next_start = time.monotonic()
+            eof = False
+            while True:
+                options = self._options_fn()
+                while not eof and len(window) < max(1, int(options["concurrency"])):
+                    if time.time() > batch["expires_at"]:
+                        final_status = BATCH_EXPIRED
+                        eof = True
+                        break
+                    raw = await asyncio.to_thread(source.readline)
+                    if not raw:
+                        eof = True
+                        break
+                    offset += len(raw)
+                    if not raw.strip():
+                        window.append((offset, None))
+                        continue
+                    # Pace request starts to the configured rate
+                    delay = next_start - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    next_start = max(next_start, time.monotonic()) + 60.0 / max(0.001, float(options["rpm"]))
+                    window.append((offset, asyncio.create_task(self._run_line(raw, batch["endpoint"], batch["owner"]))))
+                if not window:
+                    break
+
+                line_end, task = window.popleft()
+                if task is not None:
+                    ok, data = await task
+                    if ok:
+                        completed += 1
+                        await asyncio.to_thread(_write_line, output, data)
+                    else:
+                        failed += 1
+                        await asyncio.to_thread(_write_line, errors, data)
+                    self.lines["completed" if ok else "failed"] += 1
+                status = await self._store.checkpoint(
+                    batch_id,
+                    offset=line_end,
+                    completed=completed,
+                    failed=failed,
+                    output_bytes=output.tell(),
+                    error_bytes=errors.tell(),
+                )
+                if status == BATCH_CANCELLING:
+                    final_status = BATCH_CANCELLED
+                    break
+        finally:
+            for _, task in window:
+                if task is not None:
+                    task.cancel()
+            await asyncio.gather(*[task for _, task in window if task is not None], return_exceptions=True)
+            source.close()
+            output.close()
+            errors.close()
+
+        batch = await self._store.get_batch(batch_id)
+        await self._finalize(batch, final_status)
+
+    async def _run_line(self, raw: bytes, endpoint: str, owner: Optional[str]) -> Tuple[bool, bytes]:
+        """(succeeded, result line) for one input line; never raises except on cancellation."""
+        custom_id, body, error = parse_request_line(raw, endpoint)
+        if error is not None:
+            return False, _result_line(custom_id, None, {"code": "invalid_request", "message": error})
+        try:
+            status_code, response = await self._execute(owner, body)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return False, _result_line(custom_id, None, {"code": "request_failed", "message": str(e)})
+        ok = 200 <= status_code < 300 and not (isinstance(response, dict) and "error" in response)
+        result = {"status_code": status_code, "request_id": uuid.uuid4().hex, "body": response}
+        return ok, _result_line(custom_id, result, None)
+
+    async def _finalize(self, batch: Dict, status: str):
+        """Register the result files and move the batch to its terminal status."""
+        batch_id = batch["id"]
+        now = time.time()
+        files = {}
+        for column, suffix, size in (
+            ("output_file_id", "output", batch["output_bytes"]),
+            ("error_file_id", "error", batch["error_bytes"]),
+        ):
+            path = self._path(f"{batch_id}_{suffix}.jsonl")
+            if not size:
+                remove_file(path)
+                continue
+            files[column] = {
+                "id": batch.get(column) or f"file-{uuid.uuid4().hex[:24]}",
+                "owner": batch["owner"],
+                "purpose": PURPOSE_BATCH_OUTPUT,
+                "filename": f"{batch_id}_{suffix}.jsonl",
+                "bytes": size,
+                "path": path,
+                "created_at": now,
+            }
+        # File ids are stored first, so finalizing again after a crash reuses them
+        await self._store.update_batch(
+            batch_id, status=BATCH_FINALIZING, finalizing_at=now, **{k: row["id"] for k, row in files.items()}
+        )
+        for row in files.values():
+            await self._store.insert_file(row)
+        stamp = {BATCH_COMPLETED: "completed_at", BATCH_EXPIRED: "expired_at", BATCH_CANCELLED: "cancelled_at"}[status]
+        await self._store.update_batch(batch_id, status=status, runner=None, **{stamp: time.time()})
+        logger.info(f"Batch {batch_id} {status}: {batch['completed']} completed, {batch['failed']} failed")
+
+    async def _release_orphans(self):
+        def alive(runner: Optional[str]) -> bool:
+            if runner == self._runner:
+                # Before our scheduler starts, our pid on an active batch is a previous run of this container
+                return bool(self._tasks)
+            return process_alive(runner)
+
+        released = await self._store.release_orphans(time.time() - 3 * HEARTBEAT_INTERVAL, alive)
+        if released:
+            logger.info(f"Resuming {released} batches left by a stopped gateway process")
+            self._wake.set()
+
+    async def _maintenance_loop(self):
+        ticks = 0
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self._store.heartbeat(list(self._running))
+                await self._release_orphans()
+                ticks += 1
+                if ticks % int(3600 / HEARTBEAT_INTERVAL) == 0:
+                    await self._cleanup()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Batch maintenance error: {e}")
+
+    async def _cleanup(self):
+        retention = float(self._options_fn()["retention_hours"]) * 3600
+        for batch in await self._store.expired(time.time() - retention):
+            for column in ("output_file_id", "error_file_id"):
+                row = await self._store.get_file(batch[column]) if batch.get(column) else None
+                if row is not None:
+                    await self.delete_file(row)
+            await self._store.delete_batch(batch["id"])
+
+    async def start(self):
+        await self._release_orphans()
+        await self._cleanup()
+        self._tasks = [asyncio.create_task(self._scheduler()), asyncio.create_task(self._maintenance_loop())]
+
+    async def stop(self):
+        running = list(self._running.values())
+        for task in self._tasks + running:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *running, return_exceptions=True)
+        self._tasks = []
+        self._store.close()
+
+    def stats(self) -> Dict:
+        return {"running": sorted(self._running), "lines": dict(self.lines)}
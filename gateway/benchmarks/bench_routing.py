@@ -0,0 +1,87 @@
+"""
+Microbenchmark: compiled RoutingTable vs the linear _select_service_for_model.
+
+Usage (from the gateway directory):
+    python benchmarks/bench_routing.py [--models 1000] [--lookups 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import _select_service_for_model  # noqa: E402
+from routing import RoutingTable  # noqa: E402
+
+SERVICE_KEYS = ["deepseek", "glm", "kimi", "qwen", "doubao", "yuanbao", "jimeng", "baidu"]
+
+
+def build_config(total_models: int):
+    rng = random.Random(42)
+    config = {key: {"url": f"http://{key}:8000", "token": "", "models": []} for key in SERVICE_KEYS}
+    for i in range(total_models):
+        key = SERVICE_KEYS[i % len(SERVICE_KEYS)]
+        family = rng.choice(["chat", "pro", "lite", "think", "search", "vision"])
+        config[key]["models"].append(f"{key}-{family}-{i}")
+    # The legacy / cross-service cases from the real config
+    config["deepseek"]["models"].append("deepseek-r1")
+    config["yuanbao"]["models"].extend(["deepseek-r1", "hunyuan-t1"])
+    config["baidu"]["models"].append("DeepSeek-R1")
+    return config
+
+
+def build_queries(config, count: int):
+    rng = random.Random(7)
+    configured = [m for service in config.values() for m in service["models"]]
+    unknown = ["DeepSeek-R1", "gpt-4o", "hunyuan-t1-search", "Kimi-Latest", "moonshot-v1-8k", "qwen3-max-preview"]
+    queries = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.7:
+            queries.append(rng.choice(configured))
+        elif roll < 0.9:
+            queries.append(rng.choice(configured) + "-latest")
+        else:
+            queries.append(rng.choice(unknown))
+    return queries
+
+
+def bench(label, fn, queries):
+    started = time.perf_counter()
+    for model in queries:
+        fn(model)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<14} {elapsed * 1e6 / len(queries):10.2f} us/lookup  ({elapsed:.3f}s total)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=int, default=1000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    config = build_config(args.models)
+    queries = build_queries(config, args.lookups)
+
+    started = time.perf_counter()
+    table = RoutingTable(config)
+    print(f"compile        {(time.perf_counter() - started) * 1000:10.2f} ms for {args.models} models")
+
+    mismatches = [
+        m for m in set(queries)
+        if table.lookup(m)[0] != _select_service_for_model(config, m)[0]
+    ]
+    if mismatches:
+        print(f"MISMATCH on {len(mismatches)} models, e.g. {mismatches[:5]}")
+        sys.exit(1)
+
+    linear = bench("linear", lambda m: _select_service_for_model(config, m), queries)
+    compiled = bench("routing table", table.lookup, queries)
+    print(f"speedup        {linear / compiled:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
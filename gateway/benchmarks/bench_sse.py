@@ -0,0 +1,110 @@
+"""
+Benchmark: byte passthrough vs line rewriting for SSE streams.
+
+Feeds a synthetic 10k-event stream, split at random network-like chunk boundaries,
+through both paths and reports throughput plus per-chunk latency (time from an
+upstream chunk arriving to the next piece being handed to the client).
+
+Usage (from the gateway directory):
+    python benchmarks/bench_sse.py [--events 10000] [--rounds 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sse import iter_text_lines, passthrough_sse, rewrite_sse_lines  # noqa: E402
+
+
+def build_stream(events: int):
+    rng = random.Random(3)
+    parts = []
+    for i in range(events):
+        delta = {"reasoning_content" if i < events // 2 else "content": "tok" * rng.randint(1, 6)}
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "deepseek-r1",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        }
+        parts.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+    parts.append("data: [DONE]\n\n")
+    raw = "".join(parts).encode("utf-8")
+
+    chunks = []
+    pos = 0
+    while pos < len(raw):
+        size = rng.randint(64, 1024)
+        chunks.append(raw[pos:pos + size])
+        pos += size
+    return raw, chunks
+
+
+class Source:
+    """Async chunk source recording when each chunk was handed out."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.emitted_at = 0.0
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            self.emitted_at = time.perf_counter()
+            yield chunk
+
+
+async def run_once(mode: str, chunks):
+    source = Source(chunks)
+    if mode == "passthrough":
+        pipeline = passthrough_sse(source.__aiter__())
+    else:
+        pipeline = rewrite_sse_lines(iter_text_lines(source.__aiter__()))
+
+    latencies = []
+    out_bytes = 0
+    last_seen = None
+    started = time.perf_counter()
+    async for piece in pipeline:
+        now = time.perf_counter()
+        if source.emitted_at != last_seen:
+            latencies.append(now - source.emitted_at)
+            last_seen = source.emitted_at
+        out_bytes += len(piece) if isinstance(piece, bytes) else len(piece.encode("utf-8"))
+    return time.perf_counter() - started, out_bytes, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    raw, chunks = build_stream(args.events)
+    print(f"stream: {args.events} events, {len(raw) / 1024:.0f} KiB in {len(chunks)} chunks")
+
+    for mode in ("rewrite", "passthrough"):
+        elapsed_all, latencies_all = [], []
+        out_bytes = 0
+        for _ in range(args.rounds):
+            elapsed, out_bytes, latencies = asyncio.run(run_once(mode, chunks))
+            elapsed_all.append(elapsed)
+            latencies_all.extend(latencies)
+        best = min(elapsed_all)
+        latencies_all.sort()
+        p50 = statistics.median(latencies_all) * 1e6
+        p99 = latencies_all[int(len(latencies_all) * 0.99)] * 1e6
+        print(
+            f"{mode:<12} {len(raw) / best / 1024 / 1024:8.1f} MiB/s  {args.events / best:10.0f} events/s  "
+            f"chunk latency p50={p50:.1f}us p99={p99:.1f}us  out={out_bytes} bytes"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import logging
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# settings.json 的 "breaker" 段为全局默认，config.json 服务里的 "breaker" 字段可单独覆盖
+DEFAULT_BREAKER_OPTIONS = {
+    "enabled": True,
+    "window": 20,                   # 最近 N 次调用参与统计
+    "min_calls": 5,                 # 样本不足时不熔断
+    "failure_rate_threshold": 0.5,  # 失败（含慢调用）占比达到阈值则熔断
+    "slow_call_seconds": 60.0,      # 超过该耗时的调用视为失败
+    "open_seconds": 30.0,           # 熔断后多久进入半开
+    "half_open_calls": 1,           # 半开状态允许的探测请求数
+}
+
+
+def breaker_options(defaults: Optional[Dict], service: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_BREAKER_OPTIONS)
+    for overrides in (defaults, (service or {}).get("breaker")):
+        if isinstance(overrides, dict):
+            for k in DEFAULT_BREAKER_OPTIONS:
+                if overrides.get(k) is not None:
+                    options[k] = overrides[k]
+    return options
+
+
+def compile_breaker_options(config: Dict, defaults: Optional[Dict]) -> Dict[str, Dict]:
+    return {
+        key: breaker_options(defaults, service)
+        for key, service in (config or {}).items()
+        if isinstance(service, dict)
+    }
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over a rolling window of the last calls to one upstream."""
+
+    def __init__(self, key: str, options: Dict):
+        self.key = key
+        self.options = options
+        self.state = STATE_CLOSED
+        self._window = deque(maxlen=max(1, int(options["window"])))
+        self._opened_at = 0.0
+        self._half_open_inflight = 0
+        self._half_open_started = 0.0
+        self.trips = 0
+        # on_change(key, state, open_seconds_left): open/closed transitions, shared with other processes
+        self.on_change: Optional[Callable[[str, str, float], None]] = None
+
+    def configure(self, options: Dict):
+        if options is self.options or options == self.options:
+            return
+        self.options = options
+        self._window = deque(self._window, maxlen=max(1, int(options["window"])))
+
+    def allow(self) -> bool:
+        if not self.options.get("enabled", True):
+            return True
+        now = time.monotonic()
+        if self.state == STATE_OPEN:
+            if now - self._opened_at < float(self.options["open_seconds"]):
+                return False
+            self._transition(STATE_HALF_OPEN)
+            self._half_open_inflight = 0
+        if self.state == STATE_HALF_OPEN:
+            # A probe that never reported back must not wedge the breaker
+            if self._half_open_inflight and now - self._half_open_started > float(self.options["open_seconds"]):
+                self._half_open_inflight = 0
+            if self._half_open_inflight >= int(self.options["half_open_calls"]):
+                return False
+            self._half_open_inflight += 1
+            self._half_open_started = now
+        return True
+
+    def retry_after(self) -> int:
+        if self.state != STATE_OPEN:
+            return 0
+        remaining = float(self.options["open_seconds"]) - (time.monotonic() - self._opened_at)
+        return max(1, int(remaining + 0.999))
+
+    def release(self):
+        """Return a half-open slot taken by allow() for a call that never reached the upstream."""
+        if self.state == STATE_HALF_OPEN:
+            self._half_open_inflight = max(0, self._half_open_inflight - 1)
+
+    def record(self, success: bool, latency: float):
+        slow = latency > float(self.options["slow_call_seconds"])
+        ok = success and not slow
+
+        if self.state == STATE_HALF_OPEN:
+            self._half_open_inflight = max(0, self._half_open_inflight - 1)
+            if ok:
+                self._window.clear()
+                self._transition(STATE_CLOSED)
+            else:
+                self._trip()
+            return
+
+        self._window.append(ok)
+        if self.state == STATE_CLOSED and len(self._window) >= int(self.options["min_calls"]):
+            failures = self._window.count(False)
+            if failures / len(self._window) >= float(self.options["failure_rate_threshold"]):
+                self._trip()
+
+    def _trip(self):
+        self._opened_at = time.monotonic()
+        self.trips += 1
+        self._transition(STATE_OPEN)
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit breaker for {self.key}: {self.state} -> {state}")
+            self.state = state
+            if self.on_change is not None and state != STATE_HALF_OPEN:
+                self.on_change(self.key, state, float(self.options["open_seconds"]) if state == STATE_OPEN else 0.0)
+
+    def apply(self, state: str, open_seconds_left: float):
+        """Transition reported by another process; does not notify on_change again."""
+        if state == STATE_OPEN:
+            if self.state != STATE_OPEN:
+                self.trips += 1
+            self._opened_at = time.monotonic() - max(0.0, float(self.options["open_seconds"]) - open_seconds_left)
+            self.state = STATE_OPEN
+        elif state == STATE_CLOSED and self.state != STATE_CLOSED:
+            self._window.clear()
+            self._half_open_inflight = 0
+            self.state = STATE_CLOSED
+
+    def stats(self) -> Dict:
+        calls = len(self._window)
+        failures = self._window.count(False)
+        return {
+            "state": self.state,
+            "calls": calls,
+            "failure_rate": round(failures / calls, 3) if calls else 0.0,
+            "trips": self.trips,
+            "retry_after_s": self.retry_after(),
+        }
+
+
+class BreakerRegistry:
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self.on_change: Optional[Callable[[str, str, float], None]] = None
+
+    def get(self, key: str, options: Optional[Dict] = None) -> CircuitBreaker:
+        options = options or DEFAULT_BREAKER_OPTIONS
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(key, options)
+            breaker.on_change = self.on_change
+            self._breakers[key] = breaker
+        else:
+            breaker.configure(options)
+        return breaker
+
+    def apply(self, key: str, state: str, open_seconds_left: float):
+        self.get(key, self._breakers[key].options if key in self._breakers else None).apply(state, open_seconds_left)
+
+    def stats(self) -> Dict:
+        return {key: breaker.stats() for key, breaker in self._breakers.items()}
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# settings.json 的 "cache" 段：缓存总体容量与默认 TTL
+DEFAULT_CACHE_OPTIONS = {
+    "enabled": True,
+    "ttl": 300.0,                   # 默认缓存有效期（秒）
+    "max_bytes": 64 * 1024 * 1024,  # 所有缓存响应体的总字节预算
+    "max_entries": 10000,
+    "max_entry_bytes": 1024 * 1024, # 超过该大小的响应不缓存
+}
+
+# Request fields that never change the completion itself
+_IGNORED_FIELDS = ("stream", "stream_options", "user")
+
+
+def cache_options(settings: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_CACHE_OPTIONS)
+    overrides = (settings or {}).get("cache")
+    if isinstance(overrides, dict):
+        for k in DEFAULT_CACHE_OPTIONS:
+            if overrides.get(k) is not None:
+                options[k] = overrides[k]
+    return options
+
+
+def compile_cache_policies(config: Dict, defaults: Dict) -> Dict[str, Dict]:
+    """
+    Per-service "cache" option from config.json, opt-in:
+        "cache": true
+        "cache": {"enabled": true, "ttl": 600, "models": ["deepseek-chat"], "exclude_models": [...]}
+    Services without it are not cached.
+    """
+    policies = {}
+    if not defaults.get("enabled", True):
+        return policies
+    for key, service in (config or {}).items():
+        if not isinstance(service, dict):
+            continue
+        option = service.get("cache")
+        if option is True:
+            option = {"enabled": True}
+        if not isinstance(option, dict) or not option.get("enabled", True):
+            continue
+        models = option.get("models")
+        policies[key] = {
+            "ttl": float(option.get("ttl") or defaults["ttl"]),
+            "models": set(models) if isinstance(models, list) else None,
+            "exclude_models": set(option.get("exclude_models") or ()),
+        }
+    return policies
+
+
+def cache_ttl(policies: Dict[str, Dict], service_key: str, model: str) -> Optional[float]:
+    """TTL for (service, model) if caching is enabled for it, else None."""
+    policy = policies.get(service_key)
+    if policy is None or model in policy["exclude_models"]:
+        return None
+    if policy["models"] is not None and model not in policy["models"]:
+        return None
+    return policy["ttl"]
+
+
+def cache_key(service_key: str, body: Dict) -> str:
+    """Hash of the canonical request: sorted keys, compact separators, streaming/user fields dropped."""
+    canonical = {k: v for k, v in body.items() if k not in _IGNORED_FIELDS}
+    payload = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(f"{service_key}\n{payload}".encode("utf-8")).hexdigest()
+
+
+def raw_key(service_key: str, raw: bytes) -> str:
+    """Hash of the request bytes as sent; only byte-identical bodies match (no parse needed)."""
+    digest = hashlib.sha256(service_key.encode("utf-8") + b"\n")
+    digest.update(raw)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """LRU of complete upstream responses with per-entry TTL and a total byte budget."""
+
+    def __init__(self, options: Optional[Dict] = None):
+        self.options = options or dict(DEFAULT_CACHE_OPTIONS)
+        self._entries: "OrderedDict[str, Tuple[bytes, str, float]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def configure(self, options: Dict):
+        self.options = options
+        self._evict()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        content, media_type, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return content, media_type
+
+    def put(self, key: str, content: bytes, media_type: str, ttl: float):
+        if len(content) > int(self.options["max_entry_bytes"]):
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (content, media_type, time.monotonic() + ttl)
+        self._bytes += len(content)
+        self.stores += 1
+        self._evict()
+
+    def _drop(self, key: str):
+        content, _, _ = self._entries.pop(key)
+        self._bytes -= len(content)
+
+    def _evict(self):
+        max_bytes = int(self.options["max_bytes"])
+        max_entries = int(self.options["max_entries"])
+        while self._entries and (self._bytes > max_bytes or len(self._entries) > max_entries):
+            key = next(iter(self._entries))
+            self._drop(key)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": int(self.options["max_bytes"]),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "bypassed": self.bypassed,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Set
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 连接池默认值，可在 config.json 的服务里用 "pool" 字段覆盖：
+# "pool": {"max_connections": 100, "max_keepalive_connections": 20, "keepalive_expiry": 30, "http2": false}
+DEFAULT_POOL_OPTIONS = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30.0,
+    "http2": False,
+}
+
+# 配置变更后被替换的连接池：等待其中的请求结束后关闭；超过上限时间仍未结束则强制关闭
+RETIRE_CHECK_INTERVAL = 30.0
+RETIRE_MAX_WAIT = 900.0
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def _pool_options(service: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_POOL_OPTIONS)
+    overrides = (service or {}).get("pool")
+    if isinstance(overrides, dict):
+        for k in DEFAULT_POOL_OPTIONS:
+            if overrides.get(k) is not None:
+                options[k] = overrides[k]
+    return options
+
+
+class UpstreamClients:
+    """One long-lived httpx.AsyncClient per upstream service key (keep-alive + pooled connections)."""
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._options: Dict[str, Dict] = {}
+        # Clients replaced by sync() may still carry in-flight requests; they close once those finish
+        self._retired: Set[asyncio.Task] = set()
+
+    def _build(self, key: str, options: Dict) -> httpx.AsyncClient:
+        http2 = bool(options.get("http2"))
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning(f"HTTP/2 requested for {key} but the 'h2' package is not installed; falling back to HTTP/1.1")
+            http2 = False
+        limits = httpx.Limits(
+            max_connections=options.get("max_connections"),
+            max_keepalive_connections=options.get("max_keepalive_connections"),
+            keepalive_expiry=options.get("keepalive_expiry"),
+        )
+        return httpx.AsyncClient(limits=limits, http2=http2)
+
+    def get(self, key: str, service: Optional[Dict] = None) -> httpx.AsyncClient:
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            options = _pool_options(service)
+            client = self._build(key, options)
+            self._clients[key] = client
+            self._options[key] = options
+        return client
+
+    async def sync(self, config: Dict):
+        """Create clients for new services and rebuild the ones whose pool options changed."""
+        for key, service in (config or {}).items():
+            if not isinstance(service, dict):
+                continue
+            options = _pool_options(service)
+            current = self._clients.get(key)
+            if current is not None and self._options.get(key) == options:
+                continue
+            if current is not None:
+                self._retire(key, current)
+            self._clients[key] = self._build(key, options)
+            self._options[key] = options
+        for key in [k for k in self._clients if not isinstance((config or {}).get(k), dict)]:
+            self._retire(key, self._clients.pop(key))
+            self._options.pop(key, None)
+
+    def _retire(self, key: str, client: httpx.AsyncClient):
+        task = asyncio.create_task(self._close_when_idle(key, client))
+        self._retired.add(task)
+        task.add_done_callback(self._retired.discard)
+
+    async def _close_when_idle(self, key: str, client: httpx.AsyncClient):
+        deadline = time.monotonic() + RETIRE_MAX_WAIT
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(RETIRE_CHECK_INTERVAL)
+                state = _pool_state(client)
+                # Without pool introspection (other httpx versions), wait out the full grace period
+                if state is not None and state["in_use"] == 0 and state["waiting"] == 0:
+                    break
+        finally:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error(f"Error closing retired upstream client for {key}: {e}")
+
+    async def aclose(self):
+        # Cancelling a retirement closes its client right away
+        retired = list(self._retired)
+        for task in retired:
+            task.cancel()
+        await asyncio.gather(*retired, return_exceptions=True)
+        clients = list(self._clients.values())
+        self._clients.clear()
+        self._options.clear()
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error(f"Error closing upstream client: {e}")
+
+    def stats(self) -> Dict:
+        """Pool usage per service; the connection counts are None when httpx's pool cannot be inspected."""
+        result = {}
+        for key, client in self._clients.items():
+            state = _pool_state(client) or {"connections": None, "in_use": None, "idle": None, "waiting": None}
+            result[key] = {**state, "limits": self._options.get(key, {})}
+        return result
+
+
+def _pool_state(client: httpx.AsyncClient) -> Optional[Dict[str, int]]:
+    """Connection counts read from httpcore's pool (not public API); None if its layout is different."""
+    try:
+        pool = client._transport._pool
+        connections = list(pool.connections)
+        requests = list(pool._requests)
+        idle = sum(1 for c in connections if c.is_idle())
+        waiting = sum(1 for r in requests if r.is_queued())
+    except Exception:
+        return None
+    return {"connections": len(connections), "in_use": len(connections) - idle, "idle": idle, "waiting": waiting}
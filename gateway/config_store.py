@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """
+    Merged config compiled once per file version.
+    Treat `services` and `settings` as read-only: they are shared by every in-flight request.
+    """
+    version: int
+    services: Dict
+    loaded_at: float
+    settings: Dict = field(default_factory=dict)
+    compiled: Dict[str, Any] = field(default_factory=dict)
+
+
+class ConfigStore:
+    """
+    Holds the current ConfigSnapshot. The request path only reads `current()`;
+    reloads happen on save or when the watched files' mtime/inode/size change.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[..., Dict],
+        paths: List[str],
+        *,
+        settings_loader: Optional[Callable[..., Dict]] = None,
+        interval: float = 2.0,
+    ):
+        self._loader = loader
+        self._settings_loader = settings_loader
+        self._paths = list(paths)
+        self._interval = interval
+        self._snapshot = ConfigSnapshot(version=0, services={}, loaded_at=0.0)
+        self._signature: Optional[Tuple] = None
+        self._compilers: Dict[str, Callable[[ConfigSnapshot], Any]] = {}
+        self._listeners: List[Callable[[ConfigSnapshot], Awaitable[None]]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._reload_tasks: Set[asyncio.Task] = set()
+        self._lock = asyncio.Lock()
+
+    def current(self) -> ConfigSnapshot:
+        return self._snapshot
+
+    def signature(self) -> Optional[Tuple]:
+        """File signature the current snapshot was built from; equal signatures mean the same files."""
+        return self._signature
+
+    def register_compiler(self, name: str, compiler: Callable[[ConfigSnapshot], Any]):
+        """
+        Derived structures (routing tables, etc.) built once per snapshot, stored in snapshot.compiled[name].
+        Compilers run in registration order and may read earlier entries of snapshot.compiled.
+        """
+        self._compilers[name] = compiler
+
+    def add_listener(self, callback: Callable[[ConfigSnapshot], Awaitable[None]]):
+        self._listeners.append(callback)
+
+    def _file_signature(self) -> Tuple:
+        sig = []
+        for path in self._paths:
+            try:
+                st = os.stat(path)
+                sig.append((st.st_mtime_ns, st.st_ino, st.st_size))
+            except OSError:
+                sig.append(None)
+        return tuple(sig)
+
+    def _build(self, strict: bool) -> Tuple[ConfigSnapshot, Tuple]:
+        signature = self._file_signature()
+        services = self._loader(strict=strict)
+        settings = self._settings_loader(strict=strict) if self._settings_loader else {}
+        snapshot = ConfigSnapshot(
+            version=self._snapshot.version + 1,
+            services=services,
+            loaded_at=time.time(),
+            settings=settings,
+        )
+        for name, compiler in self._compilers.items():
+            snapshot.compiled[name] = compiler(snapshot)
+        return snapshot, signature
+
+    def reload(self, *, strict: bool = False) -> ConfigSnapshot:
+        """Synchronous load, used at startup before the event loop serves requests."""
+        snapshot, signature = self._build(strict)
+        self._snapshot = snapshot
+        self._signature = signature
+        return snapshot
+
+    async def areload(self, *, strict: bool = False) -> ConfigSnapshot:
+        async with self._lock:
+            snapshot, signature = await asyncio.to_thread(self._build, strict)
+            self._snapshot = snapshot
+            self._signature = signature
+        logger.info(f"Config reloaded (version {snapshot.version})")
+        for callback in self._listeners:
+            try:
+                await callback(snapshot)
+            except Exception as e:
+                logger.error(f"Config listener failed: {e}")
+        return snapshot
+
+    def request_reload(self):
+        """Schedule a reload from outside the watcher (e.g. another process saved config.json)."""
+        task = asyncio.create_task(self._reload_requested())
+        self._reload_tasks.add(task)
+        task.add_done_callback(self._reload_tasks.discard)
+
+    async def _reload_requested(self):
+        try:
+            await self.areload(strict=True)
+        except Exception as e:
+            logger.error(f"Config reload failed, keeping version {self._snapshot.version}: {e}")
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                if self._file_signature() != self._signature:
+                    # strict: a half-written or broken config.json keeps the last good snapshot
+                    await self.areload(strict=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Config reload failed, keeping version {self._snapshot.version}: {e}")
+                # Don't retry the same broken file on every tick
+                self._signature = self._file_signature()
+
+    def start(self):
+        if self._task is None and self._interval > 0:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        for task in list(self._reload_tasks):
+            task.cancel()
+        if self._reload_tasks:
+            await asyncio.gather(*self._reload_tasks, return_exceptions=True)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
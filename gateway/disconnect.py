@@ -0,0 +1,116 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional
+
+from starlette.requests import ClientDisconnect
+
+# 客户端断开检测：请求体读完后由中间件代为监听 http.disconnect，
+# 等待上游的调用（对话、图片 / 视频生成）随即取消，流式响应由 Starlette 在断开时停止读取上游
+
+PHASE_WAITING = "waiting"      # 还在等待上游响应头（尚未向客户端发送任何内容）
+PHASE_STREAMING = "streaming"  # 响应已开始，正在向客户端转发
+CLIENT_CLOSED_REQUEST = 499    # 记录到请求指标中的状态码（nginx 惯例）
+
+
+class ClientDisconnects:
+    """Clients that went away before their response was complete, by phase."""
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {PHASE_WAITING: 0, PHASE_STREAMING: 0}
+
+    def record(self, phase: str):
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counts)
+
+
+class DisconnectMiddleware:
+    """
+    Watches /v1/* requests for a client disconnect once the handler has read the request body.
+
+    The listener owns the receive channel from then on: scope state "disconnected" is an asyncio.Event
+    the handlers race their upstream calls against (cancel_on_disconnect), and later receive() calls
+    (StreamingResponse's own disconnect listener) are answered from the same event. Downstream sees
+    ASGI spec 2.3 so Starlette keeps listening for disconnects while streaming, whatever the server.
+    """
+
+    def __init__(self, app, disconnects: ClientDisconnects, prefix: str = "/v1/"):
+        self.app = app
+        self.disconnects = disconnects
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        disconnected = asyncio.Event()
+        listener: Optional[asyncio.Task] = None
+        response = {"started": False, "complete": False}
+
+        async def listen():
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    break
+            if not response["complete"]:
+                self.disconnects.record(PHASE_STREAMING if response["started"] else PHASE_WAITING)
+            disconnected.set()
+
+        async def receive_wrapper():
+            nonlocal listener
+            if listener is not None:
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request" and not message.get("more_body", False):
+                listener = asyncio.create_task(listen())
+            elif message["type"] == "http.disconnect":
+                disconnected.set()
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["started"] = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                response["complete"] = True
+            await send(message)
+
+        scope = dict(scope)
+        scope["asgi"] = {**(scope.get("asgi") or {}), "spec_version": "2.3"}
+        scope.setdefault("state", {})["disconnected"] = disconnected
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            if listener is not None:
+                listener.cancel()
+
+
+async def cancel_on_disconnect(
+    disconnected: Optional[asyncio.Event],
+    awaitable: Awaitable,
+    discard: Optional[Callable[[object], Awaitable]] = None,
+):
+    """
+    Await awaitable, cancelling it as soon as `disconnected` is set and raising ClientDisconnect.
+    As with hedging.race, the awaitable must clean up on CancelledError; a result that still arrived
+    is passed to discard().
+    """
+    if disconnected is None:
+        return await awaitable
+    task = asyncio.ensure_future(awaitable)
+    waiter = asyncio.ensure_future(disconnected.wait())
+    try:
+        await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        waiter.cancel()
+    if task.done():
+        return task.result()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    if not task.cancelled() and task.exception() is None and discard is not None:
+        await discard(task.result())
+    raise ClientDisconnect()
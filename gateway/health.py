@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# settings.json 的 "health" 段可覆盖
+DEFAULT_HEALTH_OPTIONS = {
+    "enabled": True,
+    "interval": 300.0,      # 健康服务的初始探测间隔（秒）
+    "min_interval": 30.0,   # 失败后的探测间隔
+    "max_interval": 900.0,  # 连续成功时间隔逐步放大到该值
+    "backoff": 1.5,
+    "jitter": 0.2,          # 间隔随机抖动比例，避免所有服务同时探测
+    "window": 20,           # 每个服务/账号保留的最近结果数
+    "timeout": 10.0,
+    "concurrency": 4,
+}
+
+ProbeFn = Callable[[str, Dict, Any, float], Awaitable[Dict]]
+ElectFn = Callable[[], Awaitable[bool]]
+
+
+def health_options(settings: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_HEALTH_OPTIONS)
+    overrides = (settings or {}).get("health")
+    if isinstance(overrides, dict):
+        for k in DEFAULT_HEALTH_OPTIONS:
+            if overrides.get(k) is not None:
+                options[k] = overrides[k]
+    return options
+
+
+class _ServiceHealth:
+    __slots__ = ("latest", "interval", "next_due", "cursor", "windows", "probing")
+
+    def __init__(self, interval: float):
+        self.latest: Optional[Dict] = None
+        self.interval = interval
+        self.next_due = 0.0
+        self.cursor = 0
+        self.windows: Dict[str, deque] = {}
+        self.probing: Optional[asyncio.Future] = None
+
+
+class HealthMonitor:
+    """
+    One background task probing every service on its own adaptive, jittered schedule:
+    the interval grows while a service stays healthy and drops to min_interval when it fails.
+    Each probe uses the next account in round-robin order, so windows are kept per service and token.
+
+    With several processes, `elect` decides whether this one runs the scheduled probes; the others
+    receive results through apply() instead of probing the same upstreams again.
+    """
+
+    def __init__(self, probe: ProbeFn, snapshot_fn: Callable[[], Any]):
+        self._probe = probe
+        self._snapshot_fn = snapshot_fn
+        self._services: Dict[str, _ServiceHealth] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # elect(): True while this process is the prober; None probes unconditionally (single process)
+        self.elect: Optional[ElectFn] = None
+        # on_result(key, result, interval): every probe result, shared with other processes
+        self.on_result: Optional[Callable[[str, Dict, float], None]] = None
+
+    def _options(self) -> Dict:
+        snapshot = self._snapshot_fn()
+        return snapshot.compiled.get("health_options") or health_options(snapshot.settings)
+
+    def _state(self, key: str, options: Dict) -> _ServiceHealth:
+        state = self._services.get(key)
+        if state is None:
+            state = _ServiceHealth(float(options["interval"]))
+            # Spread the first round of probes instead of firing them all at startup
+            state.next_due = time.monotonic() + random.uniform(0, float(options["min_interval"]))
+            self._services[key] = state
+        return state
+
+    def _jittered(self, interval: float, options: Dict) -> float:
+        jitter = float(options["jitter"])
+        return interval * random.uniform(1 - jitter, 1 + jitter)
+
+    async def probe(self, key: str, service: Dict, accounts: List[Tuple[str, Any]], timeout: Optional[float] = None) -> Dict:
+        """Probe now (coalescing with a probe already running for this service) and cache the result."""
+        options = self._options()
+        state = self._state(key, options)
+        if state.probing is None or state.probing.done():
+            state.probing = asyncio.ensure_future(self._run_probe(key, service, accounts, state, options, timeout))
+        await asyncio.shield(state.probing)
+        return self.cached(key)
+
+    async def _run_probe(
+        self,
+        key: str,
+        service: Dict,
+        accounts: List[Tuple[str, Any]],
+        state: _ServiceHealth,
+        options: Dict,
+        timeout: Optional[float] = None,
+    ) -> Dict:
+        tid, account = None, None
+        if accounts:
+            tid, account = accounts[state.cursor % len(accounts)]
+            state.cursor += 1
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(int(options["concurrency"]))
+        async with self._semaphore:
+            try:
+                result = await self._probe(key, service, account, float(timeout or options["timeout"]))
+            except Exception as e:
+                result = {"status": "error", "code": 0, "message": f"Probe failed: {e}"}
+
+        result = dict(result)
+        result["token_id"] = tid
+        if result.get("status") == "success":
+            interval = min(state.interval * float(options["backoff"]), float(options["max_interval"]))
+        else:
+            interval = float(options["min_interval"])
+        self._record(state, result, interval, options)
+        if self.on_result is not None:
+            self.on_result(key, result, interval)
+        return result
+
+    def _record(self, state: _ServiceHealth, result: Dict, interval: float, options: Dict):
+        tid = result.get("token_id")
+        window = state.windows.get(tid or "")
+        if window is None or window.maxlen != int(options["window"]):
+            window = deque(window or (), maxlen=int(options["window"]))
+            state.windows[tid or ""] = window
+        window.append((result.get("status") == "success", result.get("latency_ms"), result.get("checked_at")))
+        state.interval = interval
+        state.next_due = time.monotonic() + self._jittered(interval, options)
+        state.latest = result
+
+    def apply(self, key: str, result: Dict, interval: float):
+        """Probe result reported by another process; does not notify on_result again."""
+        options = self._options()
+        state = self._state(key, options)
+        self._record(state, result, interval, options)
+        # Keep the round-robin going if this process becomes the prober
+        state.cursor += 1
+
+    def cached(self, key: str) -> Optional[Dict]:
+        state = self._services.get(key)
+        if state is None or state.latest is None:
+            return None
+        result = dict(state.latest)
+        result["history"] = self._history(state)
+        result["next_probe_in_s"] = round(max(0.0, state.next_due - time.monotonic()), 1)
+        return result
+
+    @staticmethod
+    def _history(state: _ServiceHealth) -> Dict:
+        tokens = {}
+        total = ok = 0
+        for tid, window in state.windows.items():
+            succeeded = sum(1 for success, _, _ in window if success)
+            latencies = [latency for success, latency, _ in window if success and latency is not None]
+            tokens[tid or "-"] = {
+                "ok": succeeded,
+                "total": len(window),
+                "avg_latency_ms": int(sum(latencies) / len(latencies)) if latencies else None,
+            }
+            total += len(window)
+            ok += succeeded
+        return {"ok": ok, "total": total, "tokens": tokens}
+
+    async def _loop(self):
+        while True:
+            try:
+                snapshot = self._snapshot_fn()
+                options = self._options()
+                if not options.get("enabled", True):
+                    await asyncio.sleep(5.0)
+                    continue
+                accounts = snapshot.compiled.get("accounts") or {}
+                # The lease is renewed every pass; the loop never sleeps for more than 5s
+                prober = self.elect is None or await self.elect()
+                now = time.monotonic()
+                soonest = now + 5.0
+                for key, service in snapshot.services.items():
+                    if not isinstance(service, dict):
+                        continue
+                    if not prober:
+                        continue
+                    state = self._state(key, options)
+                    if state.next_due <= now and (state.probing is None or state.probing.done()):
+                        state.probing = asyncio.ensure_future(
+                            self._run_probe(key, service, accounts.get(key, []), state, options)
+                        )
+                    soonest = min(soonest, state.next_due)
+                for key in list(self._services):
+                    if key not in snapshot.services:
+                        del self._services[key]
+                await asyncio.sleep(max(0.5, soonest - time.monotonic()))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Health monitor error: {e}")
+                await asyncio.sleep(5.0)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        tasks = [s.probing for s in self._services.values() if s.probing is not None and not s.probing.done()]
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
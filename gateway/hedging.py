@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# settings.json 的 "hedging" 段（默认关闭）：
+# 首字节超过阈值仍未到达时，向另一个账号或等价服务再发一次请求，先出首字的一方胜出，另一方立即取消
+DEFAULT_HEDGING_OPTIONS = {
+    "enabled": False,
+    "delay": 0,            # 固定阈值（秒），0 表示按最近首字节耗时的分位数自动计算
+    "percentile": 0.95,
+    "min_delay": 1.0,      # 自动阈值的下限 / 上限
+    "max_delay": 15.0,
+    "window": 100,         # 每个服务 / 模型保留的首字节耗时样本数
+    "min_samples": 20,     # 样本不足且没有固定阈值时不对冲
+    "non_stream": False,   # 是否对非流式请求也启用
+    "models": {},          # 按模型的固定阈值，例如 {"deepseek-r1": 8}；设为 0 表示该模型不对冲
+}
+
+RECOMPUTE_EVERY = 10
+
+
+def hedging_options(settings: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_HEDGING_OPTIONS)
+    overrides = (settings or {}).get("hedging")
+    if isinstance(overrides, dict):
+        for k in DEFAULT_HEDGING_OPTIONS:
+            if overrides.get(k) is not None:
+                options[k] = overrides[k]
+    return options
+
+
+class _Samples:
+    __slots__ = ("window", "pending", "threshold")
+
+    def __init__(self, size: int):
+        self.window: deque = deque(maxlen=size)
+        self.pending = 0
+        self.threshold: Optional[float] = None
+
+
+class FirstByteTracker:
+    """Rolling first-byte times per (service, model); the percentile is recomputed every few samples."""
+
+    def __init__(self):
+        self._samples: Dict[Tuple[str, str], _Samples] = {}
+
+    def record(self, service_key: str, model: str, seconds: float, options: Dict):
+        key = (service_key, model)
+        samples = self._samples.get(key)
+        if samples is None or samples.window.maxlen != int(options["window"]):
+            samples = _Samples(int(options["window"]))
+            self._samples[key] = samples
+        samples.window.append(seconds)
+        samples.pending += 1
+        if samples.pending >= RECOMPUTE_EVERY or samples.threshold is None:
+            samples.pending = 0
+            if len(samples.window) >= int(options["min_samples"]):
+                ordered = sorted(samples.window)
+                index = min(len(ordered) - 1, int(len(ordered) * float(options["percentile"])))
+                samples.threshold = ordered[index]
+
+    def delay(self, service_key: str, model: str, options: Dict) -> Optional[float]:
+        """Seconds to wait for the first byte before hedging, or None to not hedge this request."""
+        per_model = (options.get("models") or {}).get(model)
+        if per_model is not None:
+            return float(per_model) or None
+        if options.get("delay"):
+            return float(options["delay"])
+        samples = self._samples.get((service_key, model))
+        if samples is None or samples.threshold is None:
+            return None
+        return min(max(samples.threshold, float(options["min_delay"])), float(options["max_delay"]))
+
+    def stats(self) -> Dict:
+        return {
+            f"{service_key}/{model}": {
+                "samples": len(samples.window),
+                "threshold_s": round(samples.threshold, 3) if samples.threshold is not None else None,
+            }
+            for (service_key, model), samples in self._samples.items()
+        }
+
+
+async def race(
+    primary: Callable[[], Awaitable],
+    secondary: Callable[[], Awaitable],
+    delay: float,
+    discard: Callable[[object], Awaitable],
+    on_hedge: Optional[Callable[[], None]] = None,
+) -> Tuple[object, bool]:
+    """
+    Run primary(); if it has not finished after delay seconds, also run secondary() and return the first
+    successful result as (result, hedge_won). The other attempt is cancelled, so attempts must clean up
+    (close responses, release leases) on CancelledError; a loser that still managed to finish is passed
+    to discard(). If both fail, the primary's error is raised.
+    """
+    first = asyncio.ensure_future(primary())
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+    except asyncio.CancelledError:
+        first.cancel()
+        raise
+    if done:
+        return first.result(), False
+
+    if on_hedge is not None:
+        on_hedge()
+    second = asyncio.ensure_future(secondary())
+    winner = None
+    try:
+        pending = {first, second}
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in (first, second):
+                if task in done and task.exception() is None:
+                    winner = task
+                    break
+    finally:
+        for task in (first, second):
+            if task is not winner and not task.done():
+                task.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        for task in (first, second):
+            if task is not winner and not task.cancelled() and task.exception() is None:
+                await discard(task.result())
+    if winner is None:
+        raise first.exception() if first.exception() is not None else second.exception()
+    return winner.result(), winner is second
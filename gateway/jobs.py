@@ -0,0 +1,438 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from storeutil import process_alive, remove_file
+
+logger = logging.getLogger(__name__)
+
+# settings.json 的 "jobs" 段：图片 / 视频异步任务（请求带 ?async=1 或 Prefer: respond-async）
+DEFAULT_JOB_OPTIONS = {
+    "enabled": True,
+    "workers": 4,            # 同时执行的任务数（修改后重启生效）
+    "queue_size": 200,       # 排队任务上限，满了返回 429
+    "retention_hours": 72,   # 已结束任务保留时长
+    "max_attempts": 3,       # 任务因进程退出或崩溃被重新排队的次数上限，超过后标记为失败
+}
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+TERMINAL_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED)
+
+POLL_INTERVAL = 1.0        # 空闲 worker 检查其他进程提交的任务的间隔（秒）
+HEARTBEAT_INTERVAL = 15.0  # 运行中任务的心跳间隔；超过 3 个间隔没有心跳的任务重新排队
+
+# execute(job) -> (status_code, content_type, body)
+ExecuteFn = Callable[[Dict], Awaitable[Tuple[int, str, bytes]]]
+
+_COLUMNS = (
+    "id", "kind", "service", "model", "status", "owner", "request", "body_file", "content_type",
+    "attempts", "status_code", "result", "error", "created_at", "started_at", "finished_at", "runner",
+    "heartbeat_at",
+)
+
+
+def job_options(settings: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_JOB_OPTIONS)
+    overrides = (settings or {}).get("jobs")
+    if isinstance(overrides, dict):
+        for k in DEFAULT_JOB_OPTIONS:
+            if overrides.get(k) is not None:
+                options[k] = overrides[k]
+    return options
+
+
+class JobStore:
+    """Jobs in a local SQLite file; every call runs on a worker thread behind one lock."""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    service TEXT NOT NULL,
+                    model TEXT,
+                    status TEXT NOT NULL,
+                    owner TEXT,
+                    request TEXT,
+                    body_file TEXT,
+                    content_type TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    status_code INTEGER,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    runner TEXT,
+                    heartbeat_at REAL
+                )
+                """
+            )
+            existing = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for column in ("runner TEXT", "heartbeat_at REAL"):
+                if column.split()[0] not in existing:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self._conn.commit()
+        return self._conn
+
+    def _run(self, sql: str, params: Tuple = (), fetch: bool = False):
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(sql, params)
+            rows = [dict(row) for row in cursor.fetchall()] if fetch else None
+            conn.commit()
+            return rows
+
+    async def execute(self, sql: str, params: Tuple = (), fetch: bool = False):
+        return await asyncio.to_thread(self._run, sql, params, fetch)
+
+    async def insert(self, job: Dict):
+        columns = [c for c in _COLUMNS if c in job]
+        await self.execute(
+            f"INSERT INTO jobs ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+            tuple(job[c] for c in columns),
+        )
+
+    async def update(self, job_id: str, **fields):
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        await self.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        rows = await self.execute("SELECT * FROM jobs WHERE id = ?", (job_id,), fetch=True)
+        return rows[0] if rows else None
+
+    async def claim(self, runner: str) -> Optional[Dict]:
+        """Atomically move the oldest queued job to running for this runner; safe across processes."""
+        now = time.time()
+        rows = await self.execute(
+            "UPDATE jobs SET status = ?, runner = ?, started_at = ?, heartbeat_at = ?, attempts = attempts + 1 "
+            "WHERE id = (SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1) AND status = ? "
+            "RETURNING *",
+            (STATUS_RUNNING, runner, now, now, STATUS_QUEUED, STATUS_QUEUED),
+            fetch=True,
+        )
+        return rows[0] if rows else None
+
+    async def heartbeat(self, job_ids: List[str]):
+        if job_ids:
+            await self.execute(
+                f"UPDATE jobs SET heartbeat_at = ? WHERE id IN ({', '.join('?' for _ in job_ids)})",
+                (time.time(), *job_ids),
+            )
+
+    async def requeue_orphans(
+        self, stale_before: float, alive: Callable[[str], bool], max_attempts: int
+    ) -> Tuple[int, List[Dict]]:
+        """
+        Put back running jobs whose process is gone (or silent since stale_before); a job that has
+        already been claimed max_attempts times is failed instead. Returns (requeued, failed jobs).
+        """
+        rows = await self.execute(
+            "SELECT id, runner, heartbeat_at, attempts, body_file FROM jobs WHERE status = ?",
+            (STATUS_RUNNING,),
+            fetch=True,
+        )
+        orphans = [r for r in rows if (r["heartbeat_at"] or 0) < stale_before or not alive(r["runner"])]
+        requeued, failed = 0, []
+        for job in orphans:
+            if job["attempts"] >= max_attempts:
+                await self.execute(
+                    "UPDATE jobs SET status = ?, runner = NULL, finished_at = ?, error = ? WHERE id = ? AND status = ?",
+                    (
+                        STATUS_FAILED,
+                        time.time(),
+                        f"Job was interrupted {job['attempts']} times without finishing",
+                        job["id"],
+                        STATUS_RUNNING,
+                    ),
+                )
+                failed.append(job)
+            else:
+                await self.execute(
+                    "UPDATE jobs SET status = ?, runner = NULL WHERE id = ? AND status = ?",
+                    (STATUS_QUEUED, job["id"], STATUS_RUNNING),
+                )
+                requeued += 1
+        return requeued, failed
+
+    async def queue_position(self, job: Dict) -> int:
+        rows = await self.execute(
+            "SELECT COUNT(*) AS n FROM jobs WHERE status = ? AND created_at <= ?",
+            (STATUS_QUEUED, job["created_at"]),
+            fetch=True,
+        )
+        return rows[0]["n"]
+
+    async def count(self, status: str) -> int:
+        rows = await self.execute("SELECT COUNT(*) AS n FROM jobs WHERE status = ?", (status,), fetch=True)
+        return rows[0]["n"]
+
+    async def expired(self, before: float) -> List[Dict]:
+        return await self.execute(
+            "SELECT id, body_file FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (before,), fetch=True
+        )
+
+    async def delete(self, job_id: str):
+        await self.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class JobFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Job queue is full")
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """
+    Bounded worker pool for long image/video calls. Submitting persists the job and returns at once;
+    workers claim queued jobs from the store, run execute(job) and store the upstream status and body.
+    Claiming goes through SQLite, so several gateway processes can share one jobs.db; jobs left running
+    by a process that stopped or died are queued again.
+    """
+
+    def __init__(self, store: JobStore, execute: ExecuteFn, options_fn: Callable[[], Dict]):
+        self._store = store
+        self._execute = execute
+        self._options_fn = options_fn
+        self._runner = str(os.getpid())
+        self._wake = asyncio.Event()
+        self._queued = 0
+        self._running: Dict[str, float] = {}
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._workers: List[asyncio.Task] = []
+        self._avg_run = 60.0
+
+    async def submit(self, kind: str, service: str, model: Optional[str], *, owner: Optional[str] = None,
+                     request: Optional[Dict] = None, body_file: Optional[str] = None,
+                     content_type: Optional[str] = None) -> Dict:
+        options = self._options_fn()
+        self._queued = await self._store.count(STATUS_QUEUED)
+        if self._queued >= int(options["queue_size"]):
+            workers = max(1, int(options["workers"]))
+            raise JobFull(max(1, int(self._queued * self._avg_run / workers)))
+        job = {
+            "id": f"job_{uuid.uuid4().hex}",
+            "kind": kind,
+            "service": service,
+            "model": model,
+            "status": STATUS_QUEUED,
+            "owner": owner,
+            "request": json.dumps(request, ensure_ascii=False) if request is not None else None,
+            "body_file": body_file,
+            "content_type": content_type,
+            "attempts": 0,
+            "created_at": time.time(),
+        }
+        await self._store.insert(job)
+        self._queued += 1
+        self._wake.set()
+        return job
+
+    def _notify(self, job_id: str):
+        event = self._changed.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        return await self._store.get(job_id)
+
+    async def progress(self, job: Dict) -> Dict:
+        """Live fields that are not stored: queue position or seconds running."""
+        if job["status"] == STATUS_QUEUED:
+            return {"queue_position": await self._store.queue_position(job)}
+        if job["status"] == STATUS_RUNNING and job.get("started_at"):
+            return {"running_for_s": round(max(0.0, time.time() - job["started_at"]), 1)}
+        return {}
+
+    async def watch(self, job_id: str, interval: float = 2.0) -> AsyncIterator[Dict]:
+        """Yield the job on every change (and every interval seconds) until it finishes."""
+        last = None
+        while True:
+            job = await self._store.get(job_id)
+            if job is None:
+                return
+            # Another process may be running it, so changes are also picked up by polling
+            state = (job["status"], job.get("started_at"), job.get("heartbeat_at"))
+            if state != last or job["status"] == STATUS_RUNNING:
+                last = state
+                yield job
+            if job["status"] in TERMINAL_STATUSES:
+                return
+            event = self._changed.setdefault(job_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            job = await self._store.claim(self._runner)
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._queued = max(0, self._queued - 1)
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job {job['id']} crashed: {e}")
+
+    async def _run(self, job: Dict):
+        job_id = job["id"]
+        started = time.monotonic()
+        self._running[job_id] = started
+        self._notify(job_id)
+        try:
+            status_code, content_type, content = await self._execute(job)
+        except asyncio.CancelledError:
+            # Gateway shutting down: leave it "running"; the next start (or another process) re-queues it
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            await self._finish(job, STATUS_FAILED, error=str(e) or e.__class__.__name__)
+        else:
+            status = STATUS_SUCCEEDED if 200 <= status_code < 300 else STATUS_FAILED
+            await self._finish(
+                job,
+                status,
+                status_code=status_code,
+                result=content.decode("utf-8", errors="replace"),
+                error=None if status == STATUS_SUCCEEDED else f"Upstream returned HTTP {status_code}",
+            )
+        finally:
+            self._running.pop(job_id, None)
+            self._avg_run = 0.2 * (time.monotonic() - started) + 0.8 * self._avg_run
+            self._notify(job_id)
+
+    async def _finish(self, job: Dict, status: str, **fields):
+        await self._store.update(job["id"], status=status, finished_at=time.time(), **fields)
+        if job.get("body_file"):
+            remove_file(job["body_file"])
+
+    async def _requeue_orphans(self):
+        def alive(runner: Optional[str]) -> bool:
+            if runner == self._runner:
+                # Before our workers start, our pid on a running job is a previous run of this container
+                return bool(self._tasks)
+            return process_alive(runner)
+
+        max_attempts = max(1, int(self._options_fn()["max_attempts"]))
+        requeued, failed = await self._store.requeue_orphans(time.time() - 3 * HEARTBEAT_INTERVAL, alive, max_attempts)
+        for job in failed:
+            logger.warning(f"Job {job['id']} failed after {job['attempts']} interrupted attempts")
+            if job.get("body_file"):
+                remove_file(job["body_file"])
+            self._notify(job["id"])
+        if requeued:
+            logger.info(f"Re-queued {requeued} jobs left running by a stopped gateway process")
+            self._wake.set()
+
+    async def _maintenance_loop(self):
+        ticks = 0
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self._store.heartbeat(list(self._running))
+                await self._requeue_orphans()
+                self._queued = await self._store.count(STATUS_QUEUED)
+                ticks += 1
+                if ticks % int(3600 / HEARTBEAT_INTERVAL) == 0:
+                    await self._cleanup()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job maintenance error: {e}")
+
+    async def _cleanup(self):
+        retention = float(self._options_fn()["retention_hours"]) * 3600
+        for job in await self._store.expired(time.time() - retention):
+            if job.get("body_file"):
+                remove_file(job["body_file"])
+            await self._store.delete(job["id"])
+
+    async def start(self):
+        await self._requeue_orphans()
+        await self._cleanup()
+        self._queued = await self._store.count(STATUS_QUEUED)
+        if self._queued:
+            logger.info(f"{self._queued} jobs waiting in the queue")
+        workers = max(1, int(self._options_fn()["workers"]))
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(workers)]
+        self._tasks = self._workers + [asyncio.create_task(self._maintenance_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._workers = []
+        self._store.close()
+
+    def stats(self) -> Dict:
+        """This process's view: running here, queued across all processes (refreshed periodically)."""
+        return {
+            "queued": self._queued,
+            "running": len(self._running),
+            "workers": len([t for t in self._workers if not t.done()]),
+            "avg_run_s": round(self._avg_run, 1),
+        }
+
+
+def job_view(job: Dict, progress: Optional[Dict] = None) -> Dict[str, Any]:
+    """Client-facing job object; the stored upstream body is returned as JSON when it parses."""
+    view = {
+        "id": job["id"],
+        "object": "job",
+        "kind": job["kind"],
+        "model": job["model"],
+        "status": job["status"],
+        "created_at": int(job["created_at"]),
+        "started_at": int(job["started_at"]) if job.get("started_at") else None,
+        "finished_at": int(job["finished_at"]) if job.get("finished_at") else None,
+        "attempts": job.get("attempts") or 0,
+    }
+    if progress:
+        view.update(progress)
+    if job["status"] in TERMINAL_STATUSES:
+        view["status_code"] = job.get("status_code")
+        result = job.get("result")
+        if result is not None:
+            try:
+                result = json.loads(result)
+            except ValueError:
+                pass
+        view["result"] = result
+        view["error"] = job.get("error")
+    return view
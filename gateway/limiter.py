@@ -0,0 +1,251 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from scheduler import TokenLease, TokenScheduler
+
+logger = logging.getLogger(__name__)
+
+# 排队优先级：数值越小越先获得并发名额
+PRIORITY_INTERACTIVE = 0  # 流式对话
+PRIORITY_DEFAULT = 1      # 非流式对话
+PRIORITY_BATCH = 2        # 图片 / 视频 / 批量任务
+
+# settings.json 的 "limits" 段为全局默认，config.json 服务里的 "limits" 字段可单独覆盖
+DEFAULT_LIMIT_OPTIONS = {
+    "enabled": True,
+    "max_concurrent": 0,     # 该服务的最大并发，0 表示不限
+    "per_token": 3,          # 单个账号的最大并发，0 表示不限
+    "queue_size": 100,       # 等待队列长度，满了直接返回 429
+    "queue_timeout": 30.0,   # 排队超过该时间返回 429
+}
+
+
+def limit_options(defaults: Optional[Dict], service: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_LIMIT_OPTIONS)
+    for overrides in (defaults, (service or {}).get("limits")):
+        if isinstance(overrides, dict):
+            for k in DEFAULT_LIMIT_OPTIONS:
+                if overrides.get(k) is not None:
+                    options[k] = overrides[k]
+    return options
+
+
+def compile_limit_options(config: Dict, defaults: Optional[Dict]) -> Dict[str, Dict]:
+    return {
+        key: limit_options(defaults, service)
+        for key, service in (config or {}).items()
+        if isinstance(service, dict)
+    }
+
+
+class LimitExceeded(HTTPException):
+    def __init__(self, service_key: str, reason: str, retry_after: int):
+        super().__init__(
+            status_code=429,
+            detail=f"Too many concurrent requests for {service_key}: {reason}",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("entries", "service", "future", "enqueued")
+
+    def __init__(self, entries, service):
+        self.entries = entries
+        self.service = service
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+
+
+class SlotLease:
+    """A concurrency slot for a service without accounts (no token to hand out); release() exactly once."""
+
+    __slots__ = ("service_key", "account", "started", "on_release", "_released")
+
+    def __init__(self, service_key: str):
+        self.service_key = service_key
+        self.account = None
+        self.started = time.monotonic()
+        self.on_release = None
+        self._released = False
+
+    @property
+    def token_id(self) -> Optional[str]:
+        return None
+
+    def release(self, status_code: Optional[int] = None, latency: Optional[float] = None):
+        if self._released:
+            return
+        self._released = True
+        if self.on_release is not None:
+            self.on_release(time.monotonic() - self.started)
+
+
+class _ServiceLimits:
+    __slots__ = ("options", "active", "queue", "waiting", "hold_ewma", "waits", "granted", "queued", "rejected", "timed_out")
+
+    def __init__(self, options: Dict):
+        self.options = options
+        self.active = 0
+        self.queue: List[Tuple[int, int, _Waiter]] = []
+        self.waiting = 0
+        self.hold_ewma = 1.0
+        self.waits: deque = deque(maxlen=200)
+        self.granted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+
+class ConcurrencyLimiter:
+    """
+    Caps in-flight requests per service and per token in front of the TokenScheduler.
+    When no slot is free the caller waits in a bounded priority queue (interactive streams first);
+    a full queue or an expired wait is answered with 429 and a Retry-After estimated from the
+    queue depth and the recent average hold time of a slot.
+    """
+
+    def __init__(self, scheduler: TokenScheduler):
+        self._scheduler = scheduler
+        self._services: Dict[str, _ServiceLimits] = {}
+        self._seq = itertools.count()
+
+    def _limits(self, service_key: str, options: Dict) -> _ServiceLimits:
+        limits = self._services.get(service_key)
+        if limits is None:
+            limits = _ServiceLimits(options)
+            self._services[service_key] = limits
+        else:
+            limits.options = options
+        return limits
+
+    def _has_capacity(self, service_key: str, limits: _ServiceLimits, entries: List[Tuple[str, Any]]) -> bool:
+        max_concurrent = int(limits.options["max_concurrent"])
+        if max_concurrent > 0 and limits.active >= max_concurrent:
+            return False
+        per_token = int(limits.options["per_token"])
+        return per_token <= 0 or not entries or self._scheduler.free_tokens(service_key, entries, per_token) > 0
+
+    def _grant(self, service_key: str, limits: _ServiceLimits, entries, service):
+        per_token = int(limits.options["per_token"])
+        if entries:
+            lease = self._scheduler.acquire(service_key, entries, service, max_inflight=per_token or None)
+        else:
+            lease = SlotLease(service_key)
+        limits.active += 1
+        limits.granted += 1
+        lease.on_release = lambda held: self._released(service_key, held)
+        return lease
+
+    def _retry_after(self, limits: _ServiceLimits, position: int, slots: int) -> int:
+        return max(1, math.ceil((position + 1) * limits.hold_ewma / max(1, slots)))
+
+    def _slots(self, limits: _ServiceLimits, entries) -> int:
+        per_token = int(limits.options["per_token"])
+        slots = per_token * len(entries) if per_token > 0 else 0
+        max_concurrent = int(limits.options["max_concurrent"])
+        if max_concurrent > 0:
+            slots = min(slots, max_concurrent) if slots else max_concurrent
+        return slots or 1
+
+    async def acquire(
+        self,
+        service_key: str,
+        entries: List[Tuple[str, Any]],
+        service: Optional[Dict],
+        options: Dict,
+        priority: int = PRIORITY_DEFAULT,
+    ) -> Optional[TokenLease]:
+        """
+        A TokenLease for services with accounts; a SlotLease for services without, which are still held
+        to max_concurrent and its queue. None only when limits are disabled for a service without accounts.
+        """
+        if not options.get("enabled", True):
+            return self._scheduler.acquire(service_key, entries, service)
+
+        limits = self._limits(service_key, options)
+        if not limits.waiting and self._has_capacity(service_key, limits, entries):
+            limits.waits.append(0.0)
+            return self._grant(service_key, limits, entries, service)
+
+        slots = self._slots(limits, entries)
+        if limits.waiting >= int(options["queue_size"]):
+            limits.rejected += 1
+            raise LimitExceeded(service_key, "queue is full", self._retry_after(limits, limits.waiting, slots))
+
+        waiter = _Waiter(entries, service)
+        heapq.heappush(limits.queue, (priority, next(self._seq), waiter))
+        limits.waiting += 1
+        limits.queued += 1
+        try:
+            return await asyncio.wait_for(waiter.future, float(options["queue_timeout"]))
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                return waiter.future.result()
+            limits.timed_out += 1
+            raise LimitExceeded(service_key, "timed out in queue", self._retry_after(limits, limits.waiting, slots))
+        except asyncio.CancelledError:
+            # Granted just as the caller went away: hand the slot straight back
+            if waiter.future.done() and not waiter.future.cancelled():
+                waiter.future.result().release()
+            raise
+        finally:
+            if waiter.future.cancelled():
+                limits.waiting -= 1
+
+    def _released(self, service_key: str, held: float):
+        limits = self._services.get(service_key)
+        if limits is None:
+            return
+        limits.active = max(0, limits.active - 1)
+        limits.hold_ewma = 0.2 * held + 0.8 * limits.hold_ewma
+        self._dispatch(service_key, limits)
+
+    def _dispatch(self, service_key: str, limits: _ServiceLimits):
+        while limits.queue:
+            _, _, waiter = limits.queue[0]
+            if waiter.future.done():
+                # Timed out or cancelled; already taken off the waiting count
+                heapq.heappop(limits.queue)
+                continue
+            if not self._has_capacity(service_key, limits, waiter.entries):
+                return
+            heapq.heappop(limits.queue)
+            limits.waiting -= 1
+            limits.waits.append(time.monotonic() - waiter.enqueued)
+            waiter.future.set_result(self._grant(service_key, limits, waiter.entries, waiter.service))
+
+    def configure(self, options: Dict[str, Dict]):
+        """Apply reloaded limits; raised limits release queued waiters right away."""
+        for service_key, limits in self._services.items():
+            if service_key in options:
+                limits.options = options[service_key]
+                self._dispatch(service_key, limits)
+
+    def stats(self) -> Dict:
+        result = {}
+        for service_key, limits in self._services.items():
+            waits = sorted(limits.waits)
+            result[service_key] = {
+                "active": limits.active,
+                "queue_depth": limits.waiting,
+                "max_concurrent": int(limits.options["max_concurrent"]),
+                "per_token": int(limits.options["per_token"]),
+                "granted": limits.granted,
+                "queued": limits.queued,
+                "rejected": limits.rejected,
+                "timed_out": limits.timed_out,
+                "wait_ms_p50": round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                "wait_ms_p95": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                "avg_hold_s": round(limits.hold_ewma, 2),
+            }
+        return result
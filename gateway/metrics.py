@@ -0,0 +1,252 @@
+import bisect
+import math
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Prometheus 文本格式的轻量实现：标签子项在首次使用时创建并缓存（标签字符串预先渲染），
+# 请求路径上只做字典查找和数值累加，不分配标签字典
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+TTFB_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0, 60.0)
+PROBE_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Sample = (suffix, rendered labels, value)
+Sample = Tuple[str, str, float]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _CounterChild:
+    __slots__ = ("labels", "value")
+
+    def __init__(self, labels: str):
+        self.labels = labels
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value: float):
+        self.value = value
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+
+class _HistogramChild:
+    __slots__ = ("labels", "bounds", "counts", "sum", "count")
+
+    def __init__(self, labels: str, bounds: Tuple[float, ...]):
+        self.labels = labels
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.bounds, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Family:
+    """Each kind sets `kind` and `child`; children are built as child(labels, *child_args)."""
+
+    kind: str
+    child: type
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), child_args: Tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._child_args = child_args
+        self._children: Dict[Tuple, object] = {}
+
+    def labels(self, *values):
+        """Child for these label values; bind it once and reuse it on the hot path."""
+        child = self._children.get(values)
+        if child is None:
+            child = self.child(render_labels(self.labelnames, values), *self._child_args)
+            self._children[values] = child
+        return child
+
+    def remove(self, *values):
+        self._children.pop(values, None)
+
+    def samples(self) -> Iterable[Sample]:
+        for child in list(self._children.values()):
+            yield "", child.labels, child.value
+
+
+class Counter(_Family):
+    kind = "counter"
+    child = _CounterChild
+
+
+class Gauge(_Family):
+    kind = "gauge"
+    child = _GaugeChild
+
+
+class Histogram(_Family):
+    kind = "histogram"
+    child = _HistogramChild
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, (self.buckets,))
+
+    def samples(self) -> Iterable[Sample]:
+        for child in list(self._children.values()):
+            base = child.labels[1:-1] + "," if child.labels else ""
+            cumulative = 0
+            for bound, count in zip(child.bounds, child.counts):
+                cumulative += count
+                yield "_bucket", f'{{{base}le="{_format_value(bound)}"}}', cumulative
+            yield "_bucket", f'{{{base}le="+Inf"}}', child.count
+            yield "_sum", child.labels, child.sum
+            yield "_count", child.labels, child.count
+
+
+class Registry:
+    """Metric families plus scrape-time collectors for state that already lives elsewhere."""
+
+    def __init__(self):
+        self._families: List[_Family] = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, Iterable[Sample]]]]] = []
+
+    def register(self, family: _Family) -> _Family:
+        self._families.append(family)
+        return family
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, str, str, Iterable[Sample]]]]):
+        """collector() yields (name, type, help, samples) at scrape time."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for family in self._families:
+            self._render_family(lines, family.name, family.kind, family.documentation, family.samples())
+        for collector in self._collectors:
+            for name, kind, documentation, samples in collector():
+                self._render_family(lines, name, kind, documentation, samples)
+        lines.append("")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _render_family(lines: List[str], name: str, kind: str, documentation: str, samples: Iterable[Sample]):
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{labels} {_format_value(value)}")
+
+
+class RouteMetrics:
+    """Children for one (service, model) pair, bound when the routing table is compiled."""
+
+    __slots__ = ("service", "model", "_requests", "_duration", "ttfb", "stream_duration", "bytes", "_by_status")
+
+    def __init__(self, service: str, model: str, requests: Counter, duration: Histogram, ttfb: Histogram, stream_duration: Histogram, streamed: Counter):
+        self.service = service
+        self.model = model
+        self._requests = requests
+        self._duration = duration
+        self.ttfb = ttfb.labels(service, model)
+        self.stream_duration = stream_duration.labels(service, model)
+        self.bytes = streamed.labels(service, model)
+        self._by_status: Dict[int, Tuple[_CounterChild, _HistogramChild]] = {}
+
+    def finished(self, status: int, duration: float):
+        children = self._by_status.get(status)
+        if children is None:
+            children = (
+                self._requests.labels(self.service, self.model, str(status)),
+                self._duration.labels(self.service, self.model, str(status)),
+            )
+            self._by_status[status] = children
+        children[0].inc()
+        children[1].observe(duration)
+
+
+class GatewayMetrics:
+    """All gateway metric families; route(service, model) returns the pre-bound RouteMetrics."""
+
+    OTHER_MODEL = "other"
+
+    def __init__(self):
+        self.registry = Registry()
+        r = self.registry
+        self.requests = r.counter("gateway_requests_total", "Requests by service, model and status.", ("service", "model", "status"))
+        self.duration = r.histogram(
+            "gateway_request_duration_seconds", "End-to-end request duration.", ("service", "model", "status")
+        )
+        self.ttfb = r.histogram(
+            "gateway_upstream_ttfb_seconds", "Time until upstream response headers.", ("service", "model"), TTFB_BUCKETS
+        )
+        self.stream_duration = r.histogram(
+            "gateway_stream_duration_seconds", "Duration of streamed response bodies.", ("service", "model")
+        )
+        self.streamed = r.counter("gateway_streamed_bytes_total", "Response bytes relayed to clients.", ("service", "model"))
+        self.probes = r.counter("gateway_probe_total", "Upstream health probes by result.", ("service", "result"))
+        self.probe_latency = r.histogram(
+            "gateway_probe_latency_seconds", "Upstream health probe latency.", ("service",), PROBE_BUCKETS
+        )
+        self.hedges = r.counter("gateway_hedges_total", "Hedged second requests launched and won.", ("service", "outcome"))
+        self._routes: Dict[str, Dict[str, RouteMetrics]] = {}
+
+    def _bind(self, service: str, model: str) -> RouteMetrics:
+        return RouteMetrics(service, model, self.requests, self.duration, self.ttfb, self.stream_duration, self.streamed)
+
+    def bind_routes(self, models: Iterable[Tuple[str, str]]):
+        """Pre-bind children for every configured (model, service) pair; called when the config is compiled."""
+        routes: Dict[str, Dict[str, RouteMetrics]] = {}
+        for model, service in models:
+            existing = self._routes.get(service, {}).get(model)
+            routes.setdefault(service, {})[model] = existing or self._bind(service, model)
+        self._routes = routes
+        return routes
+
+    def route(self, service: Optional[str], model: Optional[str]) -> RouteMetrics:
+        by_model = self._routes.get(service or "-")
+        if by_model is None:
+            by_model = self._routes[service or "-"] = {}
+        route = by_model.get(model)
+        if route is None:
+            # Unconfigured model names share one child per service to keep label cardinality bounded
+            route = by_model.get(self.OTHER_MODEL)
+            if route is None:
+                route = by_model[self.OTHER_MODEL] = self._bind(service or "-", self.OTHER_MODEL)
+        return route
+
+    def render(self) -> str:
+        return self.registry.render()
@@ -0,0 +1,134 @@
+import json
+import re
+from typing import Dict, Iterable, Optional
+
+# 只扫描 JSON 对象的顶层字段：路由需要的 model / stream 解码出来，其余值（消息、base64 图片等）
+# 只定位结束位置不解析，请求体原样转发给上游
+
+_WS = re.compile(rb"[ \t\r\n]*")
+_STRUCTURAL = re.compile(rb'["\[\]{}]')
+_SCALAR_END = re.compile(rb"[,}\]\s]")
+# Same literals json.loads accepts, including its NaN / Infinity / -Infinity extension
+_LITERAL = rb"true|false|null|NaN|-?Infinity|-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?"
+_SCALAR = re.compile(_LITERAL)
+# What may sit between two strings / brackets inside a container: separators and complete scalars
+_GAP = re.compile(rb"[ \t\r\n,:]*(?:(?:" + _LITERAL + rb")[ \t\r\n,:]*)*")
+_QUOTE, _BACKSLASH = 0x22, 0x5C
+_OPEN = (0x5B, 0x7B)
+_CLOSE = {0x5D: 0x5B, 0x7D: 0x7B}
+_SEPARATORS = (0x2C, 0x3A)
+
+
+def _string_end(raw: bytes, i: int) -> int:
+    """Index just past the string starting with the quote at i."""
+    j = i + 1
+    while True:
+        j = raw.find(b'"', j)
+        if j < 0:
+            raise ValueError("unterminated string")
+        k = j - 1
+        while raw[k] == _BACKSLASH:
+            k -= 1
+        if (j - k) % 2 == 1:
+            return j + 1
+        j += 1
+
+
+def _value_end(raw: bytes, i: int) -> int:
+    first = raw[i]
+    if first == _QUOTE:
+        return _string_end(raw, i)
+    if first in _OPEN:
+        opened = []
+        j = i
+        while True:
+            match = _STRUCTURAL.search(raw, j)
+            if match is None:
+                raise ValueError("unterminated container")
+            k = match.start()
+            # Most gaps are a lone "," or ":"; only longer ones need the literal check
+            if k > j and not (k == j + 1 and raw[j] in _SEPARATORS) and _GAP.fullmatch(raw, j, k) is None:
+                raise ValueError("invalid literal")
+            j = k
+            if raw[j] == _QUOTE:
+                j = _string_end(raw, j)
+                continue
+            if raw[j] in _OPEN:
+                opened.append(raw[j])
+            elif not opened or opened.pop() != _CLOSE[raw[j]]:
+                raise ValueError("mismatched bracket")
+            j += 1
+            if not opened:
+                return j
+    match = _SCALAR_END.search(raw, i)
+    end = match.start() if match else len(raw)
+    if end == i or _SCALAR.fullmatch(raw, i, end) is None:
+        raise ValueError("invalid literal")
+    return end
+
+
+def scan_fields(raw: bytes, names: Iterable[str]) -> Optional[Dict]:
+    """
+    Decode only the top-level members `names` of a JSON object (the last occurrence wins, as with a
+    full parse); every other value is skipped without being decoded. Returns None when raw is not a
+    well-formed JSON object at the top level, or a skipped value has a malformed literal or
+    mismatched brackets. The order of commas and colons inside nested values is not checked.
+    """
+    wanted = set(names)
+    found: Dict = {}
+    try:
+        i = _WS.match(raw, 0).end()
+        if raw[i] != 0x7B:
+            return None
+        i = _WS.match(raw, i + 1).end()
+        if raw[i] == 0x7D:
+            i += 1
+        else:
+            while True:
+                if raw[i] != _QUOTE:
+                    return None
+                end = _string_end(raw, i)
+                key = raw[i + 1:end - 1]
+                key = json.loads(raw[i:end]) if b"\\" in key else key.decode("utf-8")
+                i = _WS.match(raw, end).end()
+                if raw[i] != 0x3A:
+                    return None
+                i = _WS.match(raw, i + 1).end()
+                value_end = _value_end(raw, i)
+                if key in wanted:
+                    found[key] = json.loads(raw[i:value_end])
+                i = _WS.match(raw, value_end).end()
+                if raw[i] == 0x2C:
+                    i = _WS.match(raw, i + 1).end()
+                    continue
+                if raw[i] == 0x7D:
+                    i += 1
+                    break
+                return None
+        if _WS.match(raw, i).end() != len(raw):
+            return None
+    except (IndexError, ValueError, UnicodeDecodeError):
+        return None
+    return found
+
+
+class RawBody(dict):
+    """
+    The scanned top-level fields of a request body, plus the original bytes. Forward `raw` as-is when
+    nothing needs to change; parsed() decodes the full body once for attempts that must rewrite it.
+    """
+
+    __slots__ = ("raw", "_parsed")
+
+    def __init__(self, raw: bytes, fields: Dict):
+        super().__init__(fields)
+        self.raw = raw
+        self._parsed: Optional[Dict] = None
+
+    def parsed(self) -> Dict:
+        if self._parsed is None:
+            body = json.loads(self.raw)
+            if not isinstance(body, dict):
+                raise ValueError("body is not a JSON object")
+            self._parsed = body
+        return self._parsed
@@ -0,0 +1,155 @@
+import hashlib
+import json
+from typing import Dict, List, Optional, Tuple
+
+_TERMINAL = ""  # trie key marking "a configured model ends here"; never a real character
+
+
+class RoutingTable:
+    """
+    Precompiled model -> service index with the same precedence as _select_service_for_model:
+      1. first service (config order) listing the model, or a configured model that is a prefix of it
+      2. first service key contained in model.lower()
+      3. DeepSeek-R1 -> baidu (legacy)
+      4. first service key that is a prefix of the model
+    Configured models resolve through a dict; everything else walks a prefix trie once.
+    """
+
+    MAX_MEMO = 4096
+
+    def __init__(self, config: Dict):
+        self._entries: List[Tuple[str, Dict]] = []
+        self._trie: Dict = {}
+        self._exact: Dict[str, int] = {}
+        self._memo: Dict[str, Optional[int]] = {}
+        self._baidu: Optional[int] = None
+
+        for key, service in (config or {}).items():
+            if not isinstance(service, dict):
+                continue
+            index = len(self._entries)
+            self._entries.append((key, service))
+            if key == "baidu":
+                self._baidu = index
+            models = service.get("models")
+            if not isinstance(models, list):
+                continue
+            for svc_model in models:
+                if isinstance(svc_model, str):
+                    self._insert(svc_model, index)
+
+        # An exact model can still lose to an earlier service's shorter prefix, so resolve through the trie
+        for key, service in self._entries:
+            for svc_model in service.get("models") or []:
+                if isinstance(svc_model, str) and svc_model not in self._exact:
+                    self._exact[svc_model] = self._prefix_lookup(svc_model)
+
+    def _insert(self, model: str, index: int):
+        node = self._trie
+        for ch in model:
+            node = node.setdefault(ch, {})
+        if node.get(_TERMINAL) is None or index < node[_TERMINAL]:
+            node[_TERMINAL] = index
+
+    def _prefix_lookup(self, model: str) -> Optional[int]:
+        node = self._trie
+        best = node.get(_TERMINAL)
+        for ch in model:
+            node = node.get(ch)
+            if node is None:
+                break
+            index = node.get(_TERMINAL)
+            if index is not None and (best is None or index < best):
+                best = index
+        return best
+
+    def _fallback_lookup(self, model: str) -> Optional[int]:
+        lowered = model.lower()
+        for index, (key, _) in enumerate(self._entries):
+            if key in lowered:
+                return index
+        if model == "DeepSeek-R1" and self._baidu is not None:
+            return self._baidu
+        for index, (key, _) in enumerate(self._entries):
+            if model.startswith(key):
+                return index
+        return None
+
+    def lookup(self, model: str) -> Tuple[Optional[str], Optional[Dict]]:
+        if model in self._exact:
+            index = self._exact[model]
+        elif model in self._memo:
+            index = self._memo[model]
+        else:
+            index = self._prefix_lookup(model)
+            if index is None:
+                index = self._fallback_lookup(model)
+            if len(self._memo) >= self.MAX_MEMO:
+                self._memo.clear()
+            self._memo[model] = index
+        if index is None:
+            return None, None
+        return self._entries[index]
+
+    def models(self) -> List[Tuple[str, str]]:
+        """(model, service_key) for every configured model, in routing order."""
+        return [(model, self._entries[index][0]) for model, index in self._exact.items() if index is not None]
+
+
+class FailoverIndex:
+    """
+    Equivalent (service, model) pairs from settings.json "failover.groups", e.g.
+        "deepseek-r1": ["deepseek/deepseek-r1", "yuanbao/deepseek-r1", "baidu/DeepSeek-R1"]
+    alternatives(service, model) returns the other members in group order.
+    """
+
+    def __init__(self, settings: Dict, config: Dict):
+        self._alternatives: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
+        failover = (settings or {}).get("failover") or {}
+        if not isinstance(failover, dict) or failover.get("enabled") is False:
+            return
+        groups = failover.get("groups") or {}
+        for members in (groups.values() if isinstance(groups, dict) else groups):
+            pairs = []
+            for member in members or []:
+                if not isinstance(member, str) or "/" not in member:
+                    continue
+                key, model = member.split("/", 1)
+                if isinstance((config or {}).get(key), dict):
+                    pairs.append((key, model))
+            for pair in pairs:
+                alternatives = self._alternatives.setdefault(pair, [])
+                alternatives.extend(p for p in pairs if p != pair and p not in alternatives)
+
+    def alternatives(self, service_key: str, model: str) -> List[Tuple[str, str]]:
+        return self._alternatives.get((service_key, model), [])
+
+
+class ModelCatalog:
+    """
+    The OpenAI-style /v1/models listing for one config version, serialized once at compile time.
+    The weak ETag covers the (model, service) pairs only, so every worker process and every reload
+    that leaves the model list unchanged hands out the same tag.
+    """
+
+    def __init__(self, routing: RoutingTable, created: int):
+        self.entries = [
+            {"id": model, "object": "model", "created": created, "owned_by": key} for model, key in routing.models()
+        ]
+        self.by_id = {entry["id"]: entry for entry in self.entries}
+        self.body = json.dumps({"object": "list", "data": self.entries}, ensure_ascii=False).encode("utf-8")
+        digest = hashlib.sha1(
+            json.dumps([(e["id"], e["owned_by"]) for e in self.entries], ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        self.etag = f'W/"{digest[:20]}"'
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """If-None-Match check; the comparison is weak, as the spec requires for this header."""
+        if not if_none_match:
+            return False
+        tag = self.etag[2:]
+        for candidate in if_none_match.split(","):
+            candidate = candidate.strip()
+            if candidate == "*" or candidate.removeprefix("W/") == tag:
+                return True
+        return False
@@ -0,0 +1,243 @@
+import hashlib
+import json
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+POLICY_LEAST_INFLIGHT = "least_inflight"
+POLICY_EWMA = "ewma"
+
+# 可在 config.json 的服务里用 "scheduler" 字段覆盖：
+# "scheduler": {"policy": "least_inflight" | "ewma", "cooldown": 5, "auth_cooldown": 60, "max_cooldown": 600}
+DEFAULT_SCHEDULER_OPTIONS = {
+    "policy": POLICY_LEAST_INFLIGHT,
+    "cooldown": 5.0,
+    "auth_cooldown": 60.0,
+    "max_cooldown": 600.0,
+}
+
+EWMA_ALPHA = 0.2
+
+
+def token_id(account: Any) -> str:
+    """Stable, non-secret identifier for an account (plain token, cookie JSON string or Yuanbao dict)."""
+    if isinstance(account, dict):
+        raw = json.dumps(account, sort_keys=True, ensure_ascii=False)
+    else:
+        raw = str(account)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+
+def compile_accounts(config: Dict) -> Dict[str, List[Tuple[str, Any]]]:
+    """Per service: [(token_id, account), ...] for every non-empty configured account."""
+    result = {}
+    for key, service in (config or {}).items():
+        if not isinstance(service, dict):
+            continue
+        token_config = service.get("token")
+        if isinstance(token_config, list):
+            accounts = [a for a in token_config if a and (not isinstance(a, str) or a.strip())]
+        elif isinstance(token_config, str) and token_config.strip():
+            accounts = [token_config]
+        else:
+            accounts = []
+        result[key] = [(token_id(a), a) for a in accounts]
+    return result
+
+
+def scheduler_options(service: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_SCHEDULER_OPTIONS)
+    overrides = (service or {}).get("scheduler")
+    if isinstance(overrides, dict):
+        for k in DEFAULT_SCHEDULER_OPTIONS:
+            if overrides.get(k) is not None:
+                options[k] = overrides[k]
+    return options
+
+
+class TokenState:
+    __slots__ = ("token_id", "inflight", "ewma_ms", "failures", "quarantined_until", "last_status", "requests")
+
+    def __init__(self, tid: str):
+        self.token_id = tid
+        self.inflight = 0
+        self.ewma_ms: Optional[float] = None
+        self.failures = 0
+        self.quarantined_until = 0.0
+        self.last_status: Optional[int] = None
+        self.requests = 0
+
+
+class TokenLease:
+    """An account handed out by the scheduler; release() exactly once with the upstream outcome."""
+
+    __slots__ = ("_scheduler", "service_key", "state", "account", "options", "started", "on_release", "_released")
+
+    def __init__(self, scheduler: "TokenScheduler", service_key: str, state: TokenState, account: Any, options: Dict):
+        self._scheduler = scheduler
+        self.service_key = service_key
+        self.state = state
+        self.account = account
+        self.options = options
+        self.started = time.monotonic()
+        self.on_release = None
+        self._released = False
+
+    @property
+    def token_id(self) -> str:
+        return self.state.token_id
+
+    def release(self, status_code: Optional[int] = None, latency: Optional[float] = None):
+        """
+        status_code: upstream HTTP status, 0 for connection errors, None if the outcome is unknown
+        (e.g. the client went away) — unknown outcomes only free the in-flight slot.
+        """
+        if self._released:
+            return
+        self._released = True
+        if latency is None:
+            latency = time.monotonic() - self.started
+        self._scheduler._finish(self, status_code, latency)
+        if self.on_release is not None:
+            self.on_release(time.monotonic() - self.started)
+
+
+class TokenScheduler:
+    """
+    Health-aware account selection per service.
+    Tokens that answer 401/403/429/5xx (or fail to connect) are quarantined with an exponential
+    cool-down and re-admitted automatically once it expires.
+    """
+
+    def __init__(self):
+        self._states: Dict[str, Dict[str, TokenState]] = {}
+        # on_quarantine(service_key, token_id, seconds, failures): lets other gateway processes skip the token too
+        self.on_quarantine: Optional[Callable[[str, str, float, int], None]] = None
+
+    def _state(self, service_key: str, tid: str) -> TokenState:
+        states = self._states.setdefault(service_key, {})
+        state = states.get(tid)
+        if state is None:
+            state = TokenState(tid)
+            states[tid] = state
+        return state
+
+    def free_tokens(self, service_key: str, entries: List[Tuple[str, Any]], max_inflight: int) -> int:
+        return sum(1 for tid, _ in entries if self._state(service_key, tid).inflight < max_inflight)
+
+    def acquire(
+        self,
+        service_key: str,
+        entries: List[Tuple[str, Any]],
+        service: Optional[Dict] = None,
+        *,
+        max_inflight: Optional[int] = None,
+    ) -> Optional[TokenLease]:
+        """max_inflight skips tokens already at that many in-flight requests (checked by the caller beforehand)."""
+        if not entries:
+            return None
+        options = scheduler_options(service)
+        now = time.monotonic()
+        if max_inflight:
+            entries = [(tid, a) for tid, a in entries if self._state(service_key, tid).inflight < max_inflight] or entries
+        candidates = []
+        for tid, account in entries:
+            state = self._state(service_key, tid)
+            if state.quarantined_until <= now:
+                candidates.append((state, account))
+
+        if not candidates:
+            # Everything is cooling down: use the account that comes back first rather than failing outright
+            state, account = min(
+                ((self._state(service_key, tid), account) for tid, account in entries),
+                key=lambda item: item[0].quarantined_until,
+            )
+        elif len(candidates) == 1:
+            state, account = candidates[0]
+        elif options.get("policy") == POLICY_EWMA:
+            state, account = self._pick_ewma(candidates)
+        else:
+            lowest = min(s.inflight for s, _ in candidates)
+            state, account = random.choice([c for c in candidates if c[0].inflight == lowest])
+
+        state.inflight += 1
+        state.requests += 1
+        return TokenLease(self, service_key, state, account, options)
+
+    @staticmethod
+    def _pick_ewma(candidates):
+        known = [s.ewma_ms for s, _ in candidates if s.ewma_ms is not None]
+        # Unmeasured tokens get the best known latency so they are tried early
+        default_ms = min(known) if known else 1000.0
+        weights = [
+            1.0 / (max(s.ewma_ms if s.ewma_ms is not None else default_ms, 1.0) * (s.inflight + 1))
+            for s, _ in candidates
+        ]
+        return random.choices(candidates, weights=weights, k=1)[0]
+
+    def _finish(self, lease: TokenLease, status_code: Optional[int], latency: float):
+        state = lease.state
+        state.inflight = max(0, state.inflight - 1)
+        if status_code is None:
+            return
+        state.last_status = status_code
+        options = lease.options
+
+        if status_code == 0 or status_code in (401, 403, 429) or status_code >= 500:
+            state.failures += 1
+            base = float(options["auth_cooldown"] if status_code in (401, 403) else options["cooldown"])
+            cooldown = min(base * (2 ** (state.failures - 1)), float(options["max_cooldown"]))
+            state.quarantined_until = time.monotonic() + cooldown
+            logger.warning(
+                f"Token {state.token_id} of {lease.service_key} quarantined for {cooldown:.0f}s "
+                f"(status={status_code}, failures={state.failures})"
+            )
+            if self.on_quarantine is not None:
+                self.on_quarantine(lease.service_key, state.token_id, cooldown, state.failures)
+            return
+
+        state.failures = 0
+        state.quarantined_until = 0.0
+        latency_ms = latency * 1000.0
+        if state.ewma_ms is None:
+            state.ewma_ms = latency_ms
+        else:
+            state.ewma_ms = EWMA_ALPHA * latency_ms + (1 - EWMA_ALPHA) * state.ewma_ms
+
+    def apply_quarantine(self, service_key: str, tid: str, seconds: float, failures: int):
+        """Quarantine reported by another process; never shortens a local cool-down."""
+        state = self._state(service_key, tid)
+        state.failures = max(state.failures, failures)
+        state.quarantined_until = max(state.quarantined_until, time.monotonic() + seconds)
+
+    def prune(self, accounts: Dict[str, List[Tuple[str, Any]]]):
+        """Drop state for services/tokens that are no longer configured."""
+        for service_key in list(self._states):
+            live = {tid for tid, _ in accounts.get(service_key, [])}
+            states = self._states[service_key]
+            for tid in list(states):
+                if tid not in live and states[tid].inflight == 0:
+                    del states[tid]
+            if not states:
+                del self._states[service_key]
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        result = {}
+        for service_key, states in self._states.items():
+            result[service_key] = [
+                {
+                    "token_id": s.token_id,
+                    "inflight": s.inflight,
+                    "requests": s.requests,
+                    "ewma_ms": round(s.ewma_ms, 1) if s.ewma_ms is not None else None,
+                    "failures": s.failures,
+                    "quarantined_for_s": round(max(0.0, s.quarantined_until - now), 1),
+                    "last_status": s.last_status,
+                }
+                for s in states.values()
+            ]
+        return result
@@ -0,0 +1,224 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 多进程部署（GATEWAY_WORKERS > 1）时各进程共享的状态：API Key 令牌桶、账号隔离、熔断状态、配置版本和健康探测结果，
+# 存放在同一个 SQLite 文件中（WAL 模式），单进程部署时不使用
+SYNC_INTERVAL = 1.0      # 拉取其他进程事件的间隔（秒）
+EVENT_RETENTION = 300.0  # 事件保留时长（秒）
+BUSY_TIMEOUT = 0.2       # 写锁等待上限，超时则退回进程内状态，不阻塞事件循环
+LEASE_TTL = 30.0         # 单一进程承担的任务（如健康探测）的租约时长，持有者退出后其他进程在此时间内接手
+
+EventCallback = Callable[[str, Dict], None]
+
+
+class SharedState:
+    """
+    Cross-process state in one SQLite file.
+
+    Token buckets are updated in one short write transaction per request, run on a worker thread.
+    Everything else is an event log: a process publishes a state change (a token quarantined, a
+    breaker opened, config saved) and the other processes pick it up within SYNC_INTERVAL and apply
+    it to their own in-memory copy, so the request path keeps reading local state. publish() only
+    queues the event; a background task writes queued events in one transaction off the event loop.
+    Work only one process should do (health probing) is guarded by a lease row the holder keeps renewing.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._origin = str(os.getpid())
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._last_seq = 0
+        self._subscribers: Dict[str, List[EventCallback]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._pending: List[Tuple[str, str, str, float]] = []
+        self._flusher: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self._path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Soft state: losing the last few writes on power loss is fine, an fsync per request is not
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key_id TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, "
+                "requests INTEGER NOT NULL DEFAULT 0, rejected INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, key TEXT NOT NULL, "
+                "data TEXT NOT NULL, origin TEXT NOT NULL, at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self._conn = conn
+            row = conn.execute("SELECT MAX(seq) FROM events").fetchone()
+            # Only changes made after this process started are replayed
+            self._last_seq = row[0] or 0
+        return self._conn
+
+    def take(self, key_id: str, rpm: float, burst: float) -> Tuple[bool, float]:
+        """Take one token from the shared bucket for key_id; returns (admitted, tokens left)."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # IMMEDIATE takes the write lock up front so two processes cannot both spend the last token
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key_id = ?", (key_id,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rpm / 60.0)
+                admitted = tokens >= 1.0
+                if admitted:
+                    tokens -= 1.0
+                conn.execute(
+                    "INSERT INTO buckets (key_id, tokens, updated, requests, rejected) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(key_id) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated, "
+                    "requests = requests + excluded.requests, rejected = rejected + excluded.rejected",
+                    (key_id, tokens, now, int(admitted), int(not admitted)),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return admitted, tokens
+
+    def buckets(self) -> Dict[str, Dict]:
+        with self._lock:
+            rows = self._connect().execute("SELECT key_id, tokens, requests, rejected FROM buckets").fetchall()
+        return {key_id: {"tokens": tokens, "requests": requests, "rejected": rejected} for key_id, tokens, requests, rejected in rows}
+
+    def hold(self, name: str, ttl: float = LEASE_TTL) -> bool:
+        """Take or renew the lease `name` for this process; False while another live process holds it."""
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = conn.execute("SELECT holder, expires FROM leases WHERE name = ?", (name,)).fetchone()
+                    held = row is None or row[0] == self._origin or row[1] < now
+                    if held:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO leases (name, holder, expires) VALUES (?, ?, ?)",
+                            (name, self._origin, now + ttl),
+                        )
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            # The holder renews well before the lease runs out; a busy database just means "not this round"
+            logger.warning(f"Could not renew shared lease {name}: {e}")
+            return False
+        return held
+
+    def publish(self, kind: str, key: str, data: Dict):
+        """Queue an event for the other processes; safe to call from the request path."""
+        self._pending.append((kind, key, json.dumps(data), time.time()))
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_events(self._take_pending())
+            return
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush())
+
+    def _take_pending(self) -> List[Tuple[str, str, str, float]]:
+        pending, self._pending = self._pending, []
+        return pending
+
+    def _write_events(self, events: List[Tuple[str, str, str, float]]):
+        if not events:
+            return
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute("BEGIN")
+                try:
+                    conn.executemany(
+                        "INSERT INTO events (kind, key, data, origin, at) VALUES (?, ?, ?, ?, ?)",
+                        [(kind, key, data, self._origin, at) for kind, key, data, at in events],
+                    )
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            logger.warning(f"Could not publish {len(events)} shared state events: {e}")
+
+    async def _flush(self):
+        # Events queued while a write is in progress go out together in the next one, in order
+        while self._pending:
+            await asyncio.to_thread(self._write_events, self._take_pending())
+
+    def subscribe(self, kind: str, callback: EventCallback):
+        """callback(key, data) runs on the event loop for changes published by other processes."""
+        self._subscribers.setdefault(kind, []).append(callback)
+
+    def _poll(self) -> List[Tuple[str, str, Dict]]:
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT seq, kind, key, data, origin FROM events WHERE seq > ? ORDER BY seq", (self._last_seq,)
+            ).fetchall()
+            if rows:
+                self._last_seq = rows[-1][0]
+        return [(kind, key, json.loads(data)) for _, kind, key, data, origin in rows if origin != self._origin]
+
+    def _prune(self):
+        with self._lock:
+            self._connect().execute("DELETE FROM events WHERE at < ?", (time.time() - EVENT_RETENTION,))
+
+    async def _loop(self):
+        ticks = 0
+        while True:
+            await asyncio.sleep(SYNC_INTERVAL)
+            try:
+                for kind, key, data in await asyncio.to_thread(self._poll):
+                    for callback in self._subscribers.get(kind, []):
+                        try:
+                            callback(key, data)
+                        except Exception as e:
+                            logger.error(f"Shared {kind} event for {key} failed: {e}")
+                ticks += 1
+                if ticks % 60 == 0:
+                    await asyncio.to_thread(self._prune)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Shared state sync error: {e}")
+
+    def start(self):
+        with self._lock:
+            self._connect()
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._flusher is not None:
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        self._write_events(self._take_pending())
+        with self._lock:
+            if self._conn is not None:
+                # Hand leases over right away instead of making the other processes wait out the TTL
+                try:
+                    self._conn.execute("DELETE FROM leases WHERE holder = ?", (self._origin,))
+                except sqlite3.Error as e:
+                    logger.warning(f"Could not release shared leases: {e}")
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from starlette.background import BackgroundTask
+from starlette.requests import ClientDisconnect
+from starlette.responses import Response, StreamingResponse
+
+from disconnect import CLIENT_CLOSED_REQUEST, cancel_on_disconnect
+
+logger = logging.getLogger(__name__)
+
+# settings.json 的 "singleflight" 段为全局默认，config.json 服务里的 "singleflight" 字段可单独覆盖
+DEFAULT_SINGLEFLIGHT_OPTIONS = {
+    "enabled": True,   # 合并相同的非流式请求
+    "stream": False,   # 是否同时合并相同的流式请求（输出扇出给所有等待的客户端）
+    "max_buffer_kb": 1024,  # 响应超过该大小后不再接受新的合并请求，已被所有客户端读取的部分随即释放
+}
+
+
+def singleflight_options(defaults: Optional[Dict], service: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_SINGLEFLIGHT_OPTIONS)
+    for overrides in (defaults, (service or {}).get("singleflight")):
+        if isinstance(overrides, dict):
+            for k in DEFAULT_SINGLEFLIGHT_OPTIONS:
+                if overrides.get(k) is not None:
+                    options[k] = overrides[k]
+    return options
+
+
+def compile_singleflight_options(config: Dict, defaults: Optional[Dict]) -> Dict[str, Dict]:
+    return {
+        key: singleflight_options(defaults, service)
+        for key, service in (config or {}).items()
+        if isinstance(service, dict)
+    }
+
+
+class _Flight:
+    """
+    One upstream call whose response head and body chunks are replayed to every subscriber.
+
+    Chunks are kept from the start while late joiners may still arrive. Once the body outgrows
+    max_buffer the flight stops accepting joiners and only keeps what some subscriber has not read yet.
+    """
+
+    def __init__(self, max_buffer: int):
+        self.status_code = 200
+        self.headers: Dict[str, str] = {}
+        self.media_type: Optional[str] = None
+        self.chunks: List[bytes] = []
+        self.base = 0  # absolute index of chunks[0]
+        self.buffered = 0
+        self.max_buffer = max_buffer
+        self.joinable = True
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.positions: Dict[int, int] = {}  # subscriber -> absolute index of its next chunk
+        self.task: Optional[asyncio.Task] = None
+        self.head_ready = asyncio.Event()
+        self._changed = asyncio.Event()
+        self._next_subscriber = 0
+
+    @property
+    def subscribers(self) -> int:
+        return len(self.positions)
+
+    def subscribe(self) -> int:
+        subscriber = self._next_subscriber
+        self._next_subscriber += 1
+        self.positions[subscriber] = self.base
+        return subscriber
+
+    def unsubscribe(self, subscriber: int):
+        if self.positions.pop(subscriber, None) is None:
+            return
+        # Every client left: stop spending upstream quota on nobody
+        if not self.positions and not self.done and self.task is not None:
+            self.task.cancel()
+        self._trim()
+
+    async def release(self, subscriber: int):
+        self.unsubscribe(subscriber)
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _trim(self):
+        if self.joinable:
+            return
+        keep_from = min(self.positions.values(), default=self.base + len(self.chunks))
+        if keep_from > self.base:
+            del self.chunks[: keep_from - self.base]
+            self.base = keep_from
+
+    def feed(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if chunk:
+            self.chunks.append(chunk)
+            self.buffered += len(chunk)
+            if self.joinable and self.buffered > self.max_buffer:
+                self.joinable = False
+            self._trim()
+            self._wake()
+
+    def finish(self, error: Optional[BaseException] = None):
+        if self.error is None:
+            self.error = error
+        self.done = True
+        self.head_ready.set()
+        self._wake()
+
+    async def replay(self, subscriber: int) -> AsyncIterator[bytes]:
+        while True:
+            changed = self._changed
+            while subscriber in self.positions and self.positions[subscriber] < self.base + len(self.chunks):
+                position = self.positions[subscriber]
+                chunk = self.chunks[position - self.base]
+                self.positions[subscriber] = position + 1
+                self._trim()
+                yield chunk
+            if self.done:
+                if self.error is not None:
+                    # Failed after the head went out; abort like a direct relay would
+                    raise RuntimeError(f"Upstream response aborted: {self.error}")
+                return
+            await changed.wait()
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight requests: the first caller's response is produced by a background task
+    and every caller with the same key, including the first, streams it from the shared buffer.
+    A late joiner replays what was already sent and then follows live.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(
+        self,
+        key: str,
+        produce: Callable[[], Awaitable[Response]],
+        disconnected: Optional[asyncio.Event] = None,
+        max_buffer: int = DEFAULT_SINGLEFLIGHT_OPTIONS["max_buffer_kb"] * 1024,
+    ) -> Response:
+        flight = self._flights.get(key)
+        if flight is not None and not flight.joinable:
+            # Too much of the body has been released to replay it from the start: start a new call
+            del self._flights[key]
+            flight = None
+        joined = flight is not None
+        if flight is None:
+            flight = _Flight(max_buffer)
+            self._flights[key] = flight
+            self.leaders += 1
+            flight.task = asyncio.create_task(self._drive(key, flight, produce))
+        else:
+            self.coalesced += 1
+        subscriber = flight.subscribe()
+
+        try:
+            await cancel_on_disconnect(disconnected, flight.head_ready.wait())
+        except ClientDisconnect:
+            # The last waiting client left before the upstream answered: cancel the shared call
+            flight.unsubscribe(subscriber)
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+        if isinstance(flight.error, HTTPException):
+            flight.unsubscribe(subscriber)
+            raise HTTPException(
+                status_code=flight.error.status_code,
+                detail=flight.error.detail,
+                headers=flight.error.headers,
+            )
+        headers = dict(flight.headers)
+        if joined:
+            headers["X-Gateway-Coalesced"] = "1"
+        return StreamingResponse(
+            flight.replay(subscriber),
+            status_code=flight.status_code,
+            media_type=flight.media_type,
+            headers=headers,
+            # Runs even if the client left before the replay started, so the subscriber is always released
+            background=BackgroundTask(flight.release, subscriber),
+        )
+
+    async def _drive(self, key: str, flight: _Flight, produce: Callable[[], Awaitable[Response]]):
+        response = None
+        try:
+            response = await produce()
+            flight.status_code = response.status_code
+            flight.media_type = response.media_type
+            flight.headers = {
+                k: v for k, v in response.headers.items() if k.lower() not in ("content-length", "content-type")
+            }
+            flight.head_ready.set()
+            if isinstance(response, StreamingResponse):
+                async for chunk in response.body_iterator:
+                    flight.feed(chunk)
+            else:
+                flight.feed(response.body)
+            flight.finish()
+        except asyncio.CancelledError:
+            flight.finish(HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request"))
+        except HTTPException as e:
+            flight.finish(e)
+        except Exception as e:
+            logger.error(f"Coalesced request failed: {e}")
+            flight.finish(HTTPException(status_code=502, detail=f"Upstream error: {e}"))
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if response is not None:
+                body_iterator = getattr(response, "body_iterator", None)
+                if body_iterator is not None and hasattr(body_iterator, "aclose"):
+                    await body_iterator.aclose()
+                if response.background is not None:
+                    await response.background()
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": len(self._flights),
+            "waiting": sum(max(0, f.subscribers - 1) for f in self._flights.values()),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,162 @@
+import asyncio
+import codecs
+import logging
+import re
+from typing import AsyncIterator, Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# 服务配置中的 "sse" 字段：
+#   "passthrough"（默认）: 上游输出规范的 SSE，原样按字节转发
+#   "rewrite": 上游不规范（裸 JSON 行、缺少 data: 前缀等），逐行改写
+SSE_PASSTHROUGH = "passthrough"
+SSE_REWRITE = "rewrite"
+
+# settings.json 的 "heartbeat" 段为全局默认，config.json 服务里的 "heartbeat" 字段可单独覆盖：
+# 流式请求在首个数据到达之前，每隔 interval 秒发送一行 SSE 注释 ": ping"，避免宝塔 / Nginx 和客户端按空闲超时断开
+DEFAULT_HEARTBEAT_OPTIONS = {
+    "enabled": True,
+    "interval": 15,   # 秒；0 表示不发送
+}
+PING = b": ping\n\n"
+
+_SSE_FIELD_PREFIXES = (b"data:", b"event:", b"id:", b"retry:", b":", b"\n", b"\r")
+_LINE_SPLIT = re.compile(r"\r\n|\r|\n")
+
+
+def heartbeat_options(defaults: Optional[Dict], service: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_HEARTBEAT_OPTIONS)
+    for overrides in (defaults, (service or {}).get("heartbeat")):
+        if isinstance(overrides, dict):
+            for k in DEFAULT_HEARTBEAT_OPTIONS:
+                if overrides.get(k) is not None:
+                    options[k] = overrides[k]
+    return options
+
+
+def compile_heartbeat_options(config: Dict, defaults: Optional[Dict]) -> Dict[str, Dict]:
+    return {
+        key: heartbeat_options(defaults, service)
+        for key, service in (config or {}).items()
+        if isinstance(service, dict)
+    }
+
+
+def heartbeat_interval(options: Optional[Dict]) -> float:
+    """Seconds between pings for a service's compiled options; 0 when heartbeats are off."""
+    options = options or DEFAULT_HEARTBEAT_OPTIONS
+    if not options.get("enabled", True):
+        return 0.0
+    try:
+        return max(0.0, float(options.get("interval") or 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def looks_like_sse(chunk: bytes) -> bool:
+    return chunk.lstrip(b" \t").startswith(_SSE_FIELD_PREFIXES)
+
+
+async def iter_text_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream into lines (same line endings as httpx aiter_lines)."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    async for chunk in chunks:
+        text = pending + decoder.decode(chunk)
+        # A trailing "\r" may be the first half of "\r\n"; hold it until the next chunk
+        held = ""
+        if text.endswith("\r"):
+            text, held = text[:-1], "\r"
+        lines = _LINE_SPLIT.split(text)
+        pending = lines.pop() + held
+        for line in lines:
+            yield line
+    pending += decoder.decode(b"", final=True)
+    pending = pending.rstrip("\r")
+    if pending:
+        yield pending
+
+
+async def rewrite_sse_lines(lines: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Line-rewriting path for upstreams flagged as non-conforming."""
+    async for line in lines:
+        if not line:
+            continue
+        # Ensure we forward SSE lines correctly
+        # Some upstream services might return raw JSON in chunks without "data: " prefix if not strict SSE
+
+        if line.startswith("data:") or line.startswith("event:") or line.startswith(":"):
+            yield f"{line}\n\n"
+        elif line.strip() == "[DONE]":
+            yield "data: [DONE]\n\n"
+        else:
+            # Fallback: wrap raw content in data
+            # Only if it looks like content
+            if line.strip():
+                 # CAUTION: If the upstream sends partial JSON or raw text, we might be breaking it by wrapping in data:
+                 # If line is just "}", it might be part of a previous JSON.
+                 yield f"data: {line}\n\n"
+
+
+async def prepend_chunk(first: bytes, rest: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    yield first
+    async for chunk in rest:
+        yield chunk
+
+
+async def passthrough_sse(chunks: AsyncIterator[bytes], *, label: str = "") -> AsyncIterator[Union[bytes, str]]:
+    """
+    Forward upstream bytes unchanged as they arrive. Framing checks are limited to:
+    - the first non-empty chunk must look like SSE, otherwise the stream falls back to rewrite_sse_lines;
+    - a stream that ends mid-event gets its terminating blank line so the client sees the last event.
+    """
+    chunks = chunks.__aiter__()
+    first = b""
+    async for chunk in chunks:
+        if chunk:
+            first = chunk
+            break
+    if not first:
+        return
+    if not looks_like_sse(first):
+        logger.warning(f"Upstream {label or '-'} did not start with SSE framing; rewriting lines")
+        async for event in rewrite_sse_lines(iter_text_lines(prepend_chunk(first, chunks))):
+            yield event
+        return
+
+    previous, last = b"", first
+    yield first
+    async for chunk in chunks:
+        if chunk:
+            previous, last = last, chunk
+            yield chunk
+    tail = (previous + last)[-4:] if len(last) < 4 else last[-4:]
+    if tail.endswith((b"\n\n", b"\r\r", b"\r\n\r\n")):
+        return
+    yield b"\n" if tail.endswith((b"\n", b"\r")) else b"\n\n"
+
+
+async def heartbeat(events: AsyncIterator, interval: float) -> AsyncIterator[Union[bytes, str]]:
+    """
+    Yield `events`, sending PING every `interval` seconds while waiting for the first one. Once data
+    is flowing the events pass straight through: pings never land between (or inside) data events.
+    """
+    events = events.__aiter__()
+    if interval > 0:
+        pending = asyncio.ensure_future(events.__anext__())
+        try:
+            while True:
+                done, _ = await asyncio.wait({pending}, timeout=interval)
+                if done:
+                    break
+                yield PING
+        finally:
+            if not pending.done():
+                pending.cancel()
+        try:
+            first = pending.result()
+        except StopAsyncIteration:
+            return
+        yield first
+    async for event in events:
+        yield event
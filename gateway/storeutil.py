@@ -0,0 +1,28 @@
+import logging
+import os
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# SQLite 持久化队列（jobs、batches）共用的辅助函数：判断领取任务的进程是否存活、删除落盘文件
+
+
+def process_alive(runner: Optional[str]) -> bool:
+    """Whether the process whose pid is stored as a job's / batch's runner is still running."""
+    try:
+        os.kill(int(runner), 0)
+    except (TypeError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def remove_file(path: str):
+    """Delete a spooled or result file; a missing file is not an error."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not remove {path}: {e}")
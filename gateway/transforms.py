@@ -0,0 +1,171 @@
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+AUTH_BEARER = "bearer"          # Authorization: Bearer <token>
+AUTH_RAW = "raw"                # Authorization: <token>
+AUTH_RAW_COOKIE = "raw_cookie"  # JSON / BDUSS Cookie 原样放入 Authorization，其他 Token 用 Bearer
+AUTH_NONE = "none"
+
+# config.json 服务里的 "transforms" 字段，按键覆盖下面的内置规则：
+# "transforms": {
+#     "drop": ["tools", "tool_choice"],                     # 删除字段
+#     "clamp": {"temperature": {"min": 0, "max": 1},         # 数值限制在范围内
+#               "max_tokens": {"min": 1, "drop": true}},     # drop: 超出范围时删除而不是截断
+#     "set": {"stream_options": {"include_usage": true}},   # 强制设置字段
+#     "inject_account": true,                               # 账号对象中 token 以外的字段写入请求体（元宝）
+#     "auth": "bearer",                                     # bearer / raw / raw_cookie / none
+#     "headers": {"X-Source": "gateway"}                    # 额外请求头
+# }
+DEFAULT_TRANSFORMS = {
+    "drop": [],
+    "clamp": {},
+    "set": {},
+    "inject_account": True,
+    "auth": AUTH_BEARER,
+    "headers": {},
+}
+
+# 原先写死在代码中的按服务处理，作为未配置 transforms 时的默认值
+BUILTIN_TRANSFORMS = {
+    "qwen": {
+        "drop": ["stream_options", "response_format", "tools", "tool_choice", "functions", "function_call"],
+        "clamp": {"max_tokens": {"min": 1, "drop": True}, "max_completion_tokens": {"min": 1, "drop": True}},
+    },
+    "baidu": {"auth": AUTH_RAW_COOKIE},
+}
+
+ACCOUNT_TOKEN_FIELDS = ("token", "hy_token")
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
+
+Step = Callable[[Dict, Any], None]
+
+
+def transform_options(service_key: str, service: Optional[Dict]) -> Dict:
+    options = dict(DEFAULT_TRANSFORMS)
+    for overrides in (BUILTIN_TRANSFORMS.get(service_key), (service or {}).get("transforms")):
+        if isinstance(overrides, dict):
+            for k in DEFAULT_TRANSFORMS:
+                if overrides.get(k) is not None:
+                    options[k] = overrides[k]
+    return options
+
+
+def _drop_step(fields: List[str]) -> Step:
+    fields = tuple(fields)
+
+    def drop(body: Dict, account):
+        for k in fields:
+            body.pop(k, None)
+
+    return drop
+
+
+def _clamp_step(rules: Dict[str, Dict]) -> Step:
+    compiled = [
+        (field, rule.get("min"), rule.get("max"), bool(rule.get("drop")))
+        for field, rule in rules.items()
+        if isinstance(rule, dict)
+    ]
+
+    def clamp(body: Dict, account):
+        for field, low, high, drop in compiled:
+            value = body.get(field)
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            if low is not None and value < low:
+                if drop:
+                    body.pop(field, None)
+                else:
+                    body[field] = low
+            elif high is not None and value > high:
+                if drop:
+                    body.pop(field, None)
+                else:
+                    body[field] = high
+
+    return clamp
+
+
+def _set_step(values: Dict) -> Step:
+    items = tuple(values.items())
+
+    def set_fields(body: Dict, account):
+        for k, v in items:
+            body[k] = v
+
+    return set_fields
+
+
+def _inject_account(body: Dict, account):
+    if isinstance(account, dict):
+        for k, v in account.items():
+            if k not in ACCOUNT_TOKEN_FIELDS:
+                body[k] = v
+
+
+class ServiceTransform:
+    """
+    One service's request pipeline, compiled from its "transforms" options. passthrough is True when
+    apply() can never change a body, so the client's bytes may be forwarded untouched.
+    """
+
+    __slots__ = ("service_key", "steps", "passthrough", "auth", "extra_headers")
+
+    def __init__(self, service_key: str, options: Dict, accounts: List[Tuple[str, Any]]):
+        self.service_key = service_key
+        steps: List[Step] = []
+        if options.get("drop"):
+            steps.append(_drop_step(options["drop"]))
+        if options.get("clamp"):
+            steps.append(_clamp_step(options["clamp"]))
+        if options.get("set"):
+            steps.append(_set_step(options["set"]))
+        if options.get("inject_account") and any(isinstance(a, dict) for _, a in accounts):
+            steps.append(_inject_account)
+        self.steps = tuple(steps)
+        self.passthrough = not steps
+        self.auth = options.get("auth") or AUTH_BEARER
+        self.extra_headers = {str(k): str(v) for k, v in (options.get("headers") or {}).items()}
+
+    def apply(self, body: Dict, account=None) -> Dict:
+        for step in self.steps:
+            step(body, account)
+        return body
+
+    def headers(self, account, content_type: Optional[str] = "application/json") -> Dict:
+        headers = {"User-Agent": USER_AGENT}
+        if content_type:
+            headers["Content-Type"] = content_type
+        headers.update(self.extra_headers)
+
+        if isinstance(account, dict):
+            token = account.get("hy_token") or account.get("token")
+        else:
+            token = account
+        if not token:
+            logger.warning(f"No token configured for service {self.service_key}. Request sent without Authorization header.")
+            return headers
+        if self.auth == AUTH_NONE:
+            return headers
+        if self.auth == AUTH_RAW or (
+            self.auth == AUTH_RAW_COOKIE and (token.strip().startswith("{") or "BDUSS" in token)
+        ):
+            headers["Authorization"] = token
+        else:
+            headers["Authorization"] = f"Bearer {token}"
+        return headers
+
+
+def compile_transforms(config: Dict, accounts: Dict[str, List[Tuple[str, Any]]]) -> Dict[str, ServiceTransform]:
+    return {
+        key: ServiceTransform(key, transform_options(key, service), accounts.get(key, []))
+        for key, service in (config or {}).items()
+        if isinstance(service, dict)
+    }
+
+
+def default_transform(service_key: str) -> ServiceTransform:
+    """Transform for a service missing from the compiled table (e.g. removed by a concurrent reload)."""
+    return ServiceTransform(service_key, transform_options(service_key, None), [])